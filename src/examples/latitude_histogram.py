@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from lsd import DB
+from lsd.pool2 import combine, sum_values
 import numpy as np
 
 def mapper(qresult, bins):
@@ -10,18 +11,16 @@ def mapper(qresult, bins):
 			if count != 0:
 				yield (bin, count)
 
-def reducer(kv):
-	bin, counts = kv
-	yield (bin, sum(counts))
-
 db = DB('db')
 query = db.query("SELECT dec FROM sdss")
 
 ddec = 10.
 bins = np.arange(-90, 90.0001, ddec)
 
+# Sum up the counts within each cell on the workers (the combiner),
+# and then the per-cell counts in the reducer
 hist = {}
-for (bin, count) in query.execute([(mapper, bins), reducer]):
+for (bin, count) in query.execute([combine((mapper, bins), sum_values), sum_values]):
 	hist[bin + ddec/2] = count
 
 for binctr in sorted(hist.keys()):
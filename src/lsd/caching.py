@@ -49,38 +49,68 @@ class CallResultCache(object):
 
 		fcntl.lockf(fp, fcntl.LOCK_UN)
 
+	def _hash_args(self, func, args, kwds):
+		# Construct the hash of the arguments, using the buffer protocol where
+		# possible
+		if True:
+			m = hashlib.md5()
+			for k, a in zip('\0'*len(args), args) + sorted(kwds.items()):
+				m.update(k)
+				try:
+					m.update(a)
+				except TypeError:
+					m.update(cPickle.dumps(a, -1))
+			funcname = func.__module__ + "." + func.__name__
+			hash = funcname + '-' + m.hexdigest()
+		else:
+			# Note: for 32bit hash, probability of collision of any two
+			# is about 1% for ~10k hashes, 50% for ~80k hashes
+			# This is bad.
+			import zlib
+			m = 0
+			csum = zlib.crc32
+			for k, a in zip('\0'*len(args), args) + sorted(kwds.items()):
+				m = csum(k, m)
+				try:
+					m = csum(a, m)
+				except TypeError:
+					m = csum(cPickle.dumps(a, -1), m)
+			funcname = func.__module__ + "." + func.__name__
+			hash = funcname + '-crc-' + str(m + 0x80000000)
+		#print "HASH: ", hash
+
+		return hash
+
 	def cached(self, func):
+		return self._make_wrapper(func, lambda args, kwds: self._hash_args(func, args, kwds))
+
+	def cached_by(self, keyfunc):
+		"""
+			Cache by key, rather than by argument values
+
+			Returns a decorator caching the results of a function
+			under keyfunc(*args, **kwds), rather than under the
+			values of the arguments themselves. Useful when the
+			arguments are expensive (or impossible) to pickle, but
+			the result is fully determined by some cheaper
+			summary of them. If keyfunc returns None, the result
+			is computed and not cached.
+		"""
+		def decorator(func):
+			def hashfunc(args, kwds):
+				key = keyfunc(*args, **kwds)
+				return self._hash_args(func, (key,), {}) if key is not None else None
+			return self._make_wrapper(func, hashfunc)
+		return decorator
+
+	def _make_wrapper(self, func, hashfunc):
 
 		@functools.wraps(func)
 		def wrapper(*args, **kwds):
-			# Construct the hash of the arguments, using the buffer protocol where
-			# possible
-			if True:
-				m = hashlib.md5()
-				for k, a in zip('\0'*len(args), args) + sorted(kwds.items()):
-					m.update(k)
-					try:
-						m.update(a)
-					except TypeError:
-						m.update(cPickle.dumps(a, -1))
-				funcname = func.__module__ + "." + func.__name__
-				hash = funcname + '-' + m.hexdigest()
-			else:
-				# Note: for 32bit hash, probability of collision of any two
-				# is about 1% for ~10k hashes, 50% for ~80k hashes
-				# This is bad.
-				import zlib
-				m = 0
-				csum = zlib.crc32
-				for k, a in zip('\0'*len(args), args) + sorted(kwds.items()):
-					m = csum(k, m)
-					try:
-						m = csum(a, m)
-					except TypeError:
-						m = csum(cPickle.dumps(a, -1), m)
-				funcname = func.__module__ + "." + func.__name__
-				hash = funcname + '-crc-' + str(m + 0x80000000)
-			#print "HASH: ", hash
+			hash = hashfunc(args, kwds)
+			if hash is None:
+				wrapper.misses += 1
+				return func(*args, **kwds)
 
 			# See if it's in memory cache (LRU)
 			try:
@@ -165,6 +195,7 @@ class CallResultCache(object):
 ## Default cache object
 oc = CallResultCache()
 cached = oc.cached
+cached_by = oc.cached_by
 
 ## Some testing code
 if __name__ == "__main__":
@@ -11,9 +11,11 @@ of equal length.
 """
 
 import numpy as np
-from utils import full_dtype
+from utils import full_dtype, tempdir
+from mr import serialization
 import copy
 import tempfile, os, cPickle, sys
+import mmap
 
 def make_record(dtype):
 	# Construct a numpy record corresponding to a row of this table
@@ -593,37 +595,96 @@ class ColGroup(object):
 		return self
 
 
+def _colgroup_to_columns(cg):
+	cols = cg.items()
+	if any(col.dtype.hasobject for (_, col) in cols):
+		return None
+	return cols, cg.info
+
+def _colgroup_from_columns(cols, info):
+	return ColGroup(cols, info=info)
+
+# Serialize ColGroups as raw columns when passing them between MapReduce stages
+serialization.register(ColGroup, 'colgroup', _colgroup_to_columns, _colgroup_from_columns)
+
+def _is_mapped(col):
+	"""
+	Return True if col is backed by a private memory mapping (e.g.,
+	a result passed back by a pool2 worker via shared memory), and
+	can be handed out without copying.
+	"""
+	base = col
+	while isinstance(base, np.ndarray) and not base.flags.owndata:
+		base = base.base
+	return isinstance(base, mmap.mmap)
+
 def fromiter(it, dtype=None, blocks=False):
 	"""
 	Load a ColGroup from an iterable.
+
+	The blocks are collected as they come, and concatenated once, a
+	column at a time. Unless the caller holds on to the blocks, each
+	column's blocks are released as soon as it's been concatenated,
+	so the peak memory use is not much above the size of the result.
 	"""
 	assert blocks == True, "blocks==False not implemented yet."
 
-	buf = None
+	names, info, columns = None, None, None
 	for rows in it:
-		if buf is None:
-			# Just copy the first one
-			buf = rows.copy()
-			at  = len(buf)
+		if names is None:
+			if not isinstance(rows, ColGroup):
+				# Structured ndarrays
+				return np.concatenate([rows] + list(it))
+			names, info = rows.keys(), rows.info
+			columns = [ [] for _ in names ]
+		for (data, name) in zip(columns, names):
+			data.append(rows[name])
+	rows = None
+
+	if names is None:
+		return ColGroup(dtype=dtype, size=0)
+
+	buf = ColGroup(info=info)
+	for name in names:
+		data = columns.pop(0)
+		if len(data) == 1 and _is_mapped(data[0]):
+			col = data[0]
 		else:
-			at2 = at + len(rows)
-			if at2 > len(buf):
-				# Next higher power of two
-				newsize = 1 << int(np.ceil(np.log2(at2)))
-				buf.resize(newsize)
-
-			# append
-			buf[at:at+len(rows)] = rows
-			at = at + len(rows)
-
-	# Truncate the buffer to output size
-	if buf is not None:
-		buf.resize(at)
-	else:
-		buf = ColGroup(dtype=dtype, size=0)
+			col = np.concatenate(data)
+		del data[:]
+		buf.add_column(name, col)
 
 	return buf
 
+def tofile(it, fn, dtype=None, blocks=False, tabname='rows'):
+	"""
+	Stream blocks from an iterable into table <tabname> of a new HDF5
+	file <fn>, without materializing them in memory.
+
+	Returns the number of rows written.
+	"""
+	assert blocks == True, "blocks==False not implemented yet."
+	import tables
+
+	n = 0
+	fp = tables.openFile(fn, mode='w')
+	try:
+		table = None
+		for rows in it:
+			if isinstance(rows, ColGroup):
+				rows = rows.as_ndarray()
+			if table is None:
+				table = fp.createTable('/', tabname, rows.dtype)
+			table.append(rows)
+			n += len(rows)
+
+		if table is None and dtype is not None:
+			fp.createTable('/', tabname, np.dtype(dtype))
+	finally:
+		fp.close()
+
+	return n
+
 def count_unique(v):
 	""" Given a ndarray v, return a tuple k, ct
 	    where k is an array of unique elements of v
@@ -676,7 +737,7 @@ def partitioned_fromiter(it, keycol, maxrows, dtype=None, blocks=False):
 				buf.resize(at)
 #				print "Writing block, len=", len(buf)
 				if fp is None:
-					fp = tempfile.NamedTemporaryFile(mode='r+b', prefix='fromiter-', dir=os.getenv('LSD_TEMPDIR'), suffix='.pkl', delete=True)
+					fp = tempfile.NamedTemporaryFile(mode='r+b', prefix='fromiter-', dir=tempdir(), suffix='.pkl', delete=True)
 				keys.append(buf[keycol].copy())
 				cPickle.dump(buf, fp, -1)
 				buf = None
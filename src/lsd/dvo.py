@@ -76,6 +76,7 @@ def import_from_dvo(catdir, dvo_files, create=False):
 		time_tot = time_pass / at * len(dvo_files)
 		print('  ===> Imported %s [%d/%d, %5.2f%%] +%-6d %9d (%.0f/%.0f min.)' % (file, at, len(dvo_files), 100 * float(at) / len(dvo_files), nloaded, ntot, time_pass, time_tot))
 
+@pool2.non_speculative
 def import_from_dvo_aux(file, cat):
 	# Load object data
 	dat, hdr = pyfits.getdata(file, 1, header=1)
@@ -31,6 +31,8 @@ from table       import Table
 
 import caching
 
+logger = logging.getLogger('lsd.join_ops')
+
 @caching.cached
 def cached_proj_bhealpix(lon, lat):
 	return bhpix.proj_bhealpix(lon, lat)
@@ -39,16 +41,86 @@ def cached_proj_bhealpix(lon, lat):
 def cached_isInsideV(bounds_xy, x, y):
 	return bounds_xy.isInsideV(x, y)
 
+def _canonical_bounds(bounds):
+	# Return a canonical, picklable, representation of a list of
+	# (Polygon, intervalset) bounds
+	if bounds is None:
+		return None
+
+	canon = []
+	for bounds_xy, bounds_t in bounds:
+		xy = None if bounds_xy is None else tuple( (bounds_xy.isHole(c), tuple(map(tuple, bounds_xy.contour(c)))) for c in xrange(len(bounds_xy)) )
+		t  = None if bounds_t  is None else tuple(bounds_t.data)
+		canon.append((xy, t))
+	return tuple(canon)
+
+def _plan_key(root, bounds, include_cached):
+	snapshots = root.catalog_snapshots()
+	if snapshots is None:
+		return None
+	return (snapshots, _canonical_bounds(bounds), include_cached)
+
+@caching.cached_by(_plan_key)
+def cached_get_cells(root, bounds, include_cached):
+	# Query planning: the cells (and their bounds) touched by a query on
+	# the join tree rooted at root. Keyed on the shape of the tree, the
+	# relations and the snapshots of the tables involved, so committing a
+	# new snapshot invalidates the result.
+	return root.get_cells(bounds, include_cached=include_cached)
+
 def set_NULL(col, mask=np.s_[:]):
 	""" Set the NULL marker apropriate for the datatype """
 	col[mask] = 0
 
+class SparseTablet(object):
+	""" Rows of a (possibly sparse) non-primary cgroup tablet.
+
+	    A sparse tablet may hold fewer rows than the primary cgroup
+	    tablet of the same cell; the missing trailing rows (in both
+	    the main and neighbor cache parts) are NULL. Rather than
+	    resizing the whole tablet up front, each column is padded only
+	    when requested, and only if it's actually short. Columns of
+	    fully populated tablets are returned as views, with no copy.
+	"""
+	rows    = None	# The rows as read from the tablet (main + cached)
+	valid   = None	# (nmain, ncached) rows present in the tablet
+	nrows   = None	# (nmain, ncached) rows in the primary cgroup tablet
+	columns = None	# Cache of padded columns
+
+	def __init__(self, rows, valid, nrows):
+		self.rows = rows
+		self.valid = valid
+		self.nrows = nrows
+		self.columns = {}
+
+	def is_sparse(self):
+		return self.valid != self.nrows
+
+	def column(self, name, expand=True):
+		if not expand or not self.is_sparse():
+			return self.rows[name]
+
+		try:
+			return self.columns[name]
+		except KeyError:
+			pass
+
+		src = self.rows[name]
+		col = np.zeros((sum(self.nrows),) + src.shape[1:], dtype=src.dtype)
+		(vmain, vcached), (nmain, ncached) = self.valid, self.nrows
+		m, c = min(vmain, nmain), min(vcached, ncached)
+		col[:m] = src[:m]
+		col[nmain:nmain+c] = src[vmain:vmain+c]
+
+		self.columns[name] = col
+		return col
+
 class TabletCache:
 	""" An cache of tablets loaded while performing a Query.
 
 		TODO: Perhaps merge it with DB? Or make it a global?
 	"""
-	cache = None		# Cache of loaded tables, in the form of (cell_id, table, cgroup, include_cached) -> rows
+	cache = None		# Cache of loaded tables, in the form of (cell_id, table, cgroup, include_cached) -> rows (or SparseTablet)
 
 	root_path = None	# The name of the root table (string). Used for figuring out if _not_ to load the cached rows.
 	include_cached = False	# Should we load the cached rows from the root table?
@@ -59,7 +131,17 @@ class TabletCache:
 		self.include_cached = include_cached
 		self.max_cached = max_cached
 
-	def _fetch_tablet(self, cell_id, table, cgroup, include_cached, autoexpand=True):
+	def _primary_row_counts(self, cell_id, table, include_cached):
+		# Return the (main, cached) number of rows in the primary
+		# cgroup's tablet, from table metadata (no column is loaded)
+		cell_id = table.static_if_no_temporal(cell_id)
+		if not table.cell_exists(cell_id):
+			return 0, 0
+
+		nmain, ncached = table.cell_row_counts(cell_id)
+		return nmain, (ncached if include_cached else 0)
+
+	def _fetch_tablet(self, cell_id, table, cgroup, include_cached):
 		key = (cell_id, table.name, cgroup, include_cached)
 
 		try:
@@ -74,13 +156,14 @@ class TabletCache:
 			if len(self.cache) > self.max_cached:
 				self.cache.popitem(last=False)
 
-			# Load and cache the tablet
-			rows = table.fetch_tablet(cell_id, cgroup, include_cached=include_cached)
-
-			# Ensure it's as long as the primary table (this allows us to support "sparse" tablets)
-			if autoexpand and cgroup != table.primary_cgroup:
-				nrows = len(self.load_column(cell_id, table.primary_key.name, table))
-				rows.resize(nrows)
+			# Load and cache the tablet. Non-primary tablets may be
+			# shorter than the primary one ("sparse" tablets); these
+			# get wrapped so that they can be padded on access.
+			if cgroup == table.primary_cgroup or table._is_pseudotablet(cgroup):
+				rows = table.fetch_tablet(cell_id, cgroup, include_cached=include_cached)
+			else:
+				rows, valid = table.fetch_tablet(cell_id, cgroup, include_cached=include_cached, return_counts=True)
+				rows = SparseTablet(rows, valid, self._primary_row_counts(cell_id, table, include_cached))
 
 			self.cache[key] = rows
 
@@ -99,9 +182,9 @@ class TabletCache:
 		# Figure out which table contains this column
 		cgroup = table.columns[name].cgroup
 
-		rows = self._fetch_tablet(cell_id, table, cgroup, include_cached, autoexpand=autoexpand)
+		rows = self._fetch_tablet(cell_id, table, cgroup, include_cached)
 
-		col = rows[name]
+		col = rows.column(name, expand=autoexpand) if isinstance(rows, SparseTablet) else rows[name]
 		
 		# resolve blobs, if requested
 		if resolve_blobs:
@@ -132,6 +215,25 @@ class TableEntry:
 		self.name  = name if name is not None else name
 		self.joins = []
 
+	def catalog_snapshots(self):
+		""" Return a (hashable) description of this join (sub)tree:
+		    a tuple of the (table path, catalog snapshot) pair of this
+		    table, followed by a (relation key, subtree) pair for each
+		    of the joined tables. Returns None if any of the tables is
+		    in a transaction. See Table.catalog_snapshot().
+		"""
+		snapid = self.table.catalog_snapshot()
+		if snapid is None:
+			return None
+
+		snapshots = [ (self.table.path, snapid) ]
+		for ce in self.joins:
+			s = ce.catalog_snapshots()
+			if s is None:
+				return None
+			snapshots.append((ce.relation.key(), s))
+		return tuple(snapshots)
+
 	def get_cells(self, bounds, include_cached=True):
 		""" Get populated cells of self.table that overlap
 			the requested bounds. Do it recursively.
@@ -396,16 +498,21 @@ class JoinRelation:
 	db     = None	# Controlling database instance
 	tableR = None	# Right-hand side table of the relation
 	tableS = None	# Left-hand side table of the relation
+	joindef = None	# The definition of the relation (join file contents + FROM clause args)
 	
 	def __init__(self, db, tableR, tableS, **joindef):
 		self.db     = db
 		self.kind   = 'inner' if 'outer' not in joindef else 'outer'
 		self.tableR = tableR
 		self.tableS = tableS
+		self.joindef = joindef
 
 	def join_op(self):	# Returns 'and' if the relation has an inner join-like effect, and 'or' otherwise
 		return 'and' if self.kind == 'inner' else 'or'
 
+	def key(self):		# Returns a hashable description of the relation (see TableEntry.catalog_snapshots())
+		return (self.__class__.__name__, self.join_op(), repr(sorted(self.joindef.items())))
+
 	def join(self, cell_id, table1, table2, idx1, idx2, tcache):	# Returns idx1, idx2, isnull
 		raise NotImplementedError('You must override this method from a derived class')
 
@@ -672,6 +779,7 @@ class QueryInstance(object):
 	cell_id  = None		# cell_id on which we're operating
 	jmap 	 = None		# index map used to materialize the JOINs
 	bounds   = None
+	rows     = None		# (lo, hi) range of root table rows to operate on (None for all)
 
 	# These will be filled in from a QueryEngine instance
 	db       = None		# The controlling database instance
@@ -681,7 +789,7 @@ class QueryInstance(object):
 	pix      = None         # Pixelization object (TODO: this should be moved to class DB)
 	locals   = None		# Extra local variables to be made available within the query
 
-	def __init__(self, q, cell_id, bounds, include_cached):
+	def __init__(self, q, cell_id, bounds, include_cached, rows=None):
 		self.db            = q.db
 		self.tables	   = q.tables
 		self.root	   = q.root
@@ -691,6 +799,7 @@ class QueryInstance(object):
 
 		self.cell_id	= cell_id
 		self.bounds	= bounds
+		self.rows	= rows
 
 		self.tcache	= TabletCache(self.root.table.path, include_cached)
 		self.columns	= {}
@@ -704,6 +813,8 @@ class QueryInstance(object):
 
 		# Evaluate the JOIN map
 		self.jmap   	    = self.root.evaluate_join(self.cell_id, self.bounds, self.tcache)
+		if self.jmap is not None and self.rows is not None:
+			self.jmap = self._restrict_jmap(self.jmap, *self.rows)
 
 		if self.jmap is not None:
 			# TODO: We could optimize this by evaluating WHERE first, using the result
@@ -716,6 +827,7 @@ class QueryInstance(object):
 			# eval individual columns in select clause to slurp them up from disk
 			# and have them ready for the WHERE clause
 			rows = self.eval_select(globals_)
+			pool2.record(rows_in=len(rows))
 
 			if len(rows):
 				in_  = self.eval_where(globals_)
@@ -723,6 +835,7 @@ class QueryInstance(object):
 				if(in_.any()):
 					if not in_.all():
 						rows = rows[in_]
+					pool2.record(rows_out=len(rows))
 
 					# Attach metadata
 					rows.info.cell_id = self.cell_id
@@ -731,6 +844,22 @@ class QueryInstance(object):
 
 		# We yield nothing if the result set is empty.
 
+	def _restrict_jmap(self, jmap, lo, hi):
+		# Keep only the part of the JOIN map that comes from root
+		# table rows in [lo, hi)
+		name = self.root.name
+		if name in jmap:
+			idx = jmap[name]
+			jmap = jmap[(lo <= idx) & (idx < hi)]
+		else:
+			# A trivial map (all rows of the root table)
+			nrows = len(self.tcache.load_column(self.cell_id, self.root.table.get_primary_key(), self.root.table))
+			jmap = ColGroup()
+			jmap[name] = np.arange(lo, min(hi, nrows))
+			jmap[name + '._ISNULL'] = np.zeros(len(jmap[name]), dtype='bool')
+
+		return jmap if len(jmap) else None
+
 	def prep_globals(self):
 		globals_ = self.db.get_globals()
 
@@ -1189,8 +1318,13 @@ class IntoWriter(object):
 				# Creating a new table
 				table = db.table(tabname, True)
 
-				# Enable compression
-				table.set_default_filters(**{ 'complevel': 5, 'complib': 'blosc', 'fletcher32': False })
+				# Enable compression (blosc, level 5, unless overridden with INTO arguments)
+				complib   = into_args.get('complib', 'blosc')
+				complevel = int(into_args.get('complevel', 5))
+				if complib == 'none':
+					table.set_default_filters(complevel=0)
+				else:
+					table.set_default_filters(**{ 'complevel': complevel, 'complib': complib, 'fletcher32': False })
 
 				# Create all columns
 				schema['columns'] = [ (name, utils.str_dtype(dtype[name])) for name in dtype.names ]
@@ -1279,10 +1413,11 @@ class QueryEngine(object):
 	def on_cell(self, cell_id, bounds=None, include_cached=False):
 		return QueryInstance(self, cell_id, bounds, include_cached)
 
-	def on_cells(self, partspecs, include_cached=False):
+	def on_cells(self, partspecs, include_cached=False, rows=None):
 		# Set up the args for __iter__
 		self._partspecs = partspecs
 		self._include_cached = include_cached
+		self._rows = rows
 
 		# Set the static cell
 		if partspecs:
@@ -1296,7 +1431,7 @@ class QueryEngine(object):
 		partspecs, include_cached = self._partspecs, self._include_cached
 
 		for cell_id, bounds in partspecs:
-			for rows in QueryInstance(self, cell_id, bounds, include_cached):
+			for rows in QueryInstance(self, cell_id, bounds, include_cached, self._rows):
 				yield rows
 
 	def peek(self):
@@ -1308,6 +1443,10 @@ class Query(object):
 	qwriter = None
 	query_string = None
 
+	# Queries estimated to read no more than this many rows are executed
+	# in-process, without starting worker processes (see _make_pool())
+	inprocess_max_rows = int(os.getenv("LSD_INPROCESS_MAX_ROWS", 250000))
+
 	def __str__(self):
 		"""
 		Returns the query string.
@@ -1329,7 +1468,112 @@ class Query(object):
 		if into_clause:
 			self.qwriter = IntoWriter(db, into_clause, locals)
 
-	def execute(self, kernels, bounds=None, include_cached=False, cells=[], group_by_static_cell=False, testbounds=True, nworkers=None, progress_callback=None, _yield_empty=False):
+	def estimate_rows(self, partspecs, include_cached=False):
+		"""
+		Internal: Estimate the number of rows a query will read.
+
+		Adds up the row counts recorded in table catalogs for all
+		tables in the query, in all cells in partspecs (as constructed
+		by execute()). This is an upper bound, as the spatial and
+		temporal bounds are not taken into account. Returns None if
+		the counts are unknown for some of the cells.
+		"""
+		nrows = 0
+		for parts in partspecs.itervalues():
+			n = self._parts_rows(parts, include_cached)
+			if n is None:
+				return None
+			nrows += n
+		return nrows
+
+	def _parts_rows(self, parts, include_cached, tables=None):
+		"""
+		Internal: Estimate the number of rows read from a list of
+		(cell_id, bounds) parts, in all tables in the query (or just
+		in the given ones). Returns None if unknown.
+		"""
+		if tables is None:
+			tables = [ entry.table for entry in self.qengine.tables.itervalues() ]
+
+		nrows = 0
+		for table in tables:
+			for cell_id, _ in parts:
+				cell_id = table.static_if_no_temporal(cell_id)
+				try:
+					counts = table.catalog.row_counts(cell_id)
+				except LookupError:
+					continue
+				if counts is None:
+					return None
+				nrows += counts[0] + (counts[1] if include_cached else 0)
+		return nrows
+
+	def _schedule(self, partspecs, include_cached, split_rows=None):
+		"""
+		Internal: Turn partspecs into a list of tasks for the mapper.
+
+		The tasks are ordered by their estimated cost (the number of
+		rows they'll read), largest first, so that a few big cells
+		don't end up running alone after everything else has
+		finished. Cells of unknown size are scheduled last.
+
+		If split_rows is given, single cells with more than
+		split_rows rows in the root table are split into subtasks
+		processing up to split_rows rows each.
+		"""
+		root = self.qengine.root.table
+
+		tasks = []
+		for key, parts in partspecs.iteritems():
+			cost = self._parts_rows(parts, include_cached)
+			if cost is None:
+				cost = -1
+
+			if split_rows and len(parts) == 1:
+				nrows = self._parts_rows(parts, include_cached, [root])
+				if nrows is not None and nrows > split_rows:
+					nsplit = (nrows + split_rows - 1) // split_rows
+					for lo in xrange(0, nrows, split_rows):
+						tasks.append((cost / nsplit, (key, parts, (lo, lo + split_rows))))
+					continue
+
+			tasks.append((cost, (key, parts)))
+
+		tasks.sort(key=lambda task: -task[0])
+		return [ task for (_, task) in tasks ]
+
+	def _make_pool(self, partspecs, include_cached, nworkers):
+		"""
+		Internal: Choose the executor for the query.
+
+		Unless the number of workers has been given explicitly, queries
+		estimated to touch fewer than inprocess_max_rows rows are run
+		in-process; the overhead of starting up the workers would
+		dominate their runtime. Larger ones run on the (long-lived)
+		pool2.shared_pool(), or an mr.Pool if PYMR is set.
+		"""
+		if nworkers is None:
+			nrows = self.estimate_rows(partspecs, include_cached)
+			if nrows is not None and nrows <= self.inprocess_max_rows:
+				logger.debug("Running in-process (~%d rows)" % nrows)
+				return pool2.Pool(1)
+
+		peer_directory = os.getenv("PYMR", None)
+		if peer_directory is None:
+			return pool2.shared_pool(nworkers)
+		else:
+			return mr.Pool(peer_directory)
+
+	def _checkpoint(self, path, kernels, *args):
+		# Open the checkpoint for this query, its kernels (with their
+		# arguments), the remaining arguments to execute() (args), and
+		# the snapshots of the tables (or the transaction, if one is
+		# open), in directory path
+		snapid = self.db.snapid if self.db.in_transaction() else None
+		tag = (snapid, self.qengine.root.catalog_snapshots(), self.query_string, list(kernels)) + args
+		return pool2.Checkpoint(path, tag=tag)
+
+	def execute(self, kernels, bounds=None, include_cached=False, cells=[], group_by_static_cell=False, testbounds=True, nworkers=None, progress_callback=None, split_rows=None, checkpoint=None, _yield_empty=False):
 		"""
 		Map/Reduce a list of functions over query results
 		
@@ -1403,6 +1647,12 @@ class Query(object):
 		    will be yielded back to the user, with no further
 		    processing.
 
+		    Any kernel but the last may be wrapped with
+		    pool2.combine(kernel, combiner), to have its outputs
+		    pre-reduced by the combiner on the workers before they're
+		    passed on to the next kernel. See pool2.combine() and
+		    pool2.sum_values().
+
 		bounds : list of (Polygon, intervalset) tuples
 		    A list of space/time bounds to which to restrict the
 		    query. The list is used to cull the list of all cells in
@@ -1434,6 +1684,31 @@ class Query(object):
 		    interruption). For more, see the discussion in
 		    "Important notes"
 
+		split_rows : int
+		    If set, cells with more than split_rows rows in the
+		    primary table are processed in pieces of up to
+		    split_rows rows, by separate executions of the mapper
+		    (which may run in parallel). Use this to spread a few
+		    very large cells over many workers, if your mapper
+		    does not need to see a whole cell at once. Ignored if
+		    group_by_static_cell is set. Note that _ROWNUM is
+		    counted from zero within each piece.
+
+		checkpoint : string
+		    A directory in which to record the results of each
+		    completed cell (and of each key of the reducers). If the
+		    job is interrupted, calling execute() again with the
+		    same arguments and checkpoint will skip the work that
+		    has already been done, and yield back its recorded
+		    results instead. The checkpoint is reused only for the
+		    same query, kernels (and their arguments), bounds and
+		    cells, and only if the tables haven't changed since
+		    (or, if a transaction is open, within the same
+		    transaction); otherwise it's discarded. Tasks writing
+		    into tables (e.g., of queries with an INTO clause) that
+		    were interrupted are rolled back before being rerun.
+		    See pool2.Checkpoint.
+
 		Important notes
 		---------------
 		    - Each execution of a mapper is guaranteed to operate on
@@ -1461,6 +1736,10 @@ class Query(object):
 		    - The keys must be comparable and hashable (nearly every
 		      Python object is).
 		"""
+		# Open the checkpoint, if requested
+		if checkpoint is not None:
+			checkpoint = self._checkpoint(checkpoint, kernels, _canonical_bounds(bounds), sorted(cells), include_cached, group_by_static_cell, testbounds, split_rows)
+
 		partspecs = dict()
 
 		# Add explicitly requested cells
@@ -1469,7 +1748,7 @@ class Query(object):
 
 		# Add cells within bounds
 		if len(cells) == 0 or bounds is not None:
-			partspecs.update(self.qengine.root.get_cells(bounds, include_cached=include_cached))
+			partspecs.update(cached_get_cells(self.qengine.root, bounds, include_cached))
 
 		# Tell _mapper not to test spacetime boundaries if the user requested so
 		if not testbounds:
@@ -1512,14 +1791,17 @@ class Query(object):
 		if self.qwriter:
 			kernels.append((_into_writer, self.qwriter))
 
+		# Record the results of completed tasks into the checkpoint
+		if checkpoint is not None:
+			kernels = checkpoint.wrap(kernels)
+
+		# Order (and possibly split) the tasks, largest first
+		tasks = self._schedule(partspecs, include_cached, split_rows if not group_by_static_cell else None)
+
 		# start and run the workers
-		peer_directory = os.getenv("PYMR", None)
-		if peer_directory is None:
-			pool = pool2.Pool(nworkers)
-		else:
-			pool = mr.Pool(peer_directory)
+		pool = self._make_pool(partspecs, include_cached, nworkers)
 		yielded = False
-		for result in pool.map_reduce_chain(partspecs.items(), kernels, progress_callback=progress_callback):
+		for result in pool.map_reduce_chain(tasks, kernels, progress_callback=progress_callback):
 			yield result
 			yielded = True
 
@@ -1531,7 +1813,7 @@ class Query(object):
 			else:
 				yield 0, self.qengine.peek()
 
-		# Shut down the workers
+		# Release the pool (a shared pool's workers are kept running)
 		del pool
 
 	def iterate(self, bounds=None, include_cached=False, cells=[], return_blocks=False, filter=None, testbounds=True, nworkers=None, progress_callback=None, _yield_empty=False):
@@ -1584,7 +1866,7 @@ class Query(object):
 				for row in rows:
 					yield row
 
-	def fetch(self, bounds=None, include_cached=False, cells=[], filter=None, testbounds=True, nworkers=None, progress_callback=None):
+	def fetch(self, bounds=None, include_cached=False, cells=[], filter=None, testbounds=True, nworkers=None, progress_callback=None, output=None):
 		"""
 		Returns a table (a ColGroup instance) with query results.
 
@@ -1593,19 +1875,25 @@ class Query(object):
 		the results in a single ColGroup instance. This is
 		convenient to collect results of smaller queries.
 
+		If 'output' is given, the results are instead streamed into
+		an HDF5 file of that name (as table '/rows'), without being
+		collected in memory. The number of rows written is returned.
+
 		See Query.iterate() and Query.execute() for descriptions of
 		various parameters.
 		"""
 
-		return colgroup.fromiter(
-				self.iterate(
-					bounds, include_cached, cells=cells,
-					return_blocks=True, filter=filter, _yield_empty=True,
-					nworkers=nworkers, progress_callback=progress_callback
-					),
-				blocks=True
+		blocks = self.iterate(
+				bounds, include_cached, cells=cells,
+				return_blocks=True, filter=filter, _yield_empty=True,
+				nworkers=nworkers, progress_callback=progress_callback
 			)
 
+		if output is not None:
+			return colgroup.tofile(blocks, output, blocks=True)
+
+		return colgroup.fromiter(blocks, blocks=True)
+
 	def fetch_cell(self, cell_id, include_cached=False):
 		""" Internal: Execute the query on a given (single) cell.
 
@@ -1627,6 +1915,11 @@ class DB(object):
 	snapid = 0		#: Snapshot ID
 	_transaction = False	#: Whether we're in an open transaction
 
+	_udfs = None		#: UDF namespace (loaded on first use; see the udfs property)
+	_udf_modules = None	#: Names of modules to load UDFs from
+	_registered_udfs = None	#: UDFs registered with register_udf()
+	_udf_cache = {}		#: Per-process cache of loaded UDF namespaces, keyed by (path, udf_modules)
+
 	def _tsnap_to_snapid(self, tsnap):
 		return "%s.%06d" % (time.strftime("%Y%m%d%H%M%S", time.gmtime(tsnap)), int(1e6*(tsnap-int(tsnap))))
 
@@ -1647,7 +1940,8 @@ class DB(object):
 				udf_modules = os.environ['LSD_USER_MODULES'].split(':')
 			except KeyError:
 				udf_modules = []
-		self.udfs = self._load_udfs(self.path, udf_modules)
+		self._udf_modules = udf_modules
+		self._registered_udfs = OrderedDict()
 
 		self.snapid = self._tsnap_to_snapid(time.time())
 
@@ -1657,6 +1951,30 @@ class DB(object):
 
 		self.tables = dict()	# A cache of table instances
 
+	def __getstate__(self):
+		# Don't pickle the UDFs; they're (re)loaded on first use, at
+		# most once per process. UDFs added by register_udf() are sent
+		# along in _registered_udfs.
+		state = self.__dict__.copy()
+		state.pop('_udfs', None)
+		return state
+
+	@property
+	def udfs(self):
+		if self._udfs is None:
+			key = (tuple(self.path), tuple(self._udf_modules))
+			try:
+				udfs = DB._udf_cache[key]
+			except KeyError:
+				udfs = DB._udf_cache[key] = self._load_udfs(self.path, self._udf_modules)
+
+			# Copy, so that register_udf() calls don't leak between DB instances
+			self._udfs = utils.Namespace(**udfs.__dict__)
+			for name, udf in self._registered_udfs.iteritems():
+				setattr(self._udfs, name, udf)
+
+		return self._udfs
+
 	def get_globals(self):
 		# Return the global environment for query calls
 
@@ -1680,6 +1998,7 @@ class DB(object):
 		if name is None:
 			name = getattr(udf, "__lsd_name__", udf.__name__)
 
+		self._registered_udfs[name] = udf
 		setattr(self.udfs, name, udf)
 
 	def _load_udfs(self, pathlist, udf_modules):
@@ -2206,7 +2525,7 @@ class DB(object):
 		# Return the root of the tree, and a dict of all the Table instances
 		return root, dict((  (tabname, table) for (tabname, (table, _)) in tables.iteritems() ))
 
-	def build_neighbor_cache(self, tabname, snapid, margin_x_arcsec=30):
+	def build_neighbor_cache(self, tabname, snapid, margin_x_arcsec=30, checkpoint=None):
 		""" 
 		(Re)Build the neighbor cache in a given table.
 		
@@ -2221,6 +2540,9 @@ class DB(object):
 		margin_x_arcsec : number
 		    The margin (in arcseconds) which to cache into
 		    neighboring cells
+		checkpoint : string
+		    A directory in which to record the progress, so that an
+		    interrupted run can be resumed (see Query.execute)
 		    
 		TODO: The implementation of this is pretty and inefficient.
 		      It should be nearly completely rewritten at some
@@ -2242,7 +2564,7 @@ class DB(object):
 		for (_, ncached) in self.query(query).execute([
 						(_cache_maker_mapper,  margin_x, self, tabname),
 						(_cache_maker_reducer, self, tabname)
-					], cells=cells):
+					], cells=cells, checkpoint=checkpoint):
 			ntotal = ntotal + ncached
 			ncells = ncells + 1
 			#print self._cell_prefix(cell_id), ": ", ncached, " cached objects"
@@ -2307,6 +2629,7 @@ def _cache_maker_mapper(qresult, margin_x, db, tabname):
 
 		##print "Scanned margins of %s*.h5 (%d objects)" % (db.table(tabname)._cell_prefix(cell_id), len(data))
 
+@pool2.non_speculative
 def _cache_maker_reducer(kv, db, tabname):
 	# Cache all rows to be cached in this cell
 	cell_id, rowblocks = kv
@@ -2352,11 +2675,14 @@ class TableProxy:
 		return self.coldict[self.prefix + '.' + name]
 
 def _mapper(partspec, mapper, qengine, include_cached):
-	(group_cell_id, cell_list) = partspec
+	# partspec is (group_cell_id, cell_list), or (group_cell_id, cell_list, (lo, hi))
+	# for a task operating on a range of rows (see Query._schedule)
+	cell_list = partspec[1]
+	rows = partspec[2] if len(partspec) > 2 else None
 	mapper, mapper_args = utils.unpack_callable(mapper)
 
 	# Pass on to mapper (and yield its results)
-	qresult = qengine.on_cells(cell_list, include_cached)
+	qresult = qengine.on_cells(cell_list, include_cached, rows)
 	for result in mapper(qresult, *mapper_args):
 		yield result
 
@@ -2365,6 +2691,7 @@ def _iterate_mapper(qresult):
 		if len(rows):	# Don't return empty sets. TODO: Do we need this???
 			yield (rows.info.cell_id, rows)
 
+@pool2.non_speculative
 def _into_writer(kw, qwriter):
 	cell_id, irows = kw
 	for rows in irows:
@@ -2376,6 +2703,70 @@ def _into_writer(kw, qwriter):
 def test_kernel(qresult):
 	for rows in qresult:
 		yield qresult.cell_id, len(rows)
+test_kernel.__test__ = False	# Not a unit test (for nose)
+
+############ Unit tests
+
+class _TestTable(object):
+	# A stand-in for Table, with just what query planning needs
+	def __init__(self, path, pix, cells):
+		self.path, self.pix, self.cells = path, pix, cells
+
+	def catalog_snapshot(self):
+		return '20110617084754.101965'
+
+	def get_cells(self, bounds, return_bounds=False, include_cached=True):
+		return dict((cell_id, None) for cell_id in self.cells)
+
+class Test_cached_get_cells:
+	def setUp(self):
+		global uuid
+		import uuid
+		from pixelization import Pixelization
+
+		# Table a is populated in two cells, b only in the first one.
+		# Paths are unique, so earlier runs' (on-disk) cache entries
+		# aren't picked up.
+		pix = Pixelization(7, 54335, 1)
+		self.cells = [ pix.cell_id_for_pos(10., 10.), pix.cell_id_for_pos(100., -20.) ]
+		base = '/nonexistent/%s' % uuid.uuid4()
+		self.a = _TestTable(base + '/a', pix, self.cells)
+		self.b = _TestTable(base + '/b', pix, self.cells[:1])
+
+	def _join_tree(self, **joindef):
+		root, e = TableEntry(self.a, 'a'), TableEntry(self.b, 'b')
+		e.relation = JoinRelation(None, self.a, self.b, **joindef)
+		root.joins.append(e)
+		return root
+
+	def test_inner_then_outer(self):
+		""" cached_get_cells: inner, then outer join of the same tables """
+		inner = cached_get_cells(self._join_tree(), None, False)
+		outer = cached_get_cells(self._join_tree(outer=True), None, False)
+		assert sorted(inner) == self.cells[:1], inner
+		assert sorted(outer) == sorted(self.cells), outer
+
+		# ... and back (from the cache)
+		assert cached_get_cells(self._join_tree(), None, False) == inner
+
+	def test_tree_shape(self):
+		""" cached_get_cells: keys of differently shaped join trees """
+		pix = self.a.pix
+		c = _TestTable(self.a.path + '-c', pix, [])
+
+		# a(b, c) vs. a(b(c))
+		root1, eb, ec = TableEntry(self.a, 'a'), TableEntry(self.b, 'b'), TableEntry(c, 'c')
+		eb.relation = JoinRelation(None, self.a, self.b)
+		ec.relation = JoinRelation(None, self.a, c)
+		root1.joins += [eb, ec]
+
+		root2, eb, ec = TableEntry(self.a, 'a'), TableEntry(self.b, 'b'), TableEntry(c, 'c')
+		eb.relation = JoinRelation(None, self.a, self.b)
+		ec.relation = JoinRelation(None, self.b, c)
+		root2.joins.append(eb)
+		eb.joins.append(ec)
+
+		assert root1.catalog_snapshots() != root2.catalog_snapshots()
 
 if __name__ == "__main__":
 	def test():
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from multiprocessing import Process, Queue, cpu_count, current_process
+from multiprocessing import Process, Queue, RawValue, cpu_count, current_process
 import threading
 from . import pyrpc
 from Queue import Empty
@@ -18,22 +18,422 @@ import platform
 import logging
 import signal
 import getpass
-from utils import unpack_callable
+import glob
+import copy
+import atexit
+import shutil
+import heapq
+import itertools
+import operator
+import hashlib
+import resource
+import numbers
+import json
+import bisect
+import exceptions
+from collections import deque
+from utils import unpack_callable, tempdirs
+from mr import serialization
+
+try:
+	import xxhash
+	_xxh128 = getattr(xxhash, 'xxh3_128', None) or getattr(xxhash, 'xxh128', None)
+except ImportError:
+	_xxh128 = None
 
 logger = logging.getLogger('lsd.pool2')
 
 RET_KEYVAL = 1
 RET_KEYVAL_LIST = 2
 
-BUFSIZE = 100 * 2**20 if platform.architecture()[0] == '32bit' else 1000 * 2**30
+# Maximum size of a segment of the intermediate result store (see SegmentedStore)
+SEGMENT_SIZE = 64 * 2**20 if platform.architecture()[0] == '32bit' else 2**30
 
-# OS X HFS+ filesystem does not support sparse files
-back_to_disk = platform.system() != 'Darwin'
+# Keep intermediate map_reduce_chain results on disk (see SegmentedStore)
+back_to_disk = True
 
 # allow diskless operation with LSD_DISKLESS environment variable
 if os.getenv("LSD_DISKLESS") == "1":
 	back_to_disk = False
 
+# Shuffle intermediate map_reduce_chain results through per-partition
+# spill files written directly by the workers (see map_reduce_chain).
+# Set LSD_PARTITIONED_SHUFFLE=0 to pass them through the parent instead.
+partitioned_shuffle = back_to_disk and os.getenv("LSD_PARTITIONED_SHUFFLE", "1") == "1"
+PARTITIONS_PER_WORKER = 4
+
+# Partitions with more (key, value) pairs than this are grouped by an
+# external sort, with sorted runs of this many pairs spilled to disk
+# (see _group_partition)
+SHUFFLE_SORT_BUFFER = int(os.getenv("LSD_SHUFFLE_SORT_BUFFER", 2*1000*1000))
+
+# Speculatively re-execute straggling tasks on idle workers (see
+# Pool.imap_unordered). Set LSD_SPECULATE=1 to enable. A task is a
+# straggler once it's been running for longer than SPECULATE_MIN_TIME
+# seconds, and SPECULATE_SLOWDOWN times longer than the median task
+# of its stage.
+SPECULATE = os.getenv("LSD_SPECULATE", "0") == "1"
+SPECULATE_MIN_TIME = float(os.getenv("LSD_SPECULATE_MIN_TIME", 10))
+SPECULATE_SLOWDOWN = 2.
+
+def _exception_types(names):
+	""" Return a tuple of exception classes given a comma-separated
+	    list of their names (either builtin, such as IOError, or
+	    fully qualified, such as tables.exceptions.HDF5ExtError)
+	"""
+	types = []
+	for name in names.split(','):
+		name = name.strip()
+		if '.' in name:
+			module, name = name.rsplit('.', 1)
+			types.append(getattr(__import__(module, fromlist=[name]), name))
+		elif name:
+			types.append(getattr(exceptions, name))
+	return tuple(types)
+
+# Retry tasks failing with one of RETRY_ON exceptions up to RETRIES
+# times (see Pool.imap_unordered), waiting RETRY_BACKOFF seconds before
+# the first retry, and doubling the wait for each subsequent one.
+RETRIES = int(os.getenv("LSD_RETRIES", 0))
+RETRY_ON = _exception_types(os.getenv("LSD_RETRY_ON", "EnvironmentError"))
+RETRY_BACKOFF = float(os.getenv("LSD_RETRY_BACKOFF", 1))
+
+# Arrays (and ColGroups) returned by workers that are larger than this are
+# passed back to the parent via shared memory, instead of being pickled
+# through the output queue. Set LSD_SHM_MIN_BYTES=-1 to disable.
+SHM_MIN_BYTES = int(os.getenv("LSD_SHM_MIN_BYTES", 2**20))
+
+def _shm_dir():
+	""" Return the directory where the shared memory segments are
+	    created (LSD_SHMDIR, /dev/shm, or the first of LSD_TEMPDIR, in that order).
+	"""
+	shmdir = os.getenv("LSD_SHMDIR")
+	if shmdir is None:
+		shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else tempdirs()[0]
+	return shmdir
+
+class _SharedArrays(object):
+	""" Descriptor of arrays written by a worker into a shared memory
+	    segment (a file in _shm_dir()). The parent maps the segment and
+	    unlinks it, wrapping the arrays around the mapped memory without
+	    copying them.
+	"""
+	fn = None	# The segment
+	layout = None	# A list of (name, dtype, shape, offset)
+	info = None	# ColGroup.info, or None if this is a plain ndarray
+
+	def __init__(self, fn, layout, info):
+		self.fn, self.layout, self.info = fn, layout, info
+
+	@staticmethod
+	def write(prefix, cols, info):
+		import numpy as np
+
+		fd, fn = tempfile.mkstemp(prefix=prefix, dir=_shm_dir())
+		layout = []
+		with os.fdopen(fd, 'wb') as f:
+			offs = 0
+			for name, col in cols:
+				# Keep the arrays 64-byte aligned
+				pad = -offs % 64
+				f.write('\0' * pad)
+				offs += pad
+
+				col = np.ascontiguousarray(col)
+				f.write(col.data)
+				layout.append((name, col.dtype, col.shape, offs))
+				offs += col.nbytes
+
+		return _SharedArrays(fn, layout, info)
+
+	def load(self):
+		import numpy as np
+		from colgroup import ColGroup
+
+		with open(self.fn, 'r+b') as f:
+			size = os.fstat(f.fileno()).st_size
+			mm = mmap.mmap(f.fileno(), size) if size else None
+		os.unlink(self.fn)
+
+		cols = []
+		for name, dtype, shape, offs in self.layout:
+			count = int(np.prod(shape))
+			if count:
+				col = np.frombuffer(mm, dtype=dtype, count=count, offset=offs).reshape(shape)
+			else:
+				col = np.empty(shape, dtype=dtype)
+			cols.append((name, col))
+
+		if self.info is None:
+			return cols[0][1]
+		return ColGroup(cols, info=self.info)
+
+def _export_result(result, prefix):
+	""" Replace large ndarrays and ColGroups in result (or in tuples
+	    thereof) with shared memory descriptors. Called by the workers.
+	"""
+	np = sys.modules.get('numpy')
+	if np is None or SHM_MIN_BYTES < 0:
+		return result
+	from colgroup import ColGroup
+
+	if type(result) is tuple:
+		return tuple(_export_result(v, prefix) for v in result)
+	elif type(result) is np.ndarray:
+		if not result.dtype.hasobject and result.nbytes >= SHM_MIN_BYTES:
+			return _SharedArrays.write(prefix, [(None, result)], None)
+	elif type(result) is ColGroup:
+		cols = result.items()
+		if cols and not any(col.dtype.hasobject for _, col in cols) and sum(col.nbytes for _, col in cols) >= SHM_MIN_BYTES:
+			return _SharedArrays.write(prefix, cols, result.info)
+
+	return result
+
+def _import_result(result):
+	""" Inverse of _export_result. Called by the parent. """
+	if type(result) is tuple:
+		return tuple(_import_result(v) for v in result)
+	elif type(result) is _SharedArrays:
+		return result.load()
+
+	return result
+
+def _discard_result(result):
+	""" Release the shared memory segments of an exported result
+	    that won't be imported. Called by the parent.
+	"""
+	if type(result) is tuple:
+		for v in result:
+			_discard_result(v)
+	elif type(result) is _SharedArrays:
+		os.unlink(result.fn)
+
+# Set LSD_TELEMETRY to a filename to have the telemetry of each stage
+# (a summary, and the per-task statistics) appended to it as a line of
+# JSON. The summaries of the last TELEMETRY_STAGES stages are also kept
+# in Pool.telemetry.
+TELEMETRY_FILE = os.getenv("LSD_TELEMETRY")
+TELEMETRY_STAGES = 100
+
+# ru_maxrss is in kilobytes on Linux, in bytes on OS X
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# Counters of the task currently being executed (see record())
+_task_counters = defaultdict(int)
+
+# Index (within the map) of the item currently being processed (see TaskMeter)
+_task_index = [None]
+
+# Set once the task currently being executed has modified a table (see record_write())
+_task_wrote = [False]
+
+# Undo journal of the checkpointed writer task being executed (see journal_write())
+_task_journal = [None]
+
+def record(**counters):
+	""" Add to the counters of the task currently being executed
+	    in this process, e.g. record(rows_in=len(rows)). The
+	    counters are reported to the parent with the rest of the
+	    task's telemetry (see TaskMeter).
+	"""
+	for name, value in counters.iteritems():
+		_task_counters[name] += value
+
+def record_write():
+	""" Note that the task currently being executed is about to
+	    modify a table. The Table methods writing into tablets call
+	    this; a failed task that has done so is never retried (see
+	    Pool.imap_unordered), as it may have left some of its rows
+	    behind.
+	"""
+	_task_wrote[0] = True
+
+def journal_write(fn):
+	""" Note that the file fn is about to be modified by the task
+	    currently being executed. If the task is being checkpointed
+	    (see Checkpoint), the original is saved to the task's undo
+	    journal first, so that its modifications can be rolled back
+	    if the task is interrupted before it completes. The Table
+	    methods opening tablets for writing call this.
+	"""
+	journal = _task_journal[0]
+	if journal is None:
+		return
+
+	entry = os.path.join(journal, hashlib.md5(fn).hexdigest())
+	if os.path.exists(entry):
+		return
+
+	# Copy the original (if any) before the entry is recorded, so that
+	# a recorded entry without a copy means the file didn't exist
+	if os.path.exists(fn):
+		shutil.copy2(fn, entry + '.orig')
+	with open(entry + '.tmp', 'w') as fp:
+		fp.write(fn)
+	os.rename(entry + '.tmp', entry)
+
+def _rollback_journal(journal):
+	# Undo the modifications recorded in the undo journal of an
+	# interrupted task (see journal_write()), and remove the journal
+	for entry in glob.glob(os.path.join(journal, '[0-9a-f]' * 32)):
+		fn = open(entry).read()
+		if os.path.exists(entry + '.orig'):
+			shutil.copy2(entry + '.orig', fn + '.rollback')
+			os.rename(fn + '.rollback', fn)
+		elif os.path.exists(fn):
+			os.unlink(fn)
+	shutil.rmtree(journal)
+
+def _bytes_read():
+	# Number of bytes read by this process so far (or None if unknown)
+	try:
+		with open('/proc/self/io') as f:
+			for line in f:
+				if line.startswith('rchar:'):
+					return int(line.split()[1])
+	except (IOError, ValueError):
+		pass
+	return None
+
+def _reset_peak_rss():
+	# Reset the peak RSS of this process to its current RSS (Linux
+	# only; see clear_refs in proc(5)). Returns True on success.
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+		return True
+	except IOError:
+		return False
+
+def _peak_rss():
+	# Peak RSS of this process since the last _reset_peak_rss(), in
+	# bytes (or None if unknown)
+	try:
+		with open('/proc/self/status') as f:
+			for line in f:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1]) * 1024
+	except (IOError, ValueError):
+		pass
+	return None
+
+def _task_label(item):
+	# A short, JSON-serializable label for a task (the key, for
+	# (key, ...) tuples such as the query's (cell_id, parts) tasks)
+	if type(item) in (tuple, list) and len(item):
+		item = item[0]
+	if isinstance(item, numbers.Integral):
+		return int(item)
+	if isinstance(item, (float, basestring)):
+		return item
+	label = repr(item)
+	return label if len(label) <= 80 else label[:77] + '...'
+
+class TaskMeter(object):
+	""" Measures the resources used by a single task: wall and CPU
+	    time, the number of results it yielded, bytes read, the peak
+	    RSS while it ran, and any counters set via record().
+
+	    The peak RSS of a task can only be measured where it can be
+	    reset at the start of the task (on Linux). Elsewhere, maxrss is
+	    None, and process_maxrss (the peak RSS over the lifetime of the
+	    process, which may have run many tasks) is only used for the
+	    stage-level maximum (see summarize_telemetry()).
+	"""
+	def __init__(self, item, index=None):
+		_task_counters.clear()
+		_task_index[0] = index
+		_task_wrote[0] = False
+		self.label = _task_label(item)
+		self.results = 0
+		self.rss_reset = _reset_peak_rss()
+		ru = resource.getrusage(resource.RUSAGE_SELF)
+		self.cpu0 = ru.ru_utime + ru.ru_stime
+		self.read0 = _bytes_read()
+		self.t0 = time.time()
+
+	def stats(self):
+		""" Return the statistics of the task, as a dict """
+		wall = time.time() - self.t0
+		ru = resource.getrusage(resource.RUSAGE_SELF)
+		read = _bytes_read()
+
+		stats = dict(_task_counters)
+		stats.update(
+			task       = self.label,
+			pid        = os.getpid(),
+			wall       = wall,
+			cpu        = ru.ru_utime + ru.ru_stime - self.cpu0,
+			results    = self.results,
+			bytes_read = read - self.read0 if read is not None and self.read0 is not None else None,
+			maxrss     = _peak_rss() if self.rss_reset else None
+		)
+		if stats['maxrss'] is None:
+			stats['process_maxrss'] = ru.ru_maxrss * _MAXRSS_UNIT
+		return stats
+
+_TELEMETRY_FIXED = frozenset(['task', 'pid', 'wall', 'cpu', 'results', 'bytes_read', 'maxrss', 'process_maxrss'])
+
+def summarize_telemetry(stage, tasks, nslowest=5):
+	""" Summarize the statistics of a stage's tasks (as returned by
+	    TaskMeter.stats()).
+
+	    Returns a dict with the totals, the skew (the ratio of the
+	    longest to the mean task wall time), the fraction of wall
+	    time spent on the CPU (the rest is mostly I/O), and the
+	    nslowest slowest tasks.
+	"""
+	summary = dict(stage=stage, ntasks=len(tasks))
+	if not tasks:
+		return summary
+
+	wall = sum(t['wall'] for t in tasks)
+	cpu  = sum(t['cpu'] for t in tasks)
+	wall_mean = wall / len(tasks)
+	wall_max = max(t['wall'] for t in tasks)
+	read = [ t['bytes_read'] for t in tasks if t['bytes_read'] is not None ]
+	rss  = [ t['maxrss'] if t['maxrss'] is not None else t['process_maxrss'] for t in tasks ]
+
+	summary.update(
+		wall         = wall,
+		cpu          = cpu,
+		wall_mean    = wall_mean,
+		wall_max     = wall_max,
+		skew         = wall_max / wall_mean if wall_mean else 1.,
+		cpu_fraction = min(cpu / wall, 1.) if wall else 1.,
+		results      = sum(t['results'] for t in tasks),
+		bytes_read   = sum(read) if read else None,
+		maxrss       = max(rss),
+		slowest      = [ dict(task=t['task'], wall=t['wall'], cpu=t['cpu']) for t in heapq.nlargest(nslowest, tasks, key=operator.itemgetter('wall')) ]
+	)
+
+	# Counters set by the kernels via record()
+	for t in tasks:
+		for name, value in t.iteritems():
+			if name not in _TELEMETRY_FIXED:
+				summary[name] = summary.get(name, 0) + value
+
+	return summary
+
+def format_telemetry(summary):
+	""" Format a telemetry summary as a one-line string """
+	if not summary['ntasks']:
+		return "%s: no tasks" % summary['stage']
+
+	s = "%s: %d tasks, %.2fs (mean %.2fs, max %.2fs, skew %.1fx), %d%% CPU / %d%% I/O" % (
+		summary['stage'], summary['ntasks'], summary['wall'],
+		summary['wall_mean'], summary['wall_max'], summary['skew'],
+		100 * summary['cpu_fraction'], 100 * (1 - summary['cpu_fraction']))
+	if 'rows_in' in summary:
+		s += ", %d rows in" % summary['rows_in']
+	if 'rows_out' in summary:
+		s += ", %d rows out" % summary['rows_out']
+	if summary['bytes_read'] is not None:
+		s += ", %.1f MB read" % (summary['bytes_read'] / 2.**20)
+	s += ", peak RSS %.1f MB" % (summary['maxrss'] / 2.**20)
+	s += "; slowest: " + ', '.join("%s (%.2fs)" % (t['task'], t['wall']) for t in summary['slowest'])
+	return s
+
 def _profiled_worker(*args, **kwargs):
 	import cProfile, time
 
@@ -47,14 +447,62 @@ def _profiled_worker(*args, **kwargs):
 		if time.time() - t0 > tmin:
 			profiler.dump_stats('%s/%s.%d.profile' % (os.getenv("PROFILE_DIR", "."), current_process().name, os.getpid()))
 
-def _worker(ident, qcmd, qbroadcast, qin, qout):
+class TaskCancelled(BaseException):
+	""" Raised in a worker when the parent cancels the task it's
+	    executing (a redundant copy of a speculatively re-executed
+	    task). Derived from BaseException, so that kernels catching
+	    Exception won't swallow it.
+	"""
+	pass
+
+def non_speculative(kernel):
+	""" Mark a kernel (a function) as one that must not be
+	    speculatively re-executed (see Pool.imap_unordered), e.g.
+	    because it writes into a table. Use as a decorator.
+	"""
+	kernel.speculative = False
+	return kernel
+
+def _is_marked(K_fun, K_args, attr, value):
+	# Return True if the kernel, or any kernel it wraps (e.g., the
+	# ones passed to combine(), Checkpoint.wrap() or Query's _mapper),
+	# has attribute attr set to value
+	if getattr(K_fun, attr, None) == value:
+		return True
+	for arg in K_args:
+		if callable(arg):
+			if getattr(arg, attr, None) == value:
+				return True
+		elif type(arg) is tuple and len(arg) and callable(arg[0]):
+			fun, args = unpack_callable(arg)
+			if _is_marked(fun, args, attr, value):
+				return True
+	return False
+
+def _is_speculative(K_fun, K_args):
+	# Return False if the kernel (or any kernel it wraps) has been
+	# marked with non_speculative
+	return not _is_marked(K_fun, K_args, 'speculative', False)
+
+def _worker(ident, qcmd, qbroadcast, qin, qout, cancel):
 	""" Waits for commands on qcmd. Possible commands are:
 		MAP: On MAP, store mapper and mapper_args, and
 		     begin listening on qin for a stream of
 		     items to be passed to mapper, until a
 		     message 'DONE' is encountered. Return the
 		     results yielded by mapper via qout.
+
+	    The parent cancels the task being executed by setting
+	    cancel.value to its index and sending SIGUSR1.
 	"""
+	current = [None]	# Index of the item being processed
+
+	def cancel_task(signum, frame):
+		if current[0] is not None and current[0] == cancel.value:
+			current[0] = None
+			raise TaskCancelled()
+	signal.signal(signal.SIGUSR1, cancel_task)
+	signal.siginterrupt(signal.SIGUSR1, False)	# Don't break the reads from the queues
 
 	def check_bqueue():
 		# Check if there's a command in the broadcast queue
@@ -71,25 +519,40 @@ def _worker(ident, qcmd, qbroadcast, qin, qout):
 	try:
 		for cmd, args in iter(qcmd.get, 'EXIT'):
 			if cmd == 'MAP':
-				mapper, mapper_args = cPickle.loads(args)
+				mapper, mapper_args, shm_prefix = cPickle.loads(args)
+				cancel.value = -1
 
 				check_bqueue()
 
 				i, item, result = None, None, None
 				for (i, item) in iter(qin.get, 'DONE'):
-					# Process an item
+					# Process an item. It may be cancelled only while
+					# in the mapper, never while talking to the parent.
 					try:
+						qout.put((ident, 'START', i))
+						meter = TaskMeter(item, i)
+						current[0] = i
+						if cancel.value == i:
+							raise TaskCancelled()
 						for result in mapper(item, *mapper_args):
-							qout.put((ident, 'RESULT', (i, result)))
-						qout.put((ident, 'DONE', i))
+							current[0] = None
+							qout.put((ident, 'RESULT', (i, _export_result(result, shm_prefix))))
+							meter.results += 1
+							current[0] = i
+						current[0] = None
+						qout.put((ident, 'DONE', (i, meter.stats())))
+					except TaskCancelled:
+						current[0] = None
+						qout.put((ident, 'CANCELLED', i))
 					except KeyboardInterrupt:
 						# Handle Ctrl-C by just exiting and not spewing output to stderr
 						raise
 					except:
+						current[0] = None
 						type, value, tb = sys.exc_info()
 						tb_str = traceback.format_tb(tb)
 						del tb    # See docs for sys.exec_info() for why this has to be here
-						qout.put((ident, 'EXCEPT', (type, value, tb_str)))
+						qout.put((ident, 'EXCEPT', (i, type, value, tb_str, _task_wrote[0])))
 
 					check_bqueue()
 
@@ -107,40 +570,299 @@ def _worker(ident, qcmd, qbroadcast, qin, qout):
 		for q in [qcmd, qbroadcast, qin, qout]:
 			q.cancel_join_thread()
 
-def _unserializer(file, offsets):
-	# Helper for _reduce_from_pickle_jar -- takes a filename and
-	# a list of offsets, and returns a generator unpickling objects
-	# at given offsets
-	with open(file) as f:
-		mm = mmap.mmap(f.fileno(), 0, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ)
+class SegmentedStore(object):
+	""" Append-only store for serialized intermediate results.
 
-		for offs in offsets:
-			##print "Seek to ", offs
-			mm.seek(offs)
-			yield cPickle.load(mm)
+	    The data is kept in a series of segment files of up to
+	    SEGMENT_SIZE bytes, created as needed and spread round-robin
+	    over the tempdirs(). Values are addressed by (segment, offset)
+	    pairs. The segments grow by appending, and are never
+	    preallocated, so no sparse file support is needed, and no
+	    more space is used than there is data.
+	"""
+	def __init__(self, prefix='mapresults-', segsize=SEGMENT_SIZE):
+		self.prefix = prefix
+		self.segsize = segsize
+		self.dirs = tempdirs()
+		self.files = []		# Segment filenames
+		self.fp = None		# The segment being written to
+
+	def write(self, s):
+		""" Append string s, returning its (segment, offset) """
+		if self.fp is None or (self.fp.tell() != 0 and self.fp.tell() + len(s) > self.segsize):
+			self._new_segment()
+
+		offs = self.fp.tell()
+		self.fp.write(s)
+		return (len(self.files) - 1, offs)
+
+	def _new_segment(self):
+		if self.fp is not None:
+			self.fp.close()
+
+		dir = self.dirs[len(self.files) % len(self.dirs)]
+		fd, fn = tempfile.mkstemp(prefix=self.prefix, suffix='.pkl', dir=dir)
+		self.files.append(fn)
+		self.fp = os.fdopen(fd, 'wb')
+
+	def flush(self):
+		""" Flush the written data, to make it readable by others """
+		if self.fp is not None:
+			self.fp.flush()
 
-		mm.close()
+	def close(self):
+		""" Close and remove all segments """
+		if self.fp is not None:
+			self.fp.close()
+			self.fp = None
 
-def _reduce_from_pickle_jar(kw, file, reducer, reducer_args):
+		for fn in self.files:
+			try:
+				os.unlink(fn)
+			except OSError:
+				pass
+		self.files = []
+
+def _reduce_from_pickle_jar(kw, files, reducer, reducer_args):
 	# open the pickle jar, load the objects, pass them on to the
 	# actual reducer
-	key, offsets = kw
-	for result in reducer((key, _unserializer(file, offsets)), *reducer_args):
+	key, locs = kw
+	values = _unserialize_values(( (files[seg], offs) for (seg, offs) in locs ), {})
+	for result in reducer((key, values), *reducer_args):
 		yield result
 
-def _output_pickled_kv(item, K_fun, K_args):
-	# return a pickled value, deduplicating if possible
+def dedup_values(kernel):
+	""" Mark a kernel (a function) as one whose output values
+	    should be deduplicated by content in map_reduce_chain.
+
+	    Identical values yielded by the kernel will then be stored
+	    (and passed on to the next stage) only once. This is worth
+	    it for kernels that yield many copies of the same value;
+	    for others, it's a waste of time spent hashing the outputs.
+	    Use as a decorator.
+	"""
+	kernel.dedup_values = True
+	return kernel
+
+def _wants_dedup(K_fun, K_args):
+	# Return True if the kernel (or any kernel it wraps) has been
+	# marked with dedup_values
+	return _is_marked(K_fun, K_args, 'dedup_values', True)
+
+def _output_pickled_kv(item, K_fun, K_args, dedup=False):
+	# return a serialized value, deduplicating if requested. Values
+	# already sent by this task are returned as (hash, None).
 	unique_objects = set()
 
 	for (k, v) in K_fun(item, *K_args):
-		p = cPickle.dumps(v, -1)
-
-		hash = digest(p)
-		if hash in unique_objects:
-			p = None
+		p = serialization.dumps(v)
+
+		if dedup:
+			hash = fast_digest(p)
+			if hash in unique_objects:
+				p = None
+			else:
+				unique_objects.add(hash)
+		else:
+			hash = None
 
 		yield (k, (hash, p))
 
+def _combining_kernel(item, kernel, combiner):
+	# Run the kernel, group its outputs by key, and pass them
+	# through the combiner before returning them (see combine())
+	K_fun, K_args = unpack_callable(kernel)
+	C_fun, C_args = unpack_callable(combiner)
+
+	groups = defaultdict(list)
+	for (k, v) in K_fun(item, *K_args):
+		groups[k].append(v)
+
+	for kv in groups.iteritems():
+		for result in C_fun(kv, *C_args):
+			yield result
+
+def combine(kernel, combiner):
+	""" Attach a combiner to a map_reduce_chain kernel.
+
+	    Returns a kernel that runs <kernel>, and passes the
+	    (key, value) pairs it yields for each input item through
+	    <combiner>, on the worker, before they're sent on to the next
+	    stage. The combiner is called like a reducer, as
+	    combiner((key, values), *args), and must yield (key, value)
+	    pairs. Use it to pre-reduce the outputs of aggregating kernels
+	    (e.g., sums or histograms), where it can greatly cut down the
+	    volume of data passed between the stages.
+
+	    Both kernel and combiner may be a callable, or a
+	    (callable, arg2, arg3, ...) tuple. Example:
+
+	        query.execute([combine((mapper, bins), sum_values), sum_values])
+	"""
+	return (_combining_kernel, kernel, combiner)
+
+def sum_values(kv):
+	""" A combiner (or reducer) summing up the values (numbers or
+	    numpy arrays) associated with a key. """
+	key, values = kv
+	values = iter(values)
+	total = copy.copy(next(values))
+	for v in values:
+		total += v
+	yield (key, total)
+
+def _output_partitioned_kv(item, K_fun, K_args, partdirs, dedup=False):
+	# Run the kernel, and write the (key, value) pairs it yields into
+	# the partition directories, assigned by hash of the key. Each
+	# process appends the serialized values to its own values.<pid> file
+	# in the partition directory. Once the kernel finishes, the
+	# (key, offset) pairs are written to a partial index, and renamed to
+	# index.<i>, where i is the index of the item in the map. Only these
+	# are read by _iter_partition_index, so the pairs of cancelled or
+	# failed executions of a task are ignored, and those of repeated
+	# (speculative or retried) ones replace each other. If dedup is
+	# set, identical values within a partition are stored only once.
+	# Nothing is returned to the parent.
+	pid, task = os.getpid(), _task_index[0]
+	assert task is not None
+	partial = 'partial-index.%d.%d' % (task, pid)
+	nparts = len(partdirs)
+	parts = {}	# part -> (values file, [(key, offset), ...], hash->offset map)
+	try:
+		for (k, v) in K_fun(item, *K_args):
+			part = hash(k) % nparts
+			try:
+				fp, index, unique_objects = parts[part]
+			except KeyError:
+				fp = open(os.path.join(partdirs[part], 'values.%d' % pid), 'ab')
+				fp.seek(0, os.SEEK_END)
+				fp, index, unique_objects = parts[part] = (fp, [], {})
+
+			p = serialization.dumps(v)
+			if dedup:
+				hash_ = fast_digest(p)
+				try:
+					offs = unique_objects[hash_]
+				except KeyError:
+					offs = unique_objects[hash_] = fp.tell()
+					fp.write(p)
+			else:
+				offs = fp.tell()
+				fp.write(p)
+
+			index.append((k, offs))
+
+		for part, (fp, index, _) in parts.iteritems():
+			fp.close()
+			with open(os.path.join(partdirs[part], partial), 'wb') as f:
+				cPickle.dump(('values.%d' % pid, index), f, -1)
+
+		# Commit
+		for part in parts:
+			os.rename(os.path.join(partdirs[part], partial), os.path.join(partdirs[part], 'index.%d' % task))
+	finally:
+		for part, (fp, _, _) in parts.iteritems():
+			fp.close()
+			if os.path.exists(os.path.join(partdirs[part], partial)):
+				os.unlink(os.path.join(partdirs[part], partial))
+
+	return
+	yield	# This is a generator
+
+def _unserialize_values(locs, mmaps):
+	# Helper for _reduce_from_partition and _reduce_from_pickle_jar --
+	# takes a list of (filename, offset) tuples, and returns a generator
+	# unserializing objects found there. mmaps is a cache of open
+	# files. They're mapped copy-on-write, so that the arrays can be
+	# loaded without copying; each is unmapped once all values loaded
+	# from it have been garbage collected.
+	for fn, offs in locs:
+		try:
+			mm = mmaps[fn]
+		except KeyError:
+			with open(fn) as f:
+				mm = mmaps[fn] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+		mm.seek(offs)
+		yield serialization.load(mm)
+
+def _iter_partition_index(partdir):
+	# Yield (key, (values_file, offset)) for all pairs written to a
+	# partition by _output_partitioned_kv
+	for fn in glob.glob(os.path.join(partdir, 'index.*')):
+		with open(fn, 'rb') as f:
+			values, index = cPickle.load(f)
+		values = os.path.join(partdir, values)
+		for (k, offs) in index:
+			yield (k, (values, offs))
+
+def _write_run(entries, dir):
+	# Sort the entries and store them to a temporary file, in chunks
+	entries.sort()
+	fp = tempfile.TemporaryFile(prefix='run-', dir=dir)
+	for i in xrange(0, len(entries), 10000):
+		cPickle.dump(entries[i:i+10000], fp, -1)
+	fp.seek(0)
+	return fp
+
+def _read_run(fp):
+	# Yield the entries stored by _write_run
+	while True:
+		try:
+			chunk = cPickle.load(fp)
+		except EOFError:
+			return
+		for entry in chunk:
+			yield entry
+
+def _group_partition(partdir):
+	""" Yield (key, locs) for each key found in a partition, where
+	    locs is an iterable of (values_file, offset) of its values.
+
+	    The keys are grouped in memory, unless there are more than
+	    SHUFFLE_SORT_BUFFER entries in the partition. In that case the
+	    entries are sorted in runs of SHUFFLE_SORT_BUFFER, stored to
+	    disk, and merged, so the memory use doesn't depend on the
+	    number of keys.
+	"""
+	entries, runs = [], []
+	try:
+		for entry in _iter_partition_index(partdir):
+			entries.append(entry)
+			if len(entries) >= SHUFFLE_SORT_BUFFER:
+				runs.append(_write_run(entries, partdir))
+				entries = []
+
+		if not runs:
+			groups = defaultdict(list)
+			for (k, loc) in entries:
+				groups[k].append(loc)
+			del entries[:]
+
+			for kv in groups.iteritems():
+				yield kv
+		else:
+			if entries:
+				runs.append(_write_run(entries, partdir))
+				entries = []
+
+			merged = heapq.merge(*[ _read_run(fp) for fp in runs ])
+			for key, group in itertools.groupby(merged, key=operator.itemgetter(0)):
+				yield key, ( loc for (_, loc) in group )
+	finally:
+		for fp in runs:
+			fp.close()
+
+def _reduce_from_partition(partdir, reducer, reducer_args):
+	# Group the (key, offset) pairs written to a partition by
+	# _output_partitioned_kv, and pass each key with its values on
+	# to the actual reducer
+	# Note: the mmaps are not explicitly closed, as the values loaded
+	# from them may still be in use
+	mmaps = {}
+	for key, locs in _group_partition(partdir):
+		for result in reducer((key, _unserialize_values(locs, mmaps)), *reducer_args):
+			yield result
+
 def _reduce_from_pickled(kw, pkl, reducer, args):
 	# open the piclke jar, load the objects, pass them on to the
 	# actual reducer
@@ -230,10 +952,17 @@ class Pool:
 	qin = None
 	qbroadcast = None
 	qout = None
+	cancel = None
 	ps = []
 	min_tasks_for_parallel = 3
 	DEBUG = None	# Filled in in __init__ from getenv
+	speculative = None	# Filled in in __init__ from SPECULATE
+	retries = None		# Filled in in __init__ from RETRIES
+	retry_on = None		# Filled in in __init__ from RETRY_ON
+	retry_backoff = None	# Filled in in __init__ from RETRY_BACKOFF
 	nworkers = None	# Filled in in __init__ from getenv or cpu_count()
+	active = 0	# Number of maps currently dispatched to the workers
+	_pid = None	# PID of the process owning the workers
 
 	def __del__(self):
 		self.close()
@@ -242,6 +971,11 @@ class Pool:
 		if len(self.ps) == 0:
 			return
 
+		# Only the process that created the workers may shut them down
+		# (not, e.g., a forked child that inherited this object)
+		if os.getpid() != self._pid:
+			return
+
 		for q in self.qcmd:
 			q.put('EXIT')
 
@@ -280,6 +1014,13 @@ class Pool:
 		# Release the queues and worker objects
 		del self.ps[:]
 
+		# Remove any shared memory segments the parent never picked up
+		for fn in glob.glob(os.path.join(_shm_dir(), self._shm_prefix + '*')):
+			try:
+				os.unlink(fn)
+			except OSError:
+				pass
+
 		# Close all queues
 		for qq in [ self.qcmd, self.qin, self.qbroadcast, self.qout ]:
 			if qq is None:
@@ -290,6 +1031,17 @@ class Pool:
 			for q in qq:
 				q.close()
 		self.qcmd = self.qin = self.qbroadcast = self.qout = None
+		self.cancel = None
+
+	def _cancel_copies(self, running, i, keep=None):
+		# Cancel the tasks processing item i, except on worker keep
+		for ident, (j, _) in running.iteritems():
+			if j == i and ident != keep:
+				self.cancel[ident].value = i
+				try:
+					os.kill(self.ps[ident].pid, signal.SIGUSR1)
+				except OSError:
+					pass
 
 	def _create_workers(self):
 		""" Lazily create workers, when needed. This routine
@@ -303,9 +1055,10 @@ class Pool:
 		self.qbroadcast = Queue()
 		self.qout = Queue(self.nworkers*2)
 		self.qcmd = [ Queue() for _ in xrange(self.nworkers) ]
+		self.cancel = [ RawValue('l', -1) for _ in xrange(self.nworkers) ]
 		
 		target = _worker if not os.getenv("PROFILE", 0) else _profiled_worker
-		self.ps = [ Process(target=target, name="%s{%02d}" % (current_process().name, i), args=(i, self.qcmd[i], self.qbroadcast, self.qin, self.qout)) for i in xrange(self.nworkers) ]
+		self.ps = [ Process(target=target, name="%s{%02d}" % (current_process().name, i), args=(i, self.qcmd[i], self.qbroadcast, self.qin, self.qout, self.cancel[i])) for i in xrange(self.nworkers) ]
 
 		for p in self.ps:
 			p.daemon = True
@@ -319,14 +1072,57 @@ class Pool:
 			self.nworkers = nworkers
 
 		self._ntarget = self.nworkers
-
-	def imap_unordered(self, input, mapper, mapper_args=(), progress_callback=None, progress_callback_stage='map'):
+		self.speculative = SPECULATE
+		self.retries, self.retry_on, self.retry_backoff = RETRIES, RETRY_ON, RETRY_BACKOFF
+		self._pid = os.getpid()
+		self._shm_prefix = 'lsd-shm.%d.%d.' % (self._pid, id(self))
+		self.telemetry = deque(maxlen=TELEMETRY_STAGES)
+
+	def _report_telemetry(self, stage, tasks):
+		# Summarize the telemetry of a finished stage, log it, and
+		# append it to TELEMETRY_FILE (if set)
+		summary = summarize_telemetry(stage, tasks)
+		self.telemetry.append(summary)
+		logger.info(format_telemetry(summary))
+
+		if TELEMETRY_FILE:
+			with open(TELEMETRY_FILE, 'a') as fp:
+				tasks = [ dict((k, v) for (k, v) in t.iteritems() if k != 'process_maxrss') for t in tasks ]
+				fp.write(json.dumps(dict(summary=summary, tasks=tasks), default=repr) + '\n')
+
+	def imap_unordered(self, input, mapper, mapper_args=(), progress_callback=None, progress_callback_stage='map', speculative=None):
 		""" Execute in parallel a callable <mapper> on all values of
 		    iterable <input>, ensuring that no more than ~nworkers
-		    results are pending in the output queue """
+		    results are pending in the output queue.
+
+		    The statistics of each finished item (see TaskMeter) are
+		    passed to progress_callback as the result of its 'step'
+		    call; a summary of the stage is appended to
+		    self.telemetry once all items have been processed.
+
+		    If speculative is True (default: self.speculative), once
+		    all items have been dispatched, workers that go idle are
+		    given copies of straggling items that haven't returned any
+		    results yet (see SPECULATE_MIN_TIME). The results of the
+		    copy that returns first are kept, and the other copy is
+		    cancelled. Mappers marked with non_speculative (e.g.,
+		    those writing into tables) are never re-executed.
+
+		    If self.retries is nonzero, items failing with one of
+		    self.retry_on exceptions before returning any results,
+		    and before modifying any table (see record_write()), are
+		    retried (up to self.retries times, with exponential
+		    backoff). Items that still fail don't abort the map: the
+		    remaining items are processed (and their results
+		    yielded) first, and the first failure is re-raised at
+		    the end. Failures of items that have modified a table
+		    abort the map right away.
+		"""
 		if progress_callback == None:
 			progress_callback = progress_default;
 
+		tasks = []	# Telemetry of the processed items
+
 		progress_callback(progress_callback_stage, 'begin', input, None, None)
 
 		# Try to optimize and not dispatch to workers if there are less
@@ -338,8 +1134,13 @@ class Pool:
 
 		parallel = parallel and self.nworkers > 1 and not self.DEBUG
 
+		if speculative is None:
+			speculative = self.speculative
+		speculative = speculative and _is_speculative(mapper, mapper_args)
+
 		# Dispatch/execute
 		if parallel:
+			self.active += 1
 			try:
 				# Connection to lsd-manager, with fallback if it fails
 				class Defaults(object):
@@ -367,51 +1168,138 @@ class Pool:
 					self.qbroadcast.put( ('STOP', None) )
 
 				# Initialize this map
-				map_args = cPickle.dumps((mapper, mapper_args), -1)
+				map_args = cPickle.dumps((mapper, mapper_args, self._shm_prefix), -1)
 				for q in self.qcmd:
 					q.put( ('MAP', map_args) )
 
-				# Queue the data to operate on
+				# Queue the data to operate on (keeping it around
+				# for re-execution, if speculating or retrying)
+				reexecute = speculative or self.retries > 0
+				items = []
 				i = -1
 				for (i, item) in enumerate(input):
 					self.qin.put( (i, item) )
+					if reexecute:
+						items.append(item)
 				n = i + 1
 
-				# Queue the end-of-map markers
-				for _ in xrange(self.nworkers):
-					self.qin.put('DONE')
-
+				# Queue the end-of-map markers. If items may be
+				# re-executed, this is postponed until all of them have
+				# been processed, so that idle workers keep listening.
+				def queue_markers():
+					for _ in xrange(self.nworkers):
+						self.qin.put('DONE')
+				if not reexecute or n == 0:
+					queue_markers()
 
 				# yield the outputs
 				k = 0	# Number of items that have been processed
 				wf = 0	# Number of workers that have finished
-				while wf != self.nworkers or k != n or nstopping != 0:
-					(ident, what, data) = self.qout.get()
+				nstarted  = 0		# Number of items (including copies) taken up by workers
+				nqueued   = n		# Number of items (including copies) queued
+				running   = {}		# ident -> (i, start time) of the item being processed
+				done      = set()	# Indices of processed items
+				owner     = {}		# i -> ident of the worker whose results for i are kept
+				copied    = set()	# Indices of items that have been re-executed
+				walls     = []		# Sorted wall times of processed items
+				attempts  = defaultdict(int)	# i -> number of failed attempts
+				retry_due = []		# Heap of (time, i) of items to retry
+				failed    = []		# Exceptions of items that failed for good
+				while wf != self.nworkers or k + len(failed) != n or nstopping != 0:
+					try:
+						(ident, what, data) = self.qout.get(timeout=0.1 if retry_due else (1 if speculative else None))
+					except Empty:
+						what = None
+
 					if what == 'RESULT':
 						i, result = data
-						yield result
+						if i in done or owner.setdefault(i, ident) != ident:
+							# A result from a redundant copy
+							_discard_result(result)
+							self._cancel_copies(running, i, owner.get(i))
+						else:
+							self._cancel_copies(running, i, ident)
+							yield _import_result(result)
+					elif what == 'START':
+						running[ident] = (data, time.time())
+						nstarted += 1
+						if data in done:
+							self._cancel_copies(running, data)
+					elif what == 'CANCELLED':
+						del running[ident]
 					elif what == 'MAPDONE':
 						wf += 1
 					elif what == 'DONE':
-						k += 1
-						progress_callback(progress_callback_stage, 'step', input, k, None)
+						i, stats = data
+						del running[ident]
+						if i not in done and owner.get(i, ident) == ident:
+							done.add(i)
+							self._cancel_copies(running, i)
+							tasks.append(stats)
+							bisect.insort(walls, stats['wall'])
+							k += 1
+							progress_callback(progress_callback_stage, 'step', input, k, stats)
+							if reexecute and k + len(failed) == n:
+								queue_markers()
 					elif what == 'STOPPED':
 						assert ident not in stopped
 						stopped.add(ident)
 						nstopping -= 1
 						nrunning -= 1
 					elif what == 'EXCEPT':
-						# Unhandled Exception was raised in one of the workers.
-						# The workers will be terminated by the except clause at the end
-						type, value, tb_str = data
-						print >> sys.stderr, 'Remote Traceback (most recent call last):\n', ''.join(tb_str),
-						print >> sys.stderr, ''.join(traceback.format_exception_only(type, value))
-						raise value
+						i, type, value, tb_str, wrote = data
+						del running[ident]
+						retry = self.retries and issubclass(type, self.retry_on) and not wrote
+						if i in done or (owner.get(i) != ident and i in (j for j, _ in running.itervalues())):
+							# A redundant copy failed; the item was (or
+							# may still be) processed by another one
+							logger.info("Ignoring a failure of a redundant copy of item %d: %s" % (i, ''.join(traceback.format_exception_only(type, value)).strip()))
+						elif retry and i not in owner and attempts[i] < self.retries:
+							# Retry later
+							attempts[i] += 1
+							delay = self.retry_backoff * 2**(attempts[i] - 1)
+							print >> sys.stderr, 'Item %d failed (%s), retry %d of %d in %.1f sec.' % (i, ''.join(traceback.format_exception_only(type, value)).strip(), attempts[i], self.retries, delay)
+							heapq.heappush(retry_due, (time.time() + delay, i))
+						elif retry:
+							# Give up on this item, but let the others finish
+							print >> sys.stderr, 'Remote Traceback (most recent call last):\n', ''.join(tb_str),
+							print >> sys.stderr, ''.join(traceback.format_exception_only(type, value))
+							done.add(i)
+							self._cancel_copies(running, i)
+							failed.append(value)
+							if k + len(failed) == n:
+								queue_markers()
+						else:
+							# Unhandled Exception was raised in one of the workers.
+							# The workers will be terminated by the except clause at the end
+							print >> sys.stderr, 'Remote Traceback (most recent call last):\n', ''.join(tb_str),
+							print >> sys.stderr, ''.join(traceback.format_exception_only(type, value))
+							raise value
+
+					# Queue the items due for a retry
+					while retry_due and retry_due[0][0] <= time.time():
+						_, i = heapq.heappop(retry_due)
+						self.qin.put( (i, items[i]) )
+						nqueued += 1
+
+					#
+					# Re-execute stragglers on idle workers
+					#
+					if speculative and k + len(failed) != n and nstarted == nqueued:
+						nidle = nrunning - nstopping - len(running)
+						if nidle > 0:
+							now = time.time()
+							tmin = max(SPECULATE_MIN_TIME, SPECULATE_SLOWDOWN * walls[len(walls) // 2]) if walls else SPECULATE_MIN_TIME
+							stragglers = [ (t0, i) for (i, t0) in running.itervalues() if i not in owner and i not in copied and now - t0 > tmin ]
+							for (_, i) in sorted(stragglers)[:nidle]:
+								copied.add(i)
+								self.qin.put( (i, items[i]) )
+								nqueued += 1
 
 					#
 					# Adjust the number of active workers
 					#
-					if k != n:
+					if k + len(failed) != n:
 						ntarget = min(_mgr.nworkers(), self.nworkers)
 					else:
 						# If all items have been exhausted, unstop all workers so they can
@@ -438,7 +1326,7 @@ class Pool:
 						nrunning += 1
 
 				assert wf == self.nworkers	# All workers must have finished
-				assert k == n			# All items must have been processed
+				assert k + len(failed) == n	# All items must have been processed
 				assert nstopping == 0		# No outstanding STOP orders
 
 			except BaseException as e:
@@ -452,13 +1340,24 @@ class Pool:
 				# Make sure the connection to manager is closed (e.g., if an
 				# exception is thrown)
 				_mgr._close()
+				self.active -= 1
+
+			if failed:
+				# The workers are left running, as they've all finished
+				print >> sys.stderr, '%d of %d items failed.' % (len(failed), n)
+				raise failed[0]
 		else:
 			# Execute in-thread, without external workers
 			for (i, item) in enumerate(input):
+				meter = TaskMeter(item, i)
 				for result in mapper(item, *mapper_args):
+					meter.results += 1
 					yield result
-				progress_callback(progress_callback_stage, 'step', input, i, None)
+				stats = meter.stats()
+				tasks.append(stats)
+				progress_callback(progress_callback_stage, 'step', input, i, stats)
 
+		self._report_telemetry(progress_callback_stage, tasks)
 		progress_callback(progress_callback_stage, 'end', input, None, None)
 
 	def imap_reduce(self, input, mapper, reducer, mapper_args=(), reducer_args=(), progress_callback=None):
@@ -549,19 +1448,32 @@ class Pool:
 		    	- mapper must return a dictionary of (key, value) pairs
 		    	- reducer must expect a (key, value) pair as the first
 		    	  argument, where the value will be an iterable
+		    	- to pre-reduce a kernel's output on the workers, wrap
+		    	  it with combine()
+
+		    If partitioned_shuffle is set (the default, unless
+		    running diskless), the intermediate (key, value) pairs
+		    never pass through this process: the workers write them
+		    directly into partitioned spill files, and each task of
+		    the following stage reduces all keys of one partition.
 		"""
 
+		if partitioned_shuffle and len(kernels) > 1:
+			for result in self._map_reduce_chain_partitioned(input, kernels, progress_callback):
+				yield result
+			return
+
 		if progress_callback == None:
 			progress_callback = progress_default
 
 		progress_callback('mapreduce', 'begin', input, None, None)
 
 		if back_to_disk:
-			fp, prev_fp = None, None
-			mm, prev_mm = None, None
+			store, prev_store = None, None
 
 		for i, K in enumerate(kernels):
 			K_fun, K_args = unpack_callable(K)
+			dedup = _wants_dedup(K_fun, K_args)
 			last_step = (i + 1 == len(kernels))
 			stage = where(i == 0, 'map', 'reduce')
 
@@ -572,17 +1484,14 @@ class Pool:
 				# Insert picklers/unpicklers
 				if i != 0:
 					# Insert unpickler
-					K_fun, K_args = _reduce_from_pickle_jar, (prev_fp.name, K_fun, K_args)
+					K_fun, K_args = _reduce_from_pickle_jar, (prev_store.files, K_fun, K_args)
 
 				if not last_step:
 					# Insert pickler
-					K_fun, K_args = _output_pickled_kv, (K_fun, K_args)
+					K_fun, K_args = _output_pickled_kv, (K_fun, K_args, dedup)
 
 					# Create a disk backing store for intermediate results
-					fp = tempfile.NamedTemporaryFile(mode='wb', prefix='mapresults-', dir=os.getenv('LSD_TEMPDIR'), suffix='.pkl', delete=True)
-					fd = fp.file.fileno()
-					os.ftruncate(fd, BUFSIZE)
-					mm = mmap.mmap(fd, 0)
+					store = SegmentedStore()
 
 			try:
 				# Call the distributed mappers
@@ -596,59 +1505,292 @@ class Pool:
 
 						if back_to_disk:
 							(hash, v) = v
-							if hash in unique_objects:
+							if hash is not None and hash in unique_objects:
 								v = unique_objects[hash]
 							else:
-								# The output value has already been pickled (but not the key). Store the
-								# pickled value into the pickle jar, and keep the (key, offset) tuple.
-								offs = mm.tell()
-								mm.write(v)
-								assert len(v) == mm.tell() - offs
-								v = offs
-								unique_objects[hash] = offs
+								# The output value has already been serialized (but not the key). Store
+								# it into the pickle jar, and keep the (key, (segment, offset)) tuple.
+								v = store.write(v)
+								if hash is not None:
+									unique_objects[hash] = v
 
 						# Prepare for next reduction
 						mresult[k].append(v)
 
 				input = mresult.items()
 			except:
-				# In case of an exception, delete the temporary file so the kernel
-				# won't attempt to flush them to the disk
-				if back_to_disk:
-					if mm is not None:
-						mm.resize(1)
-						mm.close()
-						mm = None
-
-					if fp is not None:
-						os.ftruncate(fp.file.fileno(), 0)
-						fp.close()
-						fp = None
+				# In case of an exception, delete the intermediate results
+				if back_to_disk and store is not None:
+					store.close()
+					store = None
 				raise
 			finally:
 				if back_to_disk:
-					# Close/clear the intermediate result backing store from the previous step
-					# ensuring it's truncated first so it doesn't hit the disk if it hasn't
-					# already.
-					if prev_fp is not None:
-						prev_mm.resize(1)
-						prev_mm.close()
-						os.ftruncate(prev_fp.file.fileno(), 0)
-						prev_fp.close()
-
-					if fp is not None:
-						prev_fp, prev_mm = fp, mm
-						fp, mm = None, None
+					# Remove the intermediate results of the previous step
+					if prev_store is not None:
+						prev_store.close()
+						prev_store = None
+
+					if store is not None:
+						store.flush()
+						prev_store, store = store, None
 
 		if progress_callback != None:
 			progress_callback('mapreduce', 'end', None, None, None)
 
+	def _map_reduce_chain_partitioned(self, input, kernels, progress_callback=None):
+		""" map_reduce_chain, with the intermediate results shuffled
+		    through partitioned spill files (see _output_partitioned_kv
+		    and _reduce_from_partition).
+		"""
+		if progress_callback == None:
+			progress_callback = progress_default
+
+		progress_callback('mapreduce', 'begin', input, None, None)
+
+		nparts = self.nworkers * PARTITIONS_PER_WORKER
+		spilldirs, prev_spilldirs = [], []
+		try:
+			for i, K in enumerate(kernels):
+				K_fun, K_args = unpack_callable(K)
+				dedup = _wants_dedup(K_fun, K_args)
+				last_step = (i + 1 == len(kernels))
+				stage = where(i == 0, 'map', 'reduce')
+
+				if i != 0:
+					# Read from the partitions of the previous stage
+					K_fun, K_args = _reduce_from_partition, (K_fun, K_args)
+
+				if not last_step:
+					# Write into a fresh set of partitions, spread over
+					# all temporary directories
+					for dir in tempdirs():
+						spilldirs.append(tempfile.mkdtemp(prefix='mapresults-', dir=dir))
+					partdirs = [ os.path.join(spilldirs[part % len(spilldirs)], str(part)) for part in xrange(nparts) ]
+					for partdir in partdirs:
+						os.mkdir(partdir)
+					K_fun, K_args = _output_partitioned_kv, (K_fun, K_args, partdirs, dedup)
+
+				for r in self.imap_unordered(input, K_fun, K_args, progress_callback=progress_callback, progress_callback_stage=stage):
+					assert last_step
+					yield r
+
+				# Clear the partitions of the previous stage
+				for d in prev_spilldirs:
+					shutil.rmtree(d, ignore_errors=True)
+				prev_spilldirs, spilldirs = spilldirs, []
+
+				input = partdirs if not last_step else None
+		finally:
+			for d in spilldirs + prev_spilldirs:
+				shutil.rmtree(d, ignore_errors=True)
+
+		progress_callback('mapreduce', 'end', None, None, None)
+
+def _checkpointed_kernel(item, kernel, path, stage):
+	# Run the kernel on item, recording the results in checkpoint
+	# directory path. If they've been recorded already (by a previous,
+	# interrupted, run), replay them instead. Results are written to
+	# a temporary file, renamed once the kernel finishes, so that only
+	# the results of completed tasks are ever replayed.
+	#
+	# Kernels writing into tables (those marked non_speculative) keep
+	# an undo journal of the tablets they modify (see journal_write()),
+	# removed once the results are recorded. If a journal is found, the
+	# task was interrupted, and its modifications are rolled back
+	# before it's rerun.
+	fn = os.path.join(path, Checkpoint._task_name(item, stage))
+	journal = fn + '.journal'
+	try:
+		fp = open(fn, 'rb')
+	except IOError:
+		pass
+	else:
+		if os.path.isdir(journal):
+			# Interrupted after the results were recorded
+			shutil.rmtree(journal)
+		with fp:
+			while True:
+				try:
+					result = serialization.load(fp)
+				except EOFError:
+					break
+				yield result
+		return
+
+	K_fun, K_args = unpack_callable(kernel)
+	writer = not _is_speculative(K_fun, K_args)
+	if os.path.isdir(journal):
+		_rollback_journal(journal)
+	if writer:
+		os.mkdir(journal)
+
+	tmp = '%s.%d.tmp' % (fn, os.getpid())
+	try:
+		with open(tmp, 'wb') as fp:
+			if writer:
+				_task_journal[0] = journal
+			try:
+				for result in K_fun(item, *K_args):
+					serialization.dump(result, fp)
+					yield result
+			finally:
+				_task_journal[0] = None
+		os.rename(tmp, fn)
+	except BaseException:
+		if os.path.exists(tmp):
+			os.unlink(tmp)
+		raise
+
+	if writer:
+		shutil.rmtree(journal)
+
+def _stable_repr(obj):
+	# A repr() of obj that doesn't change from run to run, for
+	# checkpoint tags and task names: functions are represented by
+	# their names, ndarrays by a digest of their contents, and objects
+	# without a __repr__ (whose default repr is their address) by
+	# their class and path (if any)
+	np = sys.modules.get('numpy')
+	if type(obj) in (tuple, list):
+		r = ', '.join(_stable_repr(v) for v in obj)
+		return '(%s,)' % r if type(obj) is tuple else '[%s]' % r
+	elif type(obj) is dict:
+		return '{%s}' % ', '.join(sorted('%s: %s' % (_stable_repr(k), _stable_repr(v)) for k, v in obj.iteritems()))
+	elif np is not None and isinstance(obj, np.ndarray):
+		return 'ndarray(%r, %r, %s)' % (obj.dtype.descr, obj.shape, hashlib.md5(np.ascontiguousarray(obj).tostring()).hexdigest())
+	elif hasattr(obj, '__name__') and hasattr(obj, '__module__'):
+		return '%s.%s' % (obj.__module__, obj.__name__)
+	elif type(obj).__repr__ is object.__repr__:
+		return '<%s.%s %s>' % (type(obj).__module__, type(obj).__name__, _stable_repr(getattr(obj, 'path', None)))
+	return repr(obj)
+
+class Checkpoint(object):
+	""" A directory recording the results of completed tasks of a
+	    map_reduce_chain, so that an interrupted job can be
+	    restarted without recomputing them.
+
+	    Use wrap() to wrap the kernels passed to map_reduce_chain.
+	    Each execution of a wrapped kernel on an item (a task) stores
+	    the results it yields into the checkpoint; if the results of
+	    the task are found there, they're yielded back without
+	    executing the kernel. The tasks are identified by the stage
+	    (the kernel's position in the chain) and the item (for the
+	    first stage) or its key (for the later ones, whose items are
+	    (key, values) pairs), so the restarted job must be given the
+	    same input and kernels.
+
+	    The tag identifies the job: if the checkpoint was recorded
+	    with a different tag, it's discarded. It should include
+	    everything the results depend on: the kernels and their
+	    arguments, the query bounds, and the snapshots of the tables
+	    being read. Kernels that write into a table should be tagged
+	    with the snapshot ID of the open transaction, so that the
+	    results are reused only within the same transaction.
+
+	    Tasks of kernels that write into tables (those marked with
+	    non_speculative) are rolled back if they were interrupted
+	    before their results were recorded (see journal_write()). Such
+	    tasks must write to tablets no other task writes to.
+	"""
+	path = None	# The checkpoint directory
+
+	def __init__(self, path, tag=None):
+		self.path = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+		tag = _stable_repr(tag)
+		tagfile = os.path.join(path, 'TAG')
+		try:
+			old_tag = open(tagfile).read()
+		except IOError:
+			old_tag = None
+
+		if old_tag != tag:
+			if old_tag is not None:
+				print >> sys.stderr, "Discarding checkpoint in %s (recorded for a different job)" % path
+			self.clear()
+			with open(tagfile, 'w') as fp:
+				fp.write(tag)
+
+	@staticmethod
+	def _task_name(item, stage):
+		if stage > 0 and type(item) is tuple:
+			# A (key, values) pair; the values are the results of
+			# the previous stage
+			item = (item[0],) + item[2:]
+		return '%d-%s' % (stage, hashlib.md5(_stable_repr(item)).hexdigest())
+
+	def clear(self):
+		""" Remove all recorded results """
+		for fn in glob.glob(os.path.join(self.path, '[0-9]*-*')):
+			if os.path.isdir(fn):
+				# A journal of a different job (maybe of an
+				# already committed transaction); not to be undone
+				shutil.rmtree(fn)
+			else:
+				os.unlink(fn)
+
+	def wrap(self, kernels):
+		""" Return a list of kernels, each wrapped so that it
+		    records its results into (and replays them from) this
+		    checkpoint.
+		"""
+		return [ (_checkpointed_kernel, K, self.path, stage) for (stage, K) in enumerate(kernels) ]
+
+_shared_pools = {}	# (pid, nworkers) -> Pool
+
+def shared_pool(nworkers=None):
+	""" Return a long-lived Pool, shared by all callers in this
+	    process that ask for the same number of workers.
+
+	    The workers are started on first use, and are kept running
+	    between maps; this saves on process startup and lets them
+	    reuse whatever they've cached (open tablets, loaded tables).
+	    If the workers are lost to an exception, they're restarted
+	    on next use.
+
+	    If the shared pool is busy (e.g., the results of a previous
+	    map are still being iterated over), a new, private, Pool is
+	    returned instead.
+	"""
+	key = (os.getpid(), nworkers)
+	try:
+		pool = _shared_pools[key]
+	except KeyError:
+		pool = _shared_pools[key] = Pool(nworkers)
+
+	if pool.active:
+		return Pool(nworkers)
+
+	return pool
+
+def close_shared_pools():
+	""" Shut down the workers of all shared pools created by this
+	    process.
+	"""
+	for key in _shared_pools.keys():
+		if key[0] == os.getpid():
+			_shared_pools.pop(key).close()
+
+atexit.register(close_shared_pools)
+
 def digest(s):
 	import hashlib
 	#return hashlib.md5(s).hexdigest()
 	#return hashlib.sha1(s).digest()
 	return hashlib.md5(s).digest()
 
+def fast_digest(s):
+	""" A 128-bit digest of string s, for content deduplication.
+	    Uses xxhash if available (it's several times faster), and
+	    MD5 otherwise.
+	"""
+	if _xxh128 is not None:
+		return _xxh128(s).digest()
+	return hashlib.md5(s).digest()
+
 ############ Unit tests
 
 # ====
@@ -681,6 +1823,147 @@ def _test_mapred2_red2(kv, d):
 	for val in v:
 		yield val + d
 # ====
+def _test_combine_map(a, mod):
+	for i in xrange(a):
+		yield i % mod, i
+
+def _test_combine_red(kv):
+	k, v = kv
+	yield k, sum(v)
+# ====
+def _test_collect_red(kv):
+	k, v = kv
+	yield k, sorted(v)
+# ====
+def _test_copies_map(i, ncopies):
+	import numpy as np
+	for _ in xrange(ncopies):
+		yield i % 2, np.arange(100)
+
+@dedup_values
+def _test_dedup_map(i, ncopies):
+	for kv in _test_copies_map(i, ncopies):
+		yield kv
+
+def _test_dedup_pass(kv):
+	k, v = kv
+	for val in v:
+		yield k, val
+
+def _test_dedup_red(kv):
+	# Yield the number of values, and the number of distinct buffers
+	# they were loaded into (identical values deduplicated by the
+	# previous stage are loaded from the same place)
+	import numpy as np
+	k, v = kv
+	v = list(v)
+	assert all(np.all(val == np.arange(100)) for val in v)
+	yield k, len(v), len(set(val.__array_interface__['data'][0] for val in v))
+# ====
+def _test_log_call(logfn, i):
+	# Record a call of a test kernel on item i
+	fd = os.open(logfn, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+	os.write(fd, '%d\n' % i)
+	os.close(fd)
+
+def _test_logged_calls(logfn):
+	return [ int(line) for line in open(logfn) ] if os.path.exists(logfn) else []
+
+def _test_straggler(i, tmpdir, delay):
+	# Item 0 is slow the first time it's executed
+	_test_log_call(tmpdir + '/calls', i)
+	if i == 0:
+		try:
+			os.close(os.open(tmpdir + '/slow', os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+			time.sleep(delay)
+		except OSError:
+			pass
+	yield i, 0
+	yield i, 1
+
+def _test_straggler_finishing(i, tmpdir, delay):
+	# Like _test_straggler, but the slow execution ignores being
+	# cancelled, so both copies run to completion
+	_test_log_call(tmpdir + '/calls', i)
+	if i == 0:
+		try:
+			os.close(os.open(tmpdir + '/slow', os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+		except OSError:
+			pass
+		else:
+			t1 = time.time() + delay
+			while time.time() < t1:
+				try:
+					time.sleep(t1 - time.time())
+				except TaskCancelled:
+					pass
+	yield i, 0
+	yield i, 1
+
+@non_speculative
+def _test_straggler_nonspec(i, tmpdir, delay):
+	for result in _test_straggler(i, tmpdir, delay):
+		yield result
+# ====
+def _test_flaky_kv(i, tmpdir):
+	# Item 4 fails the first time, after having output some pairs
+	_test_log_call(tmpdir + '/calls', i)
+	yield i % 3, i
+	if i == 4:
+		try:
+			os.close(os.open(tmpdir + '/failed', os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+		except OSError:
+			pass
+		else:
+			raise IOError("Item %d failed" % i)
+	yield i % 3, 10*i
+
+def _test_failing(i, tmpdir):
+	# Item 3 always fails
+	_test_log_call(tmpdir + '/calls', i)
+	if i == 3:
+		raise IOError("Item %d failed" % i)
+	yield i
+
+@non_speculative
+def _test_failing_nonspec(i, tmpdir):
+	for result in _test_failing(i, tmpdir):
+		yield result
+
+@non_speculative
+def _test_failing_writer(i, tmpdir):
+	# Like _test_failing, but modifies a "table" before failing
+	if i == 3:
+		record_write()
+	for result in _test_failing(i, tmpdir):
+		yield result
+# ====
+def _test_ckpt_map(i, tmpdir, mod):
+	_test_log_call(tmpdir + '/calls', i)
+	yield i % mod, i
+
+def _test_ckpt_red(kv, tmpdir):
+	k, v = kv
+	_test_log_call(tmpdir + '/calls', 1000 + k)
+	yield k, sum(v)
+
+@non_speculative
+def _test_ckpt_writer(i, tmpdir):
+	# Appends to its own "tablet"; item 3 fails after writing, unless
+	# tmpdir/fixed exists
+	fn = '%s/tablet.%d' % (tmpdir, i)
+	journal_write(fn)
+	with open(fn, 'a') as fp:
+		fp.write('%d\n' % i)
+	_test_log_call(tmpdir + '/calls', i)
+	if i == 3 and not os.path.exists(tmpdir + '/fixed'):
+		raise Exception('Simulated failure')
+	yield i
+
+class _test_ckpt_obj(object):
+	def __init__(self, path):
+		self.path = path
+# ====
 
 class Test_Pool:
 	@classmethod
@@ -757,3 +2040,345 @@ class Test_Pool:
 			print r3
 			assert np.all(res == r3)
 
+	def test_combine(self):
+		""" Map-Reduce: combined kernels """
+		global partitioned_shuffle
+		old = partitioned_shuffle
+		try:
+			for partitioned_shuffle in [True, False]:
+				for k in [1, 5, 100]:
+					arr = np.arange(k)
+					mod = 7
+
+					res1 = sorted(self.pool.map_reduce_chain(arr, [ (_test_combine_map, mod), _test_combine_red ], progress_callback=progress_pass))
+					res2 = sorted(self.pool.map_reduce_chain(arr, [ combine((_test_combine_map, mod), sum_values), sum_values ], progress_callback=progress_pass))
+
+					assert res1 == res2, (partitioned_shuffle, k, res1, res2)
+		finally:
+			partitioned_shuffle = old
+
+	def _run_straggler(self, mapper, tmpdir, delay):
+		pool = Pool(4)
+		try:
+			t0 = time.time()
+			res = sorted(pool.imap_unordered(range(8), mapper, (tmpdir, delay), progress_callback=progress_pass, speculative=True))
+			wall = time.time() - t0
+			assert pool.telemetry[-1]['ntasks'] == 8
+		finally:
+			pool.close()
+
+		# Each item's results are yielded exactly once
+		assert res == [ (i, j) for i in xrange(8) for j in xrange(2) ], res
+
+		return wall, _test_logged_calls(tmpdir + '/calls')
+
+	def test_speculate(self):
+		""" Mapper: speculative re-execution of stragglers """
+		global SPECULATE_MIN_TIME
+		import tempfile, shutil
+
+		old = SPECULATE_MIN_TIME
+		SPECULATE_MIN_TIME = 0.5
+		delay = 5
+		try:
+			# The straggling item is copied, and the copy's results kept
+			tmpdir = tempfile.mkdtemp()
+			try:
+				wall, calls = self._run_straggler(_test_straggler, tmpdir, delay)
+			finally:
+				shutil.rmtree(tmpdir)
+			assert wall < delay / 2., wall
+			assert sorted(calls) == [0] + range(8), calls
+
+			# Non-speculative kernels are never copied
+			tmpdir = tempfile.mkdtemp()
+			try:
+				wall, calls = self._run_straggler(_test_straggler_nonspec, tmpdir, delay)
+			finally:
+				shutil.rmtree(tmpdir)
+			assert wall >= delay, wall
+			assert sorted(calls) == range(8), calls
+		finally:
+			SPECULATE_MIN_TIME = old
+
+	def test_speculate_chain(self):
+		""" Map-Reduce: speculative re-execution of stragglers """
+		global SPECULATE_MIN_TIME, partitioned_shuffle
+		import tempfile, shutil
+
+		old = SPECULATE_MIN_TIME, partitioned_shuffle
+		SPECULATE_MIN_TIME = 0.5
+		delay = 3
+		pool = Pool(4)
+		pool.speculative = True
+		try:
+			for partitioned_shuffle in [True, False]:
+				for mapper in [ _test_straggler, _test_straggler_finishing ]:
+					tmpdir = tempfile.mkdtemp()
+					try:
+						t0 = time.time()
+						res = sorted(pool.map_reduce_chain(range(8), [ (mapper, tmpdir, delay), _test_collect_red ], progress_callback=progress_pass))
+						wall = time.time() - t0
+						calls = _test_logged_calls(tmpdir + '/calls')
+					finally:
+						shutil.rmtree(tmpdir)
+
+					# The straggler was copied, and the pairs of only one
+					# of the copies were passed on to the reducer
+					assert res == [ (i, [0, 1]) for i in xrange(8) ], (partitioned_shuffle, mapper, res)
+					assert sorted(calls) == [0] + range(8), (partitioned_shuffle, mapper, calls)
+					if mapper is _test_straggler:
+						assert wall < delay, (partitioned_shuffle, wall)
+		finally:
+			pool.close()
+			SPECULATE_MIN_TIME, partitioned_shuffle = old
+
+	def test_retry_chain(self):
+		""" Map-Reduce: retrying failed items """
+		global partitioned_shuffle
+		import tempfile, shutil
+
+		old = partitioned_shuffle
+		pool = Pool(4)
+		pool.retries, pool.retry_backoff = 1, 0.05
+		kernels = lambda tmpdir: [ (_test_flaky_kv, tmpdir), _test_collect_red ]
+		try:
+			# The pairs output before the failure are discarded
+			partitioned_shuffle = True
+			tmpdir = tempfile.mkdtemp()
+			try:
+				res = sorted(pool.map_reduce_chain(range(8), kernels(tmpdir), progress_callback=progress_pass))
+				calls = _test_logged_calls(tmpdir + '/calls')
+			finally:
+				shutil.rmtree(tmpdir)
+
+			expected = [ (k, sorted([ i for i in xrange(8) if i % 3 == k ] + [ 10*i for i in xrange(8) if i % 3 == k ])) for k in xrange(3) ]
+			assert res == expected, res
+			assert sorted(calls) == [0, 1, 2, 3, 4, 4, 5, 6, 7], calls
+
+			# Without partitioned shuffle, the pairs are returned to
+			# the parent as they're output, so the item can't be retried
+			partitioned_shuffle = False
+			tmpdir = tempfile.mkdtemp()
+			try:
+				list(pool.map_reduce_chain(range(8), kernels(tmpdir), progress_callback=progress_pass))
+			except IOError:
+				pass
+			else:
+				assert 0, "IOError should have been raised"
+			finally:
+				shutil.rmtree(tmpdir)
+		finally:
+			pool.close()
+			partitioned_shuffle = old
+
+	def _run_failing(self, mapper, tmpdir):
+		pool = Pool(4)
+		pool.retries, pool.retry_backoff = 2, 0.05
+		res = []
+		try:
+			for result in pool.imap_unordered(range(8), mapper, (tmpdir,), progress_callback=progress_pass):
+				res.append(result)
+		except IOError:
+			pass
+		else:
+			assert 0, "IOError should have been raised"
+		finally:
+			pool.close()
+
+		return sorted(res), _test_logged_calls(tmpdir + '/calls')
+
+	def test_retry(self):
+		""" Mapper: retrying failed items """
+		import tempfile, shutil
+
+		# The failing item is retried, and the others processed
+		tmpdir = tempfile.mkdtemp()
+		try:
+			res, calls = self._run_failing(_test_failing, tmpdir)
+		finally:
+			shutil.rmtree(tmpdir)
+		assert res == [0, 1, 2, 4, 5, 6, 7], res
+		assert calls.count(3) == 3, calls
+
+		# ... also for non-speculative kernels
+		tmpdir = tempfile.mkdtemp()
+		try:
+			res, calls = self._run_failing(_test_failing_nonspec, tmpdir)
+		finally:
+			shutil.rmtree(tmpdir)
+		assert res == [0, 1, 2, 4, 5, 6, 7], res
+		assert calls.count(3) == 3, calls
+
+		# ... but not if it's modified a table before failing
+		tmpdir = tempfile.mkdtemp()
+		try:
+			res, calls = self._run_failing(_test_failing_writer, tmpdir)
+		finally:
+			shutil.rmtree(tmpdir)
+		assert calls.count(3) == 1, calls
+
+	def test_checkpoint(self):
+		""" Map-Reduce: restarting from a checkpoint """
+		import tempfile, shutil
+
+		tmpdir = tempfile.mkdtemp()
+		try:
+			calls = tmpdir + '/calls'
+			ckdir = tmpdir + '/checkpoint'
+			arr = np.arange(20)
+			kernels = [ (_test_ckpt_map, tmpdir, 5), (_test_ckpt_red, tmpdir) ]
+			expected = [ (k, sum(arr[arr % 5 == k])) for k in xrange(5) ]
+
+			def run(tag):
+				if os.path.exists(calls):
+					os.unlink(calls)
+				ckpt = Checkpoint(ckdir, tag)
+				res = sorted(self.pool.map_reduce_chain(arr, ckpt.wrap(kernels), progress_callback=progress_pass))
+				return res, sorted(_test_logged_calls(calls))
+
+			# First run executes all tasks
+			res, ncalls = run(1)
+			assert res == expected, res
+			assert ncalls == range(20) + range(1000, 1005), ncalls
+
+			# Second run replays them, without calling the kernels
+			res, ncalls = run(1)
+			assert res == expected, res
+			assert ncalls == [], ncalls
+
+			# A different tag discards the checkpoint
+			Checkpoint(ckdir, 2)
+			assert os.listdir(ckdir) == ['TAG'], os.listdir(ckdir)
+			res, ncalls = run(2)
+			assert res == expected, res
+			assert ncalls == range(20) + range(1000, 1005), ncalls
+		finally:
+			shutil.rmtree(tmpdir)
+
+	def test_checkpoint_task_name(self):
+		""" Map-Reduce: checkpointed task names """
+		parts = [ '/tmp/a', '/tmp/b' ]
+		items = [ (7, parts), (7, parts, (0, 10)), (7, parts, (10, 20)), (8, parts) ]
+
+		names = [ Checkpoint._task_name(item, stage) for stage in xrange(2) for item in items ]
+		assert len(set(names)) == len(names), names
+
+		# The values (e.g., the shuffle files) of the later stages don't
+		# enter the name, but the whole item (e.g., the bounds) of the
+		# first stage does
+		assert Checkpoint._task_name((7, parts), 1) == Checkpoint._task_name((7, parts[:1]), 1)
+		assert Checkpoint._task_name((7, parts), 0) != Checkpoint._task_name((7, parts[:1]), 0)
+
+		# Objects are named by their class and path, not their address
+		assert Checkpoint._task_name((7, _test_ckpt_obj('a')), 0) == Checkpoint._task_name((7, _test_ckpt_obj('a')), 0)
+		assert Checkpoint._task_name((7, _test_ckpt_obj('a')), 0) != Checkpoint._task_name((7, _test_ckpt_obj('b')), 0)
+
+	def test_checkpoint_writer(self):
+		""" Map-Reduce: rolling back interrupted checkpointed writers """
+		import tempfile, shutil
+
+		tmpdir = tempfile.mkdtemp()
+		try:
+			calls = tmpdir + '/calls'
+			ckdir = tmpdir + '/checkpoint'
+			items = range(8)
+			kernels = [ (_test_ckpt_writer, tmpdir) ]
+			for i in [3, 4]:
+				with open('%s/tablet.%d' % (tmpdir, i), 'w') as fp:
+					fp.write('orig\n')
+
+			# Item 3 fails after writing to its tablet
+			ckpt = Checkpoint(ckdir, 1)
+			try:
+				list(self.pool.map_reduce_chain(items, ckpt.wrap(kernels), progress_callback=progress_pass))
+			except Exception:
+				pass
+			else:
+				assert False, "Expected an exception"
+			assert open(tmpdir + '/tablet.3').read() == 'orig\n3\n'
+			done = [ i for i in items if os.path.exists(os.path.join(ckdir, Checkpoint._task_name(i, 0))) ]
+			assert 3 not in done, done
+
+			# The restart rolls it back before rerunning it, and
+			# doesn't rerun the completed ones
+			os.unlink(calls)
+			open(tmpdir + '/fixed', 'w').close()
+			ckpt = Checkpoint(ckdir, 1)
+			res = sorted(self.pool.map_reduce_chain(items, ckpt.wrap(kernels), progress_callback=progress_pass))
+			assert res == items, res
+			ncalls = sorted(_test_logged_calls(calls))
+			assert ncalls == [ i for i in items if i not in done ], (ncalls, done)
+			for i in items:
+				expect = 'orig\n%d\n' % i if i in [3, 4] else '%d\n' % i
+				assert open('%s/tablet.%d' % (tmpdir, i)).read() == expect, i
+			assert not glob.glob(ckdir + '/*.journal'), os.listdir(ckdir)
+		finally:
+			shutil.rmtree(tmpdir)
+
+	def test_dedup(self):
+		""" Map-Reduce: deduplication of identical values """
+		global partitioned_shuffle
+		old = partitioned_shuffle
+		try:
+			for partitioned_shuffle in [True, False]:
+				arr = np.arange(6)
+				for mapper in [ (_test_dedup_map, 10), combine((_test_dedup_map, 10), _test_dedup_pass) ]:
+					res = sorted(self.pool.map_reduce_chain(arr, [ mapper, _test_dedup_red ], progress_callback=progress_pass))
+
+					# Stored at most once per task
+					assert [ (k, n) for (k, n, _) in res ] == [ (0, 30), (1, 30) ], res
+					assert all(nbuf <= 3 for (_, _, nbuf) in res), (partitioned_shuffle, res)
+
+				# ... and not deduplicated, unless requested
+				res = sorted(self.pool.map_reduce_chain(arr, [ (_test_copies_map, 10), _test_dedup_red ], progress_callback=progress_pass))
+				assert res == [ (0, 30, 30), (1, 30, 30) ], (partitioned_shuffle, res)
+		finally:
+			partitioned_shuffle = old
+
+	def test_task_peak_rss(self):
+		""" Telemetry: per-task peak RSS """
+		meter = TaskMeter(0)
+		a = np.ones(2**23)	# 64MB
+		del a
+		stats1 = meter.stats()
+		stats2 = TaskMeter(1).stats()
+
+		if stats1['maxrss'] is None:
+			# Can't be measured on this platform; only the process
+			# peak is available, for the stage-level maximum
+			assert stats1['process_maxrss'] >= 2**26
+		else:
+			assert 'process_maxrss' not in stats1
+			assert stats1['maxrss'] - stats2['maxrss'] >= 2**25, (stats1['maxrss'], stats2['maxrss'])
+			assert summarize_telemetry('map', [stats1, stats2])['maxrss'] == stats1['maxrss']
+
+		# The process peak is used for tasks whose peak is unknown
+		stats1['maxrss'], stats1['process_maxrss'] = None, 2**30
+		assert summarize_telemetry('map', [stats1, stats2])['maxrss'] == 2**30
+
+	def test_external_sort(self):
+		""" Map-Reduce: grouping large partitions by an external sort """
+		global partitioned_shuffle, SHUFFLE_SORT_BUFFER
+		old = partitioned_shuffle, SHUFFLE_SORT_BUFFER
+		try:
+			partitioned_shuffle = True
+			arr = np.arange(60)
+			kernels = [ (_test_combine_map, 13), _test_collect_red ]
+
+			# In memory
+			res1 = sorted(self.pool.map_reduce_chain(arr, kernels, progress_callback=progress_pass))
+
+			# Sorted in runs of 5 entries (by workers forked with the
+			# lowered buffer size)
+			SHUFFLE_SORT_BUFFER = 5
+			pool = Pool(4)
+			try:
+				res2 = sorted(pool.map_reduce_chain(arr, kernels, progress_callback=progress_pass))
+			finally:
+				pool.close()
+
+			assert len(res1) == 13
+			assert res1 == res2
+		finally:
+			partitioned_shuffle, SHUFFLE_SORT_BUFFER = old
@@ -97,6 +97,7 @@ def import_from_sweeps(db, sdss_tabname, sweep_files, create=False, all=False):
 		print('  ===> Imported %-70s [%d/%d, %5.2f%%] +%-6d %9d (%.0f/%.0f min.)' % (sfile, at, len(sweep_files), 100 * float(at) / len(sweep_files), nloaded, ntot, time_pass, time_tot))
 	del pool
 
+@pool2.non_speculative
 def import_from_sweeps_aux(file, db, tabname, all=False):
 	# import an SDSS run
 	dat   = pyfits.getdata(file, 1)
@@ -434,6 +434,7 @@ def fix_ps1_coord_bugs(cols, file, hduname):
 		keep = ~np.isnan(cols['dec'])
 		for name in cols: cols[name] = cols[name][keep]
 
+@pool2.non_speculative
 def import_from_smf_aux(file, det_table, exp_table, det_c2f, exp_c2f, survey):
 	det_c2t = gen_tab2type(det_table_def)
 	exp_c2t = gen_tab2type(exp_table_def)
@@ -605,6 +606,7 @@ def _exp_id_gather(qresult):
 
 			yield (exp_cell, (cell_id, exps))
 
+@pool2.dedup_values
 def _exp_id_load(kv, db, exp_tabname):
 	#-- This kernel is called once for each exp_tab cell referenced from det_table
 	#
@@ -656,6 +658,7 @@ def _store_rows(cell_id, exp_table, rowlist):
 	exp_table.append(arows, cell_id=cell_id, group='cached')
 	return len(arows)
 
+@pool2.non_speculative
 def _exp_store_rows(kv, db, exp_tabname):
 	# Cache all rows to be cached in this cell
 	cell_id, rowblocks = kv
@@ -790,8 +793,13 @@ def create_object_table(db, obj_tabname, det_tabname):
 		_overwrite = True
 		)
 
-def make_object_catalog(db, obj_tabname, det_tabname, exp_tabname, radius=1./3600., explist=None, oldexps=None, fovradius=None):
+def make_object_catalog(db, obj_tabname, det_tabname, exp_tabname, radius=1./3600., explist=None, oldexps=None, fovradius=None, checkpoint=None):
 	""" Create the object catalog
+
+	    If checkpoint (a directory) is given, the cells that have been
+	    matched are recorded there, and are skipped if an interrupted
+	    run is restarted (within the same transaction). The cells
+	    whose matching was interrupted are rolled back and rematched.
 	"""
 
 	# For debugging -- a simple check to see if matching works is to rerun
@@ -815,15 +823,20 @@ def make_object_catalog(db, obj_tabname, det_tabname, exp_tabname, radius=1./360
 	print >>sys.stderr, "%d cells to process." % (len(det_cells))
 	det_cells_grouped = det_table.pix.group_cells_by_spatial(det_cells).items()
 
+	kernels = [ (_obj_det_match, db, obj_tabname, det_tabname, o2d_tabname, radius, explist, _rematching) ]
+	if checkpoint is not None:
+		snapid = db.snapid if db.in_transaction() else None
+		snapshots = [ (table.path, table.catalog_snapshot()) for table in [det_table, obj_table, o2d_table] ]
+		tag = (snapid, snapshots, kernels, None if explist is None else sorted(explist))
+		kernels = pool2.Checkpoint(checkpoint, tag=tag).wrap(kernels)
+
 	t0 = time.time()
 	pool = pool2.Pool()
 	ntot = 0
 	ntotobj = 0
 	at = 0
 	for (nexp, nobj, ndet, nnew, nmatch, ndetnc) in pool.map_reduce_chain(det_cells_grouped,
-				      [
-					(_obj_det_match, db, obj_tabname, det_tabname, o2d_tabname, radius, explist, _rematching),
-				      ],
+				      kernels,
 				      progress_callback=pool2.progress_pass):
 		at += 1
 		if nexp is None:
@@ -860,6 +873,7 @@ def reserve_space(arr, minsize):
 	arr.resize(l, refcheck=False)
 
 # Single-pass detections->objects mapper.
+@pool2.non_speculative
 def _obj_det_match(cells, db, obj_tabname, det_tabname, o2d_tabname, radius, explist=None, _rematching=False):
 	"""
 	This kernel assumes:
@@ -12,11 +12,13 @@ import os, os.path
 import sys
 import json
 import utils
+import pool2
 import cPickle
 import copy
 import glob
 import shutil
 import errno
+import socket
 from table_catalog import TableCatalog
 from utils        import is_scalar_of_type
 from pixelization import Pixelization
@@ -43,6 +45,106 @@ class _Defaults(object):
 
 _mgr = pyrpc.CachingProxy("localhost", 9030, cache_for=0, retry_interval=10, defaults=_Defaults())
 
+class _TabletFilePool(object):
+	"""
+	A per-process LRU pool of open, read-only, tablet files.
+
+	Tablets of committed snapshots never change, so there's no need to
+	reopen (and re-parse the HDF5 metadata of) the same file every time
+	a query needs a different cgroup, pseudocolumns, or BLOBs from it.
+	Handles are keyed by (filename, snapid), and reference counted so
+	that a handle that is in use is never closed by LRU eviction.
+
+	The pool is reset in forked children (HDF5 handles must not be
+	shared across processes).
+	"""
+	class _Entry(object):
+		def __init__(self, key, fp):
+			self.key   = key
+			self.fp    = fp
+			self.refs  = 0
+			self.stale = False	# True if evicted/invalidated while in use
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self._pid = os.getpid()
+		self._entries = OrderedDict()
+
+	def _check_fork(self):
+		# Drop (but don't close) handles inherited from the parent process
+		if self._pid != os.getpid():
+			self._pid = os.getpid()
+			self._entries = OrderedDict()
+
+	def _discard(self, entry):
+		entry.stale = True
+		if entry.refs == 0:
+			entry.fp.close()
+
+	def acquire(self, key, opener):
+		"""
+		Return an entry for key, opening the file by calling
+		opener() if it's not already in the pool.
+		"""
+		self._check_fork()
+
+		try:
+			entry = self._entries.pop(key)
+		except KeyError:
+			entry = self._Entry(key, opener())
+
+			# Evict least recently used handles to make room
+			while len(self._entries) >= self.maxsize:
+				_, old = self._entries.popitem(last=False)
+				self._discard(old)
+
+		self._entries[key] = entry	# (Re)insert at the MRU position
+		entry.refs += 1
+
+		return entry
+
+	def release(self, entry):
+		entry.refs -= 1
+		if entry.stale and entry.refs == 0:
+			entry.fp.close()
+
+	def invalidate(self, path=None):
+		"""
+		Close all pooled handles to files in directory path (or
+		all of them, if path is None)
+		"""
+		self._check_fork()
+
+		if path is not None:
+			path = path.rstrip('/') + '/'
+
+		for key, entry in self._entries.items():
+			fn, _ = key
+			if path is None or fn.startswith(path):
+				del self._entries[key]
+				self._discard(entry)
+
+_tablet_pool = _TabletFilePool(int(os.getenv("LSD_TABLET_POOL_SIZE", 32)))
+
+# Per-process cache of Table instances opened outside of a transaction.
+# Unpickled (read-only) tables are resolved through it, so that worker
+# processes load the schema and catalog of a table only once, no matter
+# how many tasks they run (see Table.__getstate__).
+_readonly_tables = OrderedDict()
+_readonly_tables_max = 32
+
+def _readonly_table(path, snapid):
+	key = (path, snapid)
+	try:
+		table = _readonly_tables.pop(key)
+	except KeyError:
+		table = Table(path, snapid=snapid, open_transaction=False)
+		while len(_readonly_tables) >= _readonly_tables_max:
+			_readonly_tables.popitem(last=False)
+	_readonly_tables[key] = table
+
+	return table
+
 class BLOBAtom(tables.ObjectAtom):
 	"""
 	A PyTables atom representing BLOBs
@@ -103,6 +205,7 @@ class Table:
 	snapid         = 0      #: Snapshot ID of the opened table
 	_snapshots     = [ 0 ]  #: Sorted (newest to oldest) list of available, committed, snapshots
 	transaction    = False  #: True if we're in a transaction (the current snapshot is writable)
+	_touched       = None   #: Cells this process has recorded as modified in the current snapshot (see _record_touched)
 
 	_default_commit_hooks = [('Updating neighbors', 0, 'lsd.tasks', 'build_neighbor_cache')] #: Default commit hook rebuilds the neighbor cache
 
@@ -132,12 +235,19 @@ class Table:
 			for snapid in snapids:
 				local = self._snapshot_path(snapid) + '/'
 				utils.mkdir_p(local)
-				for fn in ['catalog.pkl', 'schema.cfg', '.committed']:
+				for fn in ['catalog.bin', 'catalog.pkl', 'schema.cfg', '.committed']:
 					if str(snapid) == "0" and fn == '.committed':	# Backwards compatibility
 						continue
+					if fn == 'catalog.pkl' and os.path.exists(local + 'catalog.bin'):
+						continue
 					local_fn = local + fn
 					if not os.path.exists(local_fn):
-						self.fetch_from_remote(local_fn)
+						try:
+							self.fetch_from_remote(local_fn)
+						except IOError:
+							# Remotes written by older versions of LSD only have catalog.pkl
+							if fn != 'catalog.bin':
+								raise
 
 		self._snapshots = self.list_snapshots(snapid)
 		# Sorted list of snapshots, newest first
@@ -156,7 +266,10 @@ class Table:
         def _load_catalog(self):
 		# Load the tablet cache.
 		#
-		tabtreepkl = self._find_metadata_path('catalog.pkl')
+		tabtreepkl = self._find_metadata_path('catalog.bin')
+		if not os.path.isfile(tabtreepkl):
+			# Backwards compatibility: catalogs pickled by older versions of LSD
+			tabtreepkl = self._find_metadata_path('catalog.pkl')
 		if os.path.isfile(tabtreepkl):
 			self.catalog = TableCatalog(fn=tabtreepkl)
 		elif os.path.isdir(os.path.join(self.path, 'tablets')) and not os.path.isdir(os.path.join(self.path, 'tablets', 'snapshots')):
@@ -183,18 +296,58 @@ class Table:
 			# Initialize an empty catalog
 			snapid = 0
 
-		# Update to the requested snapshot
-		pattern = self._tablet_filename(self.primary_cgroup)
-		self.catalog.update(self.path, pattern, snapid)
+		# Update to the requested snapshot. If the writers recorded which
+		# cells they've modified, merge just those into the catalog.
+		touched = self.touched_cells(snapid) if not rebuild_pre_v050_snap else None
+		if touched is not None and self.catalog.can_update_cells(self.path, snapid):
+			cells = [ (cell_id, self._tablet_file(cell_id, self.primary_cgroup, mode='w')) for cell_id in touched ]
+			self.catalog.update_cells(snapid, cells)
+		else:
+			pattern = self._tablet_filename(self.primary_cgroup)
+			self.catalog.update(self.path, pattern, snapid)
 
 		# Save
-		fn = os.path.join(self._snapshot_path(snapid), 'catalog.pkl')
+		fn = os.path.join(self._snapshot_path(snapid), 'catalog.bin')
 		self.catalog.save(fn)
 
 	def _check_transaction(self):
 		if not self.transaction:
 			raise Exception("Trying to modify a table without starting a transaction")
 
+	def _record_touched(self, cell_id):
+		"""
+		Record that the tablets of cell_id were modified in the
+		current snapshot.
+
+		Each process appends to its own manifest file in the
+		snapshot's .touched directory; see touched_cells().
+		"""
+		if self._touched is None:
+			self._touched = set()
+		if cell_id in self._touched:
+			return
+
+		path = os.path.join(self._snapshot_path(self.snapid), '.touched')
+		utils.mkdir_p(path)
+		with open(os.path.join(path, '%s.%d' % (socket.gethostname(), os.getpid())), 'a') as fp:
+			fp.write('%d\n' % cell_id)
+
+		self._touched.add(cell_id)
+
+	def touched_cells(self, snapid):
+		"""
+		Return the set of cells modified in snapshot snapid, as
+		recorded by the writers, or None if no manifest exists.
+		"""
+		path = os.path.join(self._snapshot_path(snapid), '.touched')
+		if not os.path.isdir(path):
+			return None
+
+		cells = set()
+		for fn in glob.iglob(os.path.join(path, '*')):
+			cells.update(int(line) for line in open(fn) if line.strip())
+		return cells
+
 	def begin_transaction(self, snapid, load_state=True):
 		assert not self.transaction
 
@@ -207,6 +360,7 @@ class Table:
 			raise Exception("Trying to reopen an already committed transaction")
 
 		self.transaction = True
+		self._touched = set()
 
 		if load_state:
         		# Reload state
@@ -274,6 +428,9 @@ class Table:
 
 		self.transaction = False
 
+		# Drop any pooled read-only handles that the new snapshot supersedes
+		_tablet_pool.invalidate(self.path)
+
 		# Reload state
 		self.set_snapshot(self.snapid)
 		self._load_schema()
@@ -284,6 +441,7 @@ class Table:
 		self._check_transaction()
 
 		self.transaction = False
+		_tablet_pool.invalidate(self.path)
 
 		# Reload state
 		self.set_snapshot(self.snapid)
@@ -485,6 +643,17 @@ class Table:
 		"""
 		return self.catalog.get_cells(bounds, return_bounds, include_cached)
 
+	def catalog_snapshot(self):
+		"""
+		Return the ID of the snapshot the loaded catalog describes.
+
+		Returns None if the table is in a transaction (as the
+		catalog may still change before it's committed).
+		"""
+		if self.transaction:
+			return None
+		return self._snapshots[0] if len(self._snapshots) else 0
+
 	def static_if_no_temporal(self, cell_id):
 		"""
 		Return the associated static cell, if no data exist in
@@ -570,6 +739,19 @@ class Table:
 		self._filters = filters
 		self._store_schema()
 
+	def set_cgroup_filters(self, cgroup, **filters):
+		"""
+		Set PyTables filters (compression, checksums) for a single
+		column group, overriding the table defaults.
+
+		Affects only tablets created (or recompressed) from now on.
+		Immediately commits the change to disk.
+		"""
+		assert cgroup in self._cgroups and not self._is_pseudotablet(cgroup)
+
+		self._cgroups[cgroup]['filters'] = filters
+		self._store_schema()
+
 	def define_commit_hooks(self, hooks):
 		self._commit_hooks = hooks
 		self._store_schema()
@@ -850,7 +1032,19 @@ class Table:
 		logger.debug("Released lock %s" % (lock))
 
 	#### Low level tablet creation/access routines. These employ no locking
-	def _get_row_group(self, fp, group, cgroup):
+	def _expected_rows_per_cell(self, nrows_hint=0):
+		"""
+		Estimate the number of rows a new tablet will hold.
+
+		Used to size the PyTables chunks of newly created tablets.
+		Takes the larger of the mean number of rows in populated
+		cells (from the table catalog) and nrows_hint (typically the
+		number of rows about to be written into the tablet).
+		"""
+		mean = self.catalog.mean_rows_per_cell()
+		return max(int(mean or 0), int(nrows_hint), 10*1000)
+
+	def _get_row_group(self, fp, group, cgroup, nrows_hint=0):
 		"""
 		Get a handle to the given HDF5 node.
 		
@@ -863,6 +1057,10 @@ class Table:
 		retreiving/creating the group with data belonging to the
 		cell ('main'), or the neighbor cache ('cached').
 
+		Unless the schema sets 'expectedrows', the HDF5 chunk size
+		is tuned from the observed density of rows in the table's
+		cells, and nrows_hint (see _expected_rows_per_cell()).
+
 		TODO: I feel this whole 'group' business hasn't been well
 		      though out and should be reconsidered/redesigned...
 		"""
@@ -875,7 +1073,9 @@ class Table:
 
 			# cgroup
 			filters      = schema.get('filters', self._filters)
-			expectedrows = schema.get('expectedrows', 20*1000*1000)
+			expectedrows = schema.get('expectedrows', None)
+			if expectedrows is None:
+				expectedrows = self._expected_rows_per_cell(nrows_hint)
 
 			fp.createTable('/' + group, 'table', np.dtype(schema["columns"]), createparents=True, expectedrows=expectedrows, filters=tables.Filters(**filters))
 			g = getattr(fp.root, group)
@@ -915,6 +1115,8 @@ class Table:
 		TODO: I feel this whole 'group' business hasn't been well
 		      though out and should be reconsidered/redesigned...
 		"""
+		pool2.record_write()
+
 		with self.lock_cell(cell_id, mode='r+') as cell:
 			for cgroup in self._cgroups:
 				if self._is_pseudotablet(cgroup):
@@ -940,11 +1142,26 @@ class Table:
 				_mgr.release_file_lease(self._x_fn)
 			return self._x_fp.close()
 
-	def _create_tablet(self, fn, cgroup):
+	class _PooledTabletFile(object):
+		""" Wrap a tables.File object from _tablet_pool. Closing it
+		    returns the handle to the pool, instead of closing the file.
+		"""
+		def __init__(self, entry):
+			object.__setattr__(self, '_x_entry', entry)
+
+		def __getattr__(self, k):    return getattr(self._x_entry.fp, k)
+		def __delattr__(self, k):    return delattr(self._x_entry.fp, k)
+		def __setattr__(self, k, v): return setattr(self._x_entry.fp, k, v)
+
+		def close(self):
+			_tablet_pool.release(self._x_entry)
+
+	def _create_tablet(self, fn, cgroup, nrows_hint=0):
 		"""
 		Create a new tablet.
 		
 		Create a tablet in file <fn>, for column group <cgroup>.
+		See _get_row_group() for the meaning of nrows_hint.
 		"""
 		self._check_transaction()
 
@@ -961,11 +1178,54 @@ class Table:
 		fp  = self._TabletFile(fn, mode='w')
 
 		# Force creation of the main subgroup
-		self._get_row_group(fp, 'main', cgroup)
+		self._get_row_group(fp, 'main', cgroup, nrows_hint)
 
 		return fp
 
-	def _open_tablet(self, cell_id, cgroup, mode='r'):
+	def repack_cell(self, cell_id, cgroup, rechunk=False):
+		"""
+		Rewrite the tablet of the given cgroup in cell_id into the
+		current snapshot, using the filters (compression settings)
+		currently defined for that cgroup. If rechunk=True, the HDF5
+		chunk shapes are also recomputed from the number of rows
+		actually present in the tablet.
+
+		Tablets of other cgroups are copied over to the current
+		snapshot unchanged (all tablets of a cell must reside in the
+		same snapshot).
+		"""
+		self._check_transaction()
+		pool2.record_write()
+
+		schema  = self._get_schema(cgroup)
+		filters = tables.Filters(**schema.get('filters', self._filters))
+
+		lock = self._lock_cell(cell_id)
+		try:
+			for cg in self._cgroups:
+				if self._is_pseudotablet(cg) or not self.tablet_exists(cell_id, cg):
+					continue
+
+				if cg != cgroup:
+					# Copy it over from the older snapshot, if needed
+					self._open_tablet(cell_id, cg, mode='r+').close()
+					continue
+
+				# Prefer the version already written in this snapshot, if any
+				fn_w = self._tablet_file(cell_id, cg, mode='w')
+				fn_r = fn_w if os.path.isfile(fn_w) else self._tablet_file(cell_id, cg)
+
+				tmp = fn_w + '.recompress'
+				with tables.openFile(fn_r) as fp:
+					fp.copyFile(tmp, overwrite=True, filters=filters, chunkshape='auto' if rechunk else 'keep')
+				os.chmod(tmp, 0664)
+				pool2.journal_write(fn_w)
+				os.rename(tmp, fn_w)
+				self._record_touched(cell_id)
+		finally:
+			self._unlock_cell(lock)
+
+	def _open_tablet(self, cell_id, cgroup, mode='r', nrows_hint=0):
 		"""
 		Open (or create) a tablet.
 
@@ -974,26 +1234,38 @@ class Table:
 		mode='r+': Open an existing tablet, for reading/writing
 
 		Modes that imply writablility require a transaction to be
-		open.
+		open. If a tablet gets created, nrows_hint is passed on to
+		_get_row_group().
 
 		Employs no locking of any kind.
 		"""
 
 		if mode == 'r':
 			fn_r = self._tablet_file(cell_id, cgroup)
-		        # --- hack: preload the entire file to have it appear in filesystem cache
-		        #     this will speed up subsequent random reads within the file
-		        try:
-				_mgr.obtain_file_lease(fn_r)
-				with open(fn_r) as f:
-					f.read()
-			finally:
-				_mgr.release_file_lease(fn_r)
-			# ---
-			fp = tables.openFile(fn_r)
+
+			def _open():
+			        # --- hack: preload the entire file to have it appear in filesystem cache
+			        #     this will speed up subsequent random reads within the file
+			        try:
+					_mgr.obtain_file_lease(fn_r)
+					with open(fn_r) as f:
+						f.read()
+				finally:
+					_mgr.release_file_lease(fn_r)
+				# ---
+				return tables.openFile(fn_r)
+
+			# Tablets in the snapshot being written to may still change, so
+			# only those from committed snapshots are kept in the pool
+			snapid = self.catalog.snapshot_of_cell(cell_id)
+			if _tablet_pool.maxsize > 0 and not (self.transaction and snapid == self.snapid):
+				fp = self._PooledTabletFile(_tablet_pool.acquire((fn_r, snapid), _open))
+			else:
+				fp = _open()
 		elif mode == 'r+':
 			self._check_transaction()
 			fn_w = self._tablet_file(cell_id, cgroup, mode='w')
+			pool2.journal_write(fn_w)
 			if os.path.isfile(fn_w):
 				fp = self._TabletFile(fn_w, mode='a')
 			elif self.tablet_exists(cell_id, cgroup): 	# Note: this will download the tablet from remote, if needed
@@ -1009,11 +1281,14 @@ class Table:
 				fp = self._TabletFile(fn_w, mode='a')
 			else:
 				# No file exists
-				fp = self._create_tablet(fn_w, cgroup)
+				fp = self._create_tablet(fn_w, cgroup, nrows_hint)
+			self._record_touched(cell_id)
 		elif mode == 'w':
 			self._check_transaction()
 			fn_w = self._tablet_file(cell_id, cgroup, mode='w')
-			fp = self._create_tablet(fn_w, cgroup)
+			pool2.journal_write(fn_w)
+			fp = self._create_tablet(fn_w, cgroup, nrows_hint)
+			self._record_touched(cell_id)
 		else:
 			raise Exception("Mode must be one of 'r', 'r+', or 'w'")
 
@@ -1043,6 +1318,19 @@ class Table:
 		self._load_schema()
 		self._load_catalog()
 
+	def __getstate__(self):
+		# Outside of a transaction a table can't change, so pickle just
+		# where to find it. Tables in a transaction may be modified, and
+		# are pickled whole.
+		if self.transaction:
+			return self.__dict__
+		return { '_x_readonly': (self.path, self.snapid) }
+
+	def __setstate__(self, state):
+		if '_x_readonly' in state:
+			state = _readonly_table(*state['_x_readonly']).__dict__
+		self.__dict__.update(state)
+
 	def _create(self, snapid, name, path):
 		"""
 		Create an empty table and store its schema.
@@ -1144,6 +1432,7 @@ class Table:
 
 		# Must be in a transaction to modify things
 		self._check_transaction()
+		pool2.record_write()
 
 		# Resolve aliases in the input, and prepare a ColGroup()
 		cols = ColGroup()
@@ -1237,6 +1526,7 @@ class Table:
 
 			# Mask for rows belonging to this cell
 			incell = cells == cur_cell_id
+			nincell = np.sum(incell)
 
 			# Store cell groups into their tablets
 			for cgroup, schema in self._cgroups.iteritems():
@@ -1244,8 +1534,8 @@ class Table:
 					continue
 
 				# Get the tablet file handles
-				fp    = self._open_tablet(cur_cell_id, mode='r+', cgroup=cgroup)
-				g     = self._get_row_group(fp, group, cgroup)
+				fp    = self._open_tablet(cur_cell_id, mode='r+', cgroup=cgroup, nrows_hint=nincell)
+				g     = self._get_row_group(fp, group, cgroup, nincell)
 				t     = g.table
 				blobs = schema['blobs'] if 'blobs' in schema else dict()
 
@@ -1345,7 +1635,7 @@ class Table:
 				else:
 					# Construct a compatible numpy array, that will leave
 					# unspecified columns set to zero
-					nnew = np.sum(incell)
+					nnew = nincell
 					rows = np.zeros(nnew, dtype=np.dtype(schema['columns']))
 					idx = slice(None)
 
@@ -1591,7 +1881,7 @@ class Table:
 
 		return blobs
 
-	def fetch_tablet(self, cell_id, cgroup=None, include_cached=False):
+	def fetch_tablet(self, cell_id, cgroup=None, include_cached=False, return_counts=False):
 		"""
 		Load and return the contents of a tablet.
 
@@ -1605,11 +1895,16 @@ class Table:
 		include_cached : boolean
 		    If True, data from the neighbor cache will be returned
 		    as well.
+		return_counts : boolean
+		    If True, also return the number of rows that came
+		    from the main and neighbor cache parts of the tablet.
 
 		Returns
 		-------
 		rows : structured ndarray
 		    The rows from the tablet.
+		counts : tuple
+		    (nmain, ncached), only if return_counts=True.
 
 		Notes
 		-----
@@ -1634,14 +1929,17 @@ class Table:
 		cell_id = self.static_if_no_temporal(cell_id)
 
 		if self._is_pseudotablet(cgroup):
-			return self._fetch_pseudotablet(cell_id, cgroup, include_cached)
+			rows = self._fetch_pseudotablet(cell_id, cgroup, include_cached)
+			return (rows, (len(rows), 0)) if return_counts else rows
 
+		ncached = 0
 		if self.tablet_exists(cell_id, cgroup):	# Note: this will download the tablet from remote, if needed
 			with self.lock_cell(cell_id) as cell:
 				with cell.open(cgroup) as fp:
 					rows = fp.root.main.table.read()
 					if include_cached and 'cached' in fp.root:
 						rows2 = fp.root.cached.table.read()
+						ncached = len(rows2)
 						# Make any neighbor cache BLOBs negative (so that fetch_blobs() know to
 						# look for them in the cache, instead of 'main')
 						schema = self._get_schema(cgroup)
@@ -1654,6 +1952,8 @@ class Table:
 			schema = self._get_schema(cgroup)
 			rows = np.empty(0, dtype=np.dtype(schema['columns']))
 
+		if return_counts:
+			return rows, (len(rows) - ncached, ncached)
 		return rows
 
 	def _fetch_pseudotablet(self, cell_id, cgroup, include_cached=False):
@@ -1674,10 +1974,9 @@ class Table:
 		# Find out how many rows are there in this cell
 		nrows1 = nrows2 = 0
 		if self.cell_exists(cell_id):
-			with self.lock_cell(cell_id) as cell:
-				with cell.open(self.primary_cgroup) as fp:
-					nrows1 = len(fp.root.main.table)
-					nrows2 = len(fp.root.cached.table) if (include_cached and 'cached' in fp.root) else 0
+			nrows1, nrows2 = self.cell_row_counts(cell_id)
+			if not include_cached:
+				nrows2 = 0
 		nrows = nrows1 + nrows2
 
 		cached = np.zeros(nrows, dtype=np.bool)			# _CACHED
@@ -1688,6 +1987,30 @@ class Table:
 		pcols  = ColGroup([('_CACHED', cached), ('_ROWIDX', rowidx), ('_ROWID', rowid)])
 		return pcols
 
+	def cell_row_counts(self, cell_id):
+		"""
+		Return the number of (main, cached) rows in a cell.
+
+		Uses the counts recorded in the table catalog, falling back
+		to reading the primary cgroup's tablet if they're unknown
+		(catalogs built by older versions of LSD), or may be stale
+		(cells written to in the currently open transaction).
+
+		Raises LookupError if the cell does not exist.
+		"""
+		snapid = self.catalog.snapshot_of_cell(cell_id)
+		if not (self.transaction and snapid == self.snapid):
+			counts = self.catalog.row_counts(cell_id)
+			if counts is not None:
+				return counts
+
+		with self.lock_cell(cell_id) as cell:
+			with cell.open(self.primary_cgroup) as fp:
+				nrows   = len(fp.root.main.table)
+				ncached = len(fp.root.cached.table) if 'cached' in fp.root else 0
+
+		return nrows, ncached
+
 	def _is_pseudotablet(self, cgroup):
 		"""
 		Test whether a given cgroup is a pseudotablet.
@@ -3,16 +3,18 @@
 table_catalog module - TableCatalog implementation
 
 TableCatalog class scans and caches the layout of the <table>/tablets
-directory structure into a fast bitmap+list data structure pickled in
-<table>/tablet_tree.pkl file. These are used by Table.get_cells() routine to
-substantially speed up the cell scan.
+directory structure into a fast bitmap+list data structure stored in
+the <snapshot>/catalog.bin file (see TableCatalog.save() for the format;
+older versions of LSD pickled it into catalog.pkl). These are used by
+Table.get_cells() routine to substantially speed up the cell scan.
 
 On very large tables (e.g., ps1_det), this class accellerates the get_cells()
 ~ 40x (6 seconds instead of 240).
 
 The main acceleration data structures are a 2D (W x W) numpy array of
 indices (stored in bmaps[self._pix.level]), and a 1D ndarray of (mjd, next)
-pairs into which the indices in the image refer to (leaves).  Leaves is
+pairs into which the indices in the image refer to (leaves). Snapshot IDs
+of leaves are stored as indices into a list of (interned) snapshot IDs.  Leaves is
 (logically) a singly linked list of all temporal cells within the spatial
 cell, with the root of the list being pointed to from bmap.  <W> above is
 2**lev, where lev is the bhpix level of pixelization of the table.
@@ -40,8 +42,15 @@ contains do:
 	  are no populated cells in a larger partitioning of space. E.g., if
 	  pixel (0, 0) is zero in the (2 x 2) map, it means there are no
 	  populated cells with x < 0, y < 0 bhpix coordinates (and the
-	  search of that entire subtree can be avoided). TableCatalog
-	  makes use of these 'mipmaps' to accelerate get_cells().
+	  search of that entire subtree can be avoided).
+
+	- get_cells() does not traverse the tree. It enumerates the
+	  populated pixels of the full-resolution bitmap once (when the
+	  catalog is loaded), and classifies them against the query
+	  polygon in a vectorized manner: pixels farther from any polygon
+	  edge than half their diagonal are either entirely in or entirely
+	  out. Exact Polygon intersections are computed only for the
+	  (few) pixels straddling the polygon boundary.
 
 TODO:
 	- the catalog should be build/maintained whenever the database is
@@ -52,7 +61,7 @@ TODO:
 	  	  table (we probably need a server)
 """
 import logging
-import cPickle, os, glob
+import cPickle, os, glob, struct
 import tables
 import pool2
 import numpy as np
@@ -68,6 +77,21 @@ logger = logging.getLogger('lsd.table_catalog')
 
 END_MARKER=0x7FFFFFFF
 
+# Layout of a leaf. nrows and ncached are the number of rows in the 'main'
+# and 'cached' groups of the cell's primary tablet (-1 if unknown, e.g. for
+# catalogs written by older versions of LSD).
+# snap is the index of the cell's snapshot ID in TableCatalog._snapids (-1
+# for the dummy leaves).
+LEAF_DTYPE = [('mjd', 'f4'), ('snap', 'i4'), ('cell_id', 'u8'), ('next', 'i4'), ('nrows', 'i8'), ('ncached', 'i8')]
+DUMMY_LEAF = (np.inf, -1, 0, END_MARKER, 0, 0)
+
+# Binary catalog file format (see TableCatalog.save())
+CATALOG_MAGIC = 'LSDCAT01'
+CATALOG_ALIGN = 64
+
+def _aligned(offs):
+	return (offs + CATALOG_ALIGN - 1) // CATALOG_ALIGN * CATALOG_ALIGN
+
 def _add_bounds(outcells, cell_id, xybounds, tbounds):
 	# cells is a dictionary of cell_id -> dict objects,
 	# where each dict object is another dictionary of xybounds -> tbounds
@@ -83,12 +107,33 @@ def _add_bounds(outcells, cell_id, xybounds, tbounds):
 	elif outcells[cell_id][xybounds] is not None:		# Merge tbounds with existing entry
 		outcells[cell_id][xybounds] |= tbounds
 
-def _get_cells_kernel(ij, lev, cc, bounds):
-	i, j = ij
-       	cells = defaultdict(dict)
-	for bounds_xy, bounds_t in bounds:
-		cc._get_cells_recursive(cells, bounds_xy, bounds_t, i, j, lev, bhpix.pix_size(lev))
-	yield cells
+def _distance_to_edges(x, y, poly):
+	# Return the distance from each of the points (x, y) to the
+	# nearest edge of Polygon poly (np.inf if poly has no edges)
+	dist = np.empty(len(x))
+	dist[:] = np.inf
+
+	edges = []
+	for c in xrange(len(poly)):
+		p = np.array(poly.contour(c), dtype=np.float64)
+		edges.append(np.hstack((p, np.roll(p, -1, axis=0))))
+	if not len(edges) or not len(x):
+		return dist
+
+	x0, y0, x1, y1 = np.vstack(edges).T
+	ex, ey = x1 - x0, y1 - y0
+	l2 = ex*ex + ey*ey
+	l2[l2 == 0] = 1.		# Degenerate edges (the projection below is then zero)
+
+	# Process the points in blocks, to keep the (npoints x nedges) temporaries small
+	step = max(1, 1000000 // len(x0))
+	for at in xrange(0, len(x), step):
+		px, py = x[at:at+step, None], y[at:at+step, None]
+		u = np.clip(((px - x0)*ex + (py - y0)*ey) / l2, 0., 1.)
+		dx, dy = x0 + u*ex - px, y0 + u*ey - py
+		dist[at:at+step] = np.sqrt(np.min(dx*dx + dy*dy, axis=1))
+
+	return dist
 
 def _scan_recursive_kernel(xy, lev, cc):
 	x, y = xy
@@ -139,74 +184,123 @@ def isnapshots(table_path, return_path=False, first=None, last=None, no_first=Fa
 class TableCatalog:
 	_bmaps = None
 	_leaves = None
+	_snapids = None		# List of snapshot IDs, indexed by _leaves['snap']
 	_pix = None
-	
+
+	# Derived lookup arrays (see _rebuild_internal_state())
+	_cells = None		# Sorted cell_ids
+	_cells_leaf = None	# Index into _leaves of each of _cells
+	_pix_x = None		# Centers of populated pixels
+	_pix_y = None
+	_leaf_pix = None	# Index of the pixel (into _pix_x/y) of each leaf
+	_mean_rows = None	# Cached (mean_rows_per_cell(),), or None if not computed yet
+
 	#################
 
-	def _get_cells_recursive(self, outcells, bounds_xy, bounds_t, i = 0, j = 0, lev = 0, dx = 2.):
+	def _iter_siblings(self, offs):
+		# Iterate through the list of temporal siblings starting at
+		# offs, yielding (mjd, snapid, cell_id, next, nrows, ncached)
+		for (mjd, snap, cell_id, next, nrows, ncached) in iter_siblings(self._leaves, offs):
+			yield (mjd, self._snapids[snap], cell_id, next, nrows, ncached)
+
+	def _leaf_of(self, cell_id):
+		# Return the index of cell_id's leaf (LookupError if it doesn't exist)
+		cell_id = np.uint64(cell_id)
+		i = np.searchsorted(self._cells, cell_id)
+		if i == len(self._cells) or self._cells[i] != cell_id:
+			raise LookupError()
+		return self._cells_leaf[i]
+
+	def _cell_tbounds(self, t, bounds_t):
+		""" Helper for get_cells(). Return the part of bounds_t
+		    overlapping the temporal cell starting at t (None if it's
+		    the whole cell), or False if there's no overlap.
+		"""
+		tival = intervalset((t, t+self._pix.dt))
+		tolap = bounds_t & tival
+		if len(tolap):
+			(l, r) = tolap[-1]				# Get the right-most interval component
+			if l == r == t+self._pix.dt:				# Is it a single point?
+				tolap = intervalset(*tolap[:-1])	# Since objects in this cell have time in [t, t+dt), remove the t+dt point
+
+		if len(tolap) == 0:					# No overlap between the intervals -- skip this cell
+			return False
+
+		# Return None if the cell is fully contained in the requested interval
+		return None if tival == tolap else tolap
+
+	def _get_cells_vectorized(self, outcells, bounds_xy, bounds_t, include_cached):
 		""" Helper for get_cells(). See documentation of
 		    get_cells() for usage
 		"""
-		w2 = 1 << (lev-1)
-		x, y =  (i - w2 + 0.5)*dx, (j - w2 + 0.5)*dx
-
-		# Check for nonzero overlap
-		box  = self._pix._cell_bounds_xy(x, y, dx)
-		bounds_xy = bounds_xy & box
-		if not bounds_xy:
+		if not bounds_xy or not len(self._pix_x):
 			return
 
-		# Check if the cell directory exists (give up if it doesn't)
-		bmap = self._bmaps[lev]
-		offs = bmap[i, j]
-		if not offs:
+		# Cull populated pixels outside of the bounding box
+		dx = bhpix.pix_size(self._pix.level)
+		r = dx * np.sqrt(0.5)		# Half of the diagonal of a pixel
+		x, y = self._pix_x, self._pix_y
+		(xmin, xmax, ymin, ymax) = bounds_xy.boundingBox()
+		pix = np.nonzero((x + r >= xmin) & (x - r <= xmax) & (y + r >= ymin) & (y - r <= ymax))[0]
+		if not len(pix):
+			return
+		x, y = x[pix], y[pix]
+
+		# Pixels whose centers are farther than r from the polygon boundary
+		# are either completely inside or completely outside of it.
+		far = _distance_to_edges(x, y, bounds_xy) > r
+		inside = np.zeros(len(pix), dtype=bool)
+		if np.any(far):
+			inside[far] = np.asarray(bounds_xy.isInsideV(x[far], y[far]), dtype=bool)
+
+		# Compute the xy bounds of selected pixels, intersecting
+		# the polygons only for those on the boundary
+		xybounds = dict((p, None) for p in pix[inside])
+		for p, x0, y0 in izip(pix[~far], x[~far], y[~far]):
+			box = self._pix._cell_bounds_xy(x0, y0, dx)
+			bxy = bounds_xy & box
+			if bxy:
+				xybounds[p] = None if(bxy.area() == box.area()) else bxy
+		if not len(xybounds):
 			return
 
-		# If re reached the bottom of the hierarchy
-		if offs > 1:
-			# Get the cell_ids for leaf cells matching pattern
-			xybounds = None if(bounds_xy.area() == box.area()) else bounds_xy
-			next = 0
-			while next != END_MARKER:
-				(t, _, _, next) = self._leaves[offs]
-				has_data = next > 0
-				next = abs(next)
-				if next != END_MARKER:	# Not really necessary, but numpy warns of overflow otherwise.
-					offs += next
-
-				if not has_data and not self._include_cached:
+		# Find leaves (cells) within selected pixels
+		keep = np.in1d(self._leaf_pix, np.fromiter(xybounds.iterkeys(), dtype=np.int64))
+		if not include_cached:
+			keep &= self._leaves['next'] > 0
+		idx = np.nonzero(keep)[0]
+		t = self._leaves['mjd'][idx].astype(np.float64)
+		cell_ids = self._leaves['cell_id'][idx]
+		leaf_pix = self._leaf_pix[idx]
+
+		# Classify temporal cells w.r.t. bounds_t: fully contained, fully
+		# outside, or partially overlapping (the latter are handled by
+		# _cell_tbounds())
+		static = t == self._pix.t0
+		tl, tr = np.array(bounds_t.data[0::2], dtype=np.float64), np.array(bounds_t.data[1::2], dtype=np.float64)
+		if len(tl):
+			t1 = t + self._pix.dt
+			k  = np.searchsorted(tl, t,  side='right') - 1
+			k2 = np.searchsorted(tl, t1, side='right') - 1
+			contained = (k >= 0) & (tr[np.maximum(k, 0)] >= t1)
+			overlaps = (k2 >= 0) & (tr[np.maximum(k2, 0)] >= t)
+		else:
+			contained = overlaps = np.zeros(len(t), dtype=bool)
+
+		for cell_id, p, t0, is_static, is_contained, is_overlapping in izip(cell_ids, leaf_pix, t, static, contained, overlaps):
+			if is_static:
+				tbounds = bounds_t
+			elif is_contained:
+				tbounds = None
+			elif not is_overlapping:
+				continue
+			else:
+				tbounds = self._cell_tbounds(t0, bounds_t)
+				if tbounds is False:
 					continue
 
-				if t != self._pix.t0:
-					# Cut on the time component
-					tival = intervalset((t, t+self._pix.dt))
-					tolap = bounds_t & tival
-					if len(tolap):
-						(l, r) = tolap[-1]				# Get the right-most interval component
-						if l == r == t+self._pix.dt:				# Is it a single point?
-							tolap = intervalset(*tolap[:-1])	# Since objects in this cell have time in [t, t+dt), remove the t+dt point
-	
-					if len(tolap) == 0:					# No overlap between the intervals -- skip this cell
-						continue;
-	
-					# Return None if the cell is fully contained in the requested interval
-					tbounds = None if tival == tolap else tolap
-				else:
-					# Static cell
-					tbounds = bounds_t
-					assert next == END_MARKER, "There can be only one static cell (x,y,t=%s,%s,%s)" % (x, y, t)
-
-				# Compute cell ID
-				cell_id = (x, y, t)
-
-				# Add to output
-				_add_bounds(outcells, cell_id, xybounds, tbounds)
-		else:
-			# Recursively subdivide the four subpixels
-			for (di, dj) in [(0, 0), (0, 1), (1, 0), (1, 1)]:
-				i2 = i*2 + di
-				j2 = j*2 + dj
-				self._get_cells_recursive(outcells, bounds_xy & box, bounds_t, i2, j2, lev+1, dx/2)
+			# Add to output
+			_add_bounds(outcells, cell_id, xybounds[p], tbounds)
 
 	def get_cells(self, bounds=None, return_bounds=False, include_cached=True):
 		""" Return a list of (cell_id, bounds) tuples completely
@@ -218,59 +312,66 @@ class TableCatalog:
 		    unless return_bounds=False when the output is just a
 		    list of cell_ids.
 		"""
-		self._include_cached = include_cached
-
 		# Special case of bounds=None (all sky)
 		if bounds == None:
 			bounds = [(bn.ALLSKY, intervalset((-np.inf, np.inf)))]
 
 		# Find all existing cells satisfying the bounds
 		cells = defaultdict(dict)
-		if False:
-			# Single-threaded implementation
-			for bounds_xy, bounds_t in bounds:
-				self._get_cells_recursive(cells, bounds_xy, bounds_t, 0, 0, 1, 1.)
-				self._get_cells_recursive(cells, bounds_xy, bounds_t, 0, 1, 1, 1.)
-				self._get_cells_recursive(cells, bounds_xy, bounds_t, 1, 0, 1, 1.)
-				self._get_cells_recursive(cells, bounds_xy, bounds_t, 1, 1, 1, 1.)
-		else:
-			# Multi-process implementation (appears to be as good or better than single thread in
-			# nearly all cases of interest)
-			pool = pool2.Pool()
-			lev = min(4, self._pix.level)
-			ij = np.indices((2**lev,2**lev)).reshape(2, -1).T # List of i,j coordinates
-			for cells_ in pool.imap_unordered(ij, _get_cells_kernel, (lev, self, bounds), progress_callback=pool2.progress_pass):
-				for cell_id, b in cells_.iteritems():
-					for xyb, tb in b.iteritems():
-						_add_bounds(cells, cell_id, xyb, tb)
-			del pool
-
-		if len(cells):
-			# Transform (x, y, t) tuples to cell_ids
-			xyt = np.array(cells.keys()).transpose()
-			cell_ids = self._pix._cell_id_for_xyt(xyt[0], xyt[1], xyt[2])
-
-			# Reorder cells to be a dict of cell: [(poly, time), (poly, time)] entries
-			cells = dict(( (cell_id, v.items()) for (cell_id, (k, v)) in izip(cell_ids, cells.iteritems()) ))
+		for bounds_xy, bounds_t in bounds:
+			self._get_cells_vectorized(cells, bounds_xy, bounds_t, include_cached)
 
 		if not return_bounds:
 			return cells.keys()
 		else:
-			return cells
+			# Reorder cells to be a dict of cell: [(poly, time), (poly, time)] entries
+			return dict(( (cell_id, v.items()) for (cell_id, v) in cells.iteritems() ))
 
 	def get_cells_in_snapshot(self, snapid, include_cached=True):
 		""" Return a list of cells that are physically stored in snapshot snapid """
-		keep = self._leaves['snapid'] == snapid
+		try:
+			snap = self._snapids.index(snapid)
+		except ValueError:
+			return np.empty(0, dtype=np.uint64)
+
+		keep = self._leaves['snap'] == snap
 		if not include_cached:
 			keep &= self._leaves['next'] > 0
 		cells = self._leaves['cell_id'][keep]
 		return cells
 
 	def snapshot_of_cell(self, cell_id):
-		try:
-			return self._cell_to_snapshot[cell_id]
-		except KeyError:
-			raise LookupError()
+		return self._snapids[self._leaves['snap'][self._leaf_of(cell_id)]]
+
+	def row_counts(self, cell_id):
+		""" Return the (main, cached) row counts of a cell, as recorded
+		    when the catalog was built, or None if they're unknown.
+
+		    Raises LookupError if the cell doesn't exist.
+		"""
+		leaf = self._leaves[self._leaf_of(cell_id)]
+		if leaf['nrows'] < 0:
+			return None
+		return int(leaf['nrows']), int(leaf['ncached'])
+
+	def mean_rows_per_cell(self):
+		""" Return the mean number of (non-cached) rows in cells
+		    that have any, or None if unknown.
+		"""
+		if self._mean_rows is None:
+			nrows = self._leaves['nrows'][2:]
+			nrows = nrows[nrows > 0]
+			self._mean_rows = (float(np.mean(nrows)) if len(nrows) else None,)
+		return self._mean_rows[0]
+
+	def total_rows(self):
+		""" Return the total number of (non-cached) rows in all cells,
+		    or None if the row counts of some cells are unknown.
+		"""
+		nrows = self._leaves['nrows'][2:]
+		if np.any(nrows < 0):
+			return None
+		return int(np.sum(nrows))
 
 	#################
 
@@ -316,29 +417,27 @@ class TableCatalog:
 			for snapid, path in paths:
 				for tcell, fn in self._get_temporal_siblings(path, self.__pattern):
 					if tcell not in siblings: # Add only if there's no newer version
-						# check if there are any non-cached data in here
-						try:
-							with tables.openFile(fn) as fp:
-								has_data = len(fp.root.main.table) > 0
-						except tables.exceptions.NoSuchNodeError:
-							has_data = False
+						# count the non-cached and cached rows in here
+						with tables.openFile(fn) as fp:
+							nrows   = len(fp.root.main.table)   if 'main'   in fp.root else 0
+							ncached = len(fp.root.cached.table) if 'cached' in fp.root else 0
 						
-						siblings[tcell] = snapid, has_data
+						siblings[tcell] = snapid, nrows > 0, nrows, ncached
 
 			# Add any relevant pre-existing data
 			offs = self._bmaps[self._pix.level][i, j]
 			if offs != 0:
-				for mjd, snapid, _, next in iter_siblings(self._leaves, offs):
+				for mjd, snapid, _, next, nrows, ncached in self._iter_siblings(offs):
 					if mjd not in siblings:
-						siblings[mjd] = snapid, next > 0
+						siblings[mjd] = snapid, next > 0, nrows, ncached
 
 			# Add this list to bitmap
 			assert bmap[i, j] == 0
-			bmap[i, j] = [ (tcell, snapid, self._pix._cell_id_for_xyt(x, y, tcell), has_data) for (tcell, (snapid, has_data)) in siblings.iteritems() ]
+			bmap[i, j] = [ (tcell, snapid, self._pix._cell_id_for_xyt(x, y, tcell), has_data, nrows, ncached) for (tcell, (snapid, has_data, nrows, ncached)) in siblings.iteritems() ]
 
 	def _update(self, table_path, snapid):
 		# Find what we already have loaded
-		prevsnap = np.max(self._leaves['snapid']) if len(self._leaves) > 2 else None
+		prevsnap = max(self._snapids) if len(self._leaves) > 2 else None
 		assert prevsnap <= snapid, "Cannot update a catalog to an older snapshot"
 
 		## Enumerate all existing snapshots older or equal to snapid, and newer than prevsnap, and sort them, newest first
@@ -359,17 +458,25 @@ class TableCatalog:
 		w2 = 1 << (lev-1)
 		x, y =  (i - w2 + 0.5)*dx, (j - w2 + 0.5)*dx
 
-		pool = pool2.Pool()
+		pool = pool2.shared_pool()
 		for bmap2 in pool.imap_unordered(zip(x, y), _scan_recursive_kernel, (lev, self)):
 			assert not np.any((bmap != 0) & (bmap2 != 0))
 			mask = bmap2 != 0
 			bmap[mask] = bmap2[mask]
 		del pool
 
+		return self._merge_and_pack(bmap)
+
+	def _merge_and_pack(self, bmap):
+		# Merge the lists of siblings in (object) bitmap bmap with the
+		# current contents of the catalog, and pack them into
+		# (bmaps, leaves, snapids).
+		w = bhpix.width(self._pix.level)
+
 		# Add data about cells that were not touched by this update
 		bmap_cur = self._bmaps[self._pix.level]
 		mask_cur = (bmap_cur != 0) & (bmap == 0)
-		lists_cur = [ [ (mjd, snapid, cell_id, next > 0) for (mjd, snapid, cell_id, next) in iter_siblings(self._leaves, offs) ] for offs in bmap_cur[mask_cur] ]
+		lists_cur = [ [ (mjd, snapid, cell_id, next > 0, nrows, ncached) for (mjd, snapid, cell_id, next, nrows, ncached) in self._iter_siblings(offs) ] for offs in bmap_cur[mask_cur] ]
 		try:
 			bmap[mask_cur] = lists_cur
 		except ValueError:
@@ -381,24 +488,26 @@ class TableCatalog:
 		# Repack the temporal siblings to a single numpy array, emulating a linked list
 		lists = bmap[bmap != 0]
 		llens = np.fromiter( (len(l) for l in lists), dtype=np.int32 )
-		leaves = np.empty(np.sum(llens)+2, dtype=[('mjd', 'f4'), ('snapid', object), ('cell_id', 'u8'), ('next', 'i4')])
-		leaves[:2] = [(np.inf, 0, 0, END_MARKER)]*2	# We start with two dummy entries, so that offs=0 and 1 are invalid and can take other meanings.
+		leaves = np.empty(np.sum(llens)+2, dtype=LEAF_DTYPE)
+		leaves[:2] = [DUMMY_LEAF]*2	# We start with two dummy entries, so that offs=0 and 1 are invalid and can take other meanings.
+		snapids = []
 		seen = dict()
 		at = 2
 		for l in lists:
 			last_i = len(l) - 1
-			for (i, (mjd, snapid, cell_id, has_data)) in enumerate(l):
-				# Make equal strings refer to the same string object
+			for (i, (mjd, snapid, cell_id, has_data, nrows, ncached)) in enumerate(l):
+				# Intern the snapshot IDs
 				try:
-					snapid = seen[snapid]
+					snap = seen[snapid]
 				except KeyError:
-					seen[snapid] = snapid
+					snap = seen[snapid] = len(snapids)
+					snapids.append(snapid)
 
 				next = 1 if has_data else -1
 				if i == last_i:
 					next *= END_MARKER
 
-				leaves[at] = (mjd, snapid, cell_id, next)
+				leaves[at] = (mjd, snap, cell_id, next, nrows, ncached)
 				at += 1
 
 		# Construct bmap that has offsets to head of the linked list of siblings
@@ -412,7 +521,7 @@ class TableCatalog:
 		# Recompute mipmaps
 		bmaps = self._compute_mipmaps(obmap)
 
-		return bmaps, leaves
+		return bmaps, leaves, snapids
 
 	def _compute_mipmaps(self, bmap):
 		# Create mip-maps
@@ -430,32 +539,197 @@ class TableCatalog:
 		return bmaps
 
 	def _rebuild_internal_state(self):
-		self._cell_to_snapshot = dict(v for v in izip(self._leaves['cell_id'][2:], self._leaves['snapid'][2:]))
-		assert len(self._cell_to_snapshot) == len(self._leaves)-2, (len(self._cell_to_snapshot), len(self._leaves))
+		# Sorted list of cell_ids, for lookups with searchsorted
+		order = np.argsort(self._leaves['cell_id'][2:]) + 2
+		self._cells = self._leaves['cell_id'][order]
+		self._cells_leaf = order
+		assert np.all(self._cells[1:] != self._cells[:-1]), "Duplicate cells in the catalog"
+
+		# Centers of populated pixels, and the pixel each leaf belongs to
+		# (used by get_cells()). This relies on _update() storing the
+		# temporal siblings of each pixel in a contiguous run of leaves.
+		lev  = self._pix.level
+		bmap = self._bmaps[lev]
+		i, j = np.nonzero(bmap)
+		w2 = 1 << (lev-1)
+		dx = bhpix.pix_size(lev)
+		self._pix_x, self._pix_y = (i - w2 + 0.5)*dx, (j - w2 + 0.5)*dx
+
+		heads = np.asarray(bmap[i, j], dtype=np.int64)
+		order = np.argsort(heads)
+		self._leaf_pix = np.empty(len(self._leaves), dtype=np.int64)
+		self._leaf_pix[:2] = -1
+		if len(heads):
+			self._leaf_pix[2:] = order[np.searchsorted(heads[order], np.arange(2, len(self._leaves)), side='right') - 1]
+
+		self._mean_rows = None
 
 	def update(self, table_path, pattern, snapid):
 		self.__pattern = pattern
 
-		self._bmaps, self._leaves = self._update(table_path, snapid)
+		self._bmaps, self._leaves, self._snapids = self._update(table_path, snapid)
+		self._rebuild_internal_state()
+
+	def can_update_cells(self, table_path, snapid):
+		""" Return True if update_cells() can bring the catalog up
+		    to snapid (i.e., the catalog is current with all committed
+		    snapshots older than snapid).
+		"""
+		prevsnap = max(self._snapids) if len(self._leaves) > 2 else None
+		missing = [ s for s in isnapshots(table_path, first=prevsnap, last=snapid, no_first=True) if s != snapid ]
+		return len(missing) == 0
+
+	def update_cells(self, snapid, cells):
+		""" Update the catalog with the given cells of snapshot
+		    snapid, without walking the directory tree.
+
+		    cells is an iterable of (cell_id, fn) tuples, where fn is
+		    the path to the cell's primary tablet in snapshot snapid.
+		    Cells with no such tablet are left as they are. See
+		    can_update_cells() for when this is applicable.
+		"""
+		level = self._pix.level
+		w = bhpix.width(level)
+		w2 = w // 2
+		dx = bhpix.pix_size(level)
+		bmap_cur = self._bmaps[level]
+
+		lists = dict()
+		for cell_id, fn in cells:
+			if not os.path.isfile(fn):
+				continue
+
+			# count the non-cached and cached rows in here
+			with tables.openFile(fn) as fp:
+				nrows   = len(fp.root.main.table)   if 'main'   in fp.root else 0
+				ncached = len(fp.root.cached.table) if 'cached' in fp.root else 0
+
+			x, y, t = self._pix._xyt_from_cell_id(cell_id)
+			ij = int(x // dx + w2), int(y // dx + w2)
+
+			# Start from the siblings already in the catalog
+			if ij not in lists:
+				offs = bmap_cur[ij]
+				lists[ij] = [ (mjd, snapid_, cell_id_, next > 0, nrows_, ncached_) for (mjd, snapid_, cell_id_, next, nrows_, ncached_) in self._iter_siblings(offs) ] if offs != 0 else []
+
+			siblings = [ sib for sib in lists[ij] if sib[2] != cell_id ]
+			siblings.append((t, snapid, cell_id, nrows > 0, nrows, ncached))
+			lists[ij] = siblings
+
+		bmap = np.zeros((w, w), dtype=object)
+		for ij, l in lists.iteritems():
+			bmap[ij] = l
+
+		self._bmaps, self._leaves, self._snapids = self._merge_and_pack(bmap)
 		self._rebuild_internal_state()
 
+	def _arrays(self):
+		# The arrays stored in a catalog file
+		return [
+			('bmap',       np.asarray(self._bmaps[self._pix.level], dtype=np.int32)),
+			('leaves',     self._leaves),
+			('cells',      self._cells),
+			('cells_leaf', self._cells_leaf),
+			('pix_x',      self._pix_x),
+			('pix_y',      self._pix_y),
+			('leaf_pix',   self._leaf_pix),
+		]
+
 	def save(self, fn):
+		""" Save the catalog to file fn.
+
+		    The file begins with CATALOG_MAGIC, followed by the
+		    length of the (pickled) header as a little-endian 64-bit
+		    integer, and the header itself. The header holds the
+		    Pixelization, the list of snapshot IDs, and the dtype,
+		    shape and offset of each array. The arrays follow,
+		    aligned to CATALOG_ALIGN bytes, so that load() can
+		    memory-map them.
+		"""
 		dir = os.path.dirname(os.path.normpath(fn))
 		if dir != '':
 			utils.mkdir_p(dir)
-		cPickle.dump((self._bmaps, self._leaves, self._pix), file(fn, mode='w'), -1)
+
+		arrays = [ (name, np.ascontiguousarray(a)) for name, a in self._arrays() ]
+		layout = []
+		offs = 0
+		for name, a in arrays:
+			dtype = a.dtype.descr if a.dtype.names else a.dtype.str
+			layout.append((name, dtype, a.shape, offs))
+			offs = _aligned(offs + a.nbytes)
+		header = cPickle.dumps(dict(pix=self._pix, snapids=self._snapids, arrays=layout), -1)
+
+		# Write to a temporary file, and move it into place
+		tmp = fn + '.tmp'
+		with open(tmp, 'wb') as fp:
+			fp.write(CATALOG_MAGIC)
+			fp.write(struct.pack('<Q', len(header)))
+			fp.write(header)
+			start = _aligned(fp.tell())
+			for (name, a), (_, _, _, offs) in izip(arrays, layout):
+				fp.seek(start + offs)
+				fp.write(a.tostring())
+		os.rename(tmp, fn)
 
 	def load(self, fn):
-		self._bmaps, self._leaves, self._pix = cPickle.load(file(fn))
+		with open(fn, 'rb') as fp:
+			if fp.read(len(CATALOG_MAGIC)) != CATALOG_MAGIC:
+				fp.seek(0)
+				return self._load_pickle(fp)
+
+			(hlen,) = struct.unpack('<Q', fp.read(8))
+			header = cPickle.loads(fp.read(hlen))
+			start = _aligned(fp.tell())
+
+		self._pix = header['pix']
+		self._snapids = header['snapids']
+
+		arrays = dict()
+		for name, dtype, shape, offs in header['arrays']:
+			dtype = np.dtype(dtype)
+			if np.prod(shape) == 0:
+				arrays[name] = np.empty(shape, dtype=dtype)
+			else:
+				arrays[name] = np.memmap(fn, dtype=dtype, mode='r', offset=start+offs, shape=shape)
+
+		self._bmaps = self._compute_mipmaps(arrays['bmap'])
+		self._leaves = arrays['leaves']
+		self._cells, self._cells_leaf = arrays['cells'], arrays['cells_leaf']
+		self._pix_x, self._pix_y, self._leaf_pix = arrays['pix_x'], arrays['pix_y'], arrays['leaf_pix']
+		self._mean_rows = None
+
+	def _load_pickle(self, fp):
+		# Backwards compatibility: catalogs pickled by older versions of LSD
+		bmaps, leaves, self._pix = cPickle.load(fp)
+		self._bmaps = self._compute_mipmaps(np.asarray(bmaps[self._pix.level], dtype=np.int32))
+
+		# Intern the snapshot IDs
+		self._snapids = sorted(set(leaves['snapid'][2:]))
+		index = dict((snapid, snap) for (snap, snapid) in enumerate(self._snapids))
+
+		self._leaves = np.empty(len(leaves), dtype=LEAF_DTYPE)
+		for name in ['mjd', 'cell_id', 'next']:
+			self._leaves[name] = leaves[name]
+		self._leaves['snap'][:2] = -1
+		self._leaves['snap'][2:] = [ index[snapid] for snapid in leaves['snapid'][2:] ]
+
+		# Catalogs without row counts
+		if 'nrows' in leaves.dtype.names:
+			self._leaves['nrows'] = leaves['nrows']
+			self._leaves['ncached'] = leaves['ncached']
+		else:
+			self._leaves['nrows'] = self._leaves['ncached'] = -1
+			self._leaves['nrows'][:2] = self._leaves['ncached'][:2] = 0
 
 		self._rebuild_internal_state()
 
 	def clear(self):
 		# Initialize an empty table
 		w = bhpix.width(self._pix.level)
-		self._bmaps = self._compute_mipmaps(np.zeros((w, w), dtype=object))
-		self._leaves = np.empty(2, dtype=[('mjd', 'f4'), ('snapid', object), ('cell_id', 'u8'), ('next', 'i4')])
-		self._leaves[:2] = [(np.inf, 0, 0, END_MARKER)]*2
+		self._bmaps = self._compute_mipmaps(np.zeros((w, w), dtype=np.int32))
+		self._leaves = np.empty(2, dtype=LEAF_DTYPE)
+		self._leaves[:2] = [DUMMY_LEAF]*2
+		self._snapids = []
 		
 		self._rebuild_internal_state()
 
@@ -487,25 +761,35 @@ class TableCatalog:
 
 		# Compare the temporal siblings in each bitmap
 		for offs1, offs2 in izip(bmap1[bmap1 > 1], bmap2[bmap2 > 1]):
-			list1 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _) in iter_siblings(self._leaves, offs1))
-			list2 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _) in iter_siblings(b._leaves,    offs2))
+			list1 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _, _, _) in self._iter_siblings(offs1))
+			list2 = sorted((mjd, snap_id, cell_id) for (mjd, snap_id, cell_id, _, _, _) in b._iter_siblings(offs2))
 			if list1 != list2:
 				return False
 
-		# Compare _leaves, all columns but 'next'
-		if self._leaves.dtype != b._leaves.dtype:
+		# Compare _leaves, all columns but 'next' and the row counts
+		# (and snapshot IDs, rather than their indices)
+		if self._leaves.dtype != b._leaves.dtype or len(self._leaves) != len(b._leaves):
 			return False
-		names = [ name for name in self._leaves.dtype.names if name != 'next' ]
-		s1 = np.sort(self._leaves, order=names)
-		s2 = np.sort(b._leaves,    order=names)
-		for name in names:
+		s1 = self._leaves[np.argsort(self._leaves['cell_id'], kind='mergesort')]
+		s2 = b._leaves[np.argsort(b._leaves['cell_id'], kind='mergesort')]
+		for name in ['mjd', 'cell_id']:
 			if not np.all(s1[name] == s2[name]):
 				return False
+		snapids1 = np.array(self._snapids + [0], dtype=object)[s1['snap']]	# The dummy leaves (snap=-1) map to 0
+		snapids2 = np.array(b._snapids    + [0], dtype=object)[s2['snap']]
+		if not np.all(snapids1 == snapids2):
+			return False
 
 		# Compare the signs of the 'next' column (== has_data)
 		if not np.all((s1['next'] > 0) == (s2['next'] > 0)):
 			return False
 
+		# Compare the row counts, where known in both
+		for name in ['nrows', 'ncached']:
+			known = (s1[name] >= 0) & (s2[name] >= 0)
+			if not np.all(s1[name][known] == s2[name][known]):
+				return False
+
 		# The two objects are identical
 		return True
 
@@ -524,7 +808,9 @@ def check_table_catalog(table_path, pattern, snapid=None):
 	snapshots = dict(isnapshots(table_path, return_path=True))
 	if snapid is None:
 		snapid = max(snapshots.keys())
-	fn = os.path.join(snapshots[snapid], 'catalog.pkl')
+	fn = os.path.join(snapshots[snapid], 'catalog.bin')
+	if not os.path.isfile(fn):
+		fn = os.path.join(snapshots[snapid], 'catalog.pkl')
 	cc1 = TableCatalog(fn=fn)
 
 	# Construct one from scratch
@@ -533,6 +819,144 @@ def check_table_catalog(table_path, pattern, snapid=None):
 
 	assert cc1 == cc2
 
+############################################################
+# Unit tests
+
+class Test_TableCatalog:
+	def setUp(self):
+		global tempfile, shutil
+		import tempfile, shutil
+
+		self.dir = tempfile.mkdtemp(prefix='lsd-test-catalog-')
+
+		# A catalog with a few spatial cells, some with more than one
+		# temporal cell, spread over two snapshots
+		pix = Pixelization(4, 54335, 1)
+		w = bhpix.width(pix.level)
+		w2 = w // 2
+		dx = bhpix.pix_size(pix.level)
+		bmap = np.zeros((w, w), dtype=object)
+		self.cells = []
+		for k, (i, j) in enumerate([(0, 0), (3, 5), (7, 7), (15, 2), (9, 12)]):
+			x, y = (i - w2 + 0.5)*dx, (j - w2 + 0.5)*dx
+			siblings = []
+			for n in xrange(k % 3 + 1):
+				t = pix.t0 + n*pix.dt
+				cell_id = pix._cell_id_for_xyt(x, y, t)
+				snapid = '20110617084754.101965' if n == 0 else '20110617094228.164285'
+				has_data = (k + n) % 4 != 3
+				nrows, ncached = (10*k + n if has_data else 0), k
+				siblings.append((t, snapid, cell_id, has_data, nrows, ncached))
+				self.cells.append((cell_id, snapid, nrows, ncached))
+			bmap[i, j] = siblings
+
+		self.cc = TableCatalog(pix=pix)
+		self.cc._bmaps, self.cc._leaves, self.cc._snapids = self.cc._merge_and_pack(bmap)
+		self.cc._rebuild_internal_state()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def _check_lookups(self, cc, row_counts=True):
+		for (cell_id, snapid, nrows, ncached) in self.cells:
+			leaf = cc._leaves[cc._leaf_of(cell_id)]
+			assert leaf['cell_id'] == cell_id
+			assert cc.snapshot_of_cell(cell_id) == snapid
+			if row_counts:
+				assert cc.row_counts(cell_id) == (nrows, ncached)
+			else:
+				assert cc.row_counts(cell_id) is None
+
+		# A cell that isn't in the catalog
+		cell_id = self.cells[0][0] + 1
+		try:
+			cc._leaf_of(cell_id)
+			assert False, "Expected a LookupError"
+		except LookupError:
+			pass
+
+	def test_save_load(self):
+		""" TableCatalog: save/load round-trip """
+		fn = os.path.join(self.dir, 'snap', 'catalog.bin')
+		self.cc.save(fn)
+
+		cc = TableCatalog(fn=fn)
+		assert cc == self.cc
+		assert cc._snapids == self.cc._snapids
+		assert np.all(cc._cells == self.cc._cells)
+		assert np.all(cc._leaf_pix == self.cc._leaf_pix)
+		self._check_lookups(self.cc)
+		self._check_lookups(cc)
+		assert sorted(cc.get_cells_in_snapshot('20110617094228.164285')) == sorted(self.cc.get_cells_in_snapshot('20110617094228.164285'))
+
+	def test_save_load_empty(self):
+		""" TableCatalog: save/load round-trip of an empty catalog """
+		empty = TableCatalog(pix=self.cc._pix)
+		fn = os.path.join(self.dir, 'catalog.bin')
+		empty.save(fn)
+
+		cc = TableCatalog(fn=fn)
+		assert cc == empty
+		assert len(cc._cells) == 0
+
+	def _save_legacy(self, fn, row_counts=True):
+		# Save the catalog the way older versions of LSD did (a pickle,
+		# with snapshot IDs stored in the leaves)
+		dtype = [('mjd', 'f4'), ('snapid', object), ('cell_id', 'u8'), ('next', 'i4')]
+		if row_counts:
+			dtype += [('nrows', 'i8'), ('ncached', 'i8')]
+		leaves = np.empty(len(self.cc._leaves), dtype=dtype)
+		for name, _ in dtype:
+			if name != 'snapid':
+				leaves[name] = self.cc._leaves[name]
+		leaves['snapid'][:2] = 0
+		leaves['snapid'][2:] = [ self.cc._snapids[snap] for snap in self.cc._leaves['snap'][2:] ]
+
+		with open(fn, 'wb') as fp:
+			cPickle.dump((self.cc._bmaps, leaves, self.cc._pix), fp, -1)
+
+	def test_load_legacy(self):
+		""" TableCatalog: loading a legacy catalog.pkl """
+		fn = os.path.join(self.dir, 'catalog.pkl')
+		self._save_legacy(fn)
+
+		cc = TableCatalog(fn=fn)
+		assert cc == self.cc
+		self._check_lookups(cc)
+
+		# ... and converting it to the new format
+		fn2 = os.path.join(self.dir, 'catalog.bin')
+		cc.save(fn2)
+		assert TableCatalog(fn=fn2) == self.cc
+
+	def test_load_legacy_no_row_counts(self):
+		""" TableCatalog: loading a legacy catalog.pkl without row counts """
+		fn = os.path.join(self.dir, 'catalog.pkl')
+		self._save_legacy(fn, row_counts=False)
+
+		cc = TableCatalog(fn=fn)
+		assert cc == self.cc
+		self._check_lookups(cc, row_counts=False)
+
+	def test_mean_rows_per_cell(self):
+		""" TableCatalog: mean_rows_per_cell, cached until the catalog changes """
+		nrows = [ nrows for (_, _, nrows, _) in self.cells if nrows > 0 ]
+		mean = float(sum(nrows)) / len(nrows)
+		assert self.cc.mean_rows_per_cell() == mean
+		assert self.cc._mean_rows == (mean,)
+
+		fn = os.path.join(self.dir, 'catalog.bin')
+		self.cc.save(fn)
+		assert TableCatalog(fn=fn).mean_rows_per_cell() == mean
+
+		# No populated cells
+		assert TableCatalog(pix=self.cc._pix).mean_rows_per_cell() is None
+
+		# Rebuilding the catalog recomputes it
+		self.cc._leaves['nrows'][2:] = 0
+		self.cc._rebuild_internal_state()
+		assert self.cc.mean_rows_per_cell() is None
+
 if __name__ == '__main__':
 	tpath = '/n/pan/mjuric/lsd_test5/ps1_det'
 	#check_table_catalog(tpath, 'ps1_det.astrometry.h5'); exit()
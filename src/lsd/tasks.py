@@ -3,12 +3,14 @@
 	Common tasks needed when dealing with survey datasets.
 """
 
+import os, time, tempfile, shutil
+import tables
 import pool2
 import numpy as np
 from itertools import izip
 import bhpix
 import sys
-from utils import as_columns, gnomonic, gc_dist, unpack_callable
+from utils import as_columns, gnomonic, gc_dist, unpack_callable, tempdir
 from colgroup import ColGroup
 from join_ops import IntoWriter, DB
 
@@ -89,9 +91,7 @@ def compute_coverage(db, query, dx = 0.5, bounds=None, include_cached=False, fil
 def ls_mapper(cell_id, db, tabname):
 	# return the number of rows in this chunk, keyed by the filename
 	try:
-		with db.table(tabname).lock_cell(cell_id) as cell:
-			with cell.open() as fp:
-				n = fp.root.main.table.nrows
+		n, _ = db.table(tabname).cell_row_counts(cell_id)
 	except LookupError:
 		# This can occur when counting from cells in previous snapshots,
 		# and the cell in question was not populated there
@@ -110,6 +110,12 @@ def compute_counts_aux(db, tabname, cells, progress_callback=None):
 
 def compute_counts(db, tabname, force=False):
 	if not force:
+		# Use the per-cell row counts recorded in the table catalog, if
+		# they're known for all cells
+		nrows = db.table(tabname).catalog.total_rows()
+		if nrows is not None:
+			return nrows
+
 		# Use the saved count from previous snapshot, and
 		# just add the rows added by this one
 		assert db.in_transaction()
@@ -155,9 +161,119 @@ def commit_hook__build_neighbor_cache(db, table):
 	table.rebuild_catalog()
 ###################################################################
 
+###################################################################
+## Compression benchmarking and recompression
+
+# Candidate (complib, complevel) pairs tried by benchmark_compression.
+# Codecs unsupported by the installed PyTables/HDF5 are skipped.
+compression_codecs = [
+	('blosc:lz4',  1), ('blosc:lz4',  5),
+	('blosc:zstd', 1), ('blosc:zstd', 5),
+	('blosc',      5),
+	('zlib',       1), ('zlib',       5),
+	('none',       0),
+]
+
+def codec_filters(complib, complevel):
+	""" Return the PyTables filters dict for a (complib, complevel) pair """
+	if complib == 'none':
+		return { 'complevel': 0 }
+	return { 'complib': complib, 'complevel': complevel, 'fletcher32': False }
+
+def benchmark_compression(db, tabname, cgroup, codecs=compression_codecs, ncells=10):
+	""" Benchmark compression codecs on a sample of tablets.
+
+	    Loads the tablets of cgroup from (up to) ncells cells spread
+	    over the table, and writes them out and reads them back with
+	    each of the (complib, complevel) codecs.
+
+	    Returns a list of dicts with complib, complevel, ratio (the
+	    uncompressed/compressed size ratio), write_mbps and read_mbps
+	    (throughputs, in MB/s of uncompressed data). The read is
+	    from the page cache, so it measures the decompression cost.
+	"""
+	table = db.table(tabname)
+	cells = table.get_cells(include_cached=False)
+	cells = sorted(cells)[::max(1, len(cells) // ncells)][:ncells]
+
+	blocks = [ rows for rows in (table.fetch_tablet(cell_id, cgroup) for cell_id in cells) if len(rows) ]
+	rawsize = sum(rows.nbytes for rows in blocks)
+	if rawsize == 0:
+		return []
+
+	results = []
+	tmpdir = tempfile.mkdtemp(prefix='lsd-compression-', dir=tempdir())
+	try:
+		fn = os.path.join(tmpdir, 'benchmark.h5')
+		for complib, complevel in codecs:
+			try:
+				filters = tables.Filters(**codec_filters(complib, complevel))
+			except ValueError:
+				# Codec not supported by this PyTables/HDF5 build
+				continue
+
+			t0 = time.time()
+			with tables.openFile(fn, 'w') as fp:
+				for i, rows in enumerate(blocks):
+					t = fp.createTable('/', 't%d' % i, rows.dtype, filters=filters, expectedrows=len(rows))
+					t.append(rows)
+			twrite = time.time() - t0
+			size = os.path.getsize(fn)
+
+			t0 = time.time()
+			with tables.openFile(fn) as fp:
+				for i in xrange(len(blocks)):
+					getattr(fp.root, 't%d' % i).read()
+			tread = time.time() - t0
+
+			os.unlink(fn)
+
+			mb = rawsize / 2.**20
+			results.append(dict(complib=complib, complevel=complevel, ratio=float(rawsize) / size,
+				write_mbps=mb / max(twrite, 1e-6), read_mbps=mb / max(tread, 1e-6)))
+	finally:
+		shutil.rmtree(tmpdir)
+
+	return results
+
+@pool2.non_speculative
+def _repack_mapper(cell_id, db, tabname, cgroup, rechunk):
+	db.table(tabname).repack_cell(cell_id, cgroup, rechunk)
+	yield cell_id
+
+def repack_table(db, tabname, cgroup, rechunk=False, progress_callback=None):
+	""" Rewrite all tablets of cgroup with its current filters, and
+	    (if rechunk=True) with chunk shapes recomputed from the actual
+	    number of rows in each tablet.
+
+	    Must be called from within a transaction; the rewritten
+	    tablets are written into the new snapshot. Returns the number
+	    of cells rewritten.
+	"""
+	cells = db.table(tabname).get_cells()
+
+	ncells = 0
+	pool = pool2.Pool()
+	for _ in pool.map_reduce_chain(cells, [(_repack_mapper, db, tabname, cgroup, rechunk)], progress_callback=progress_callback):
+		ncells += 1
+
+	return ncells
+
+def recompress_table(db, tabname, cgroup, complib, complevel, progress_callback=None):
+	""" Re-encode all tablets of cgroup with the given codec.
+
+	    See repack_table() for details.
+	"""
+	db.table(tabname).set_cgroup_filters(cgroup, **codec_filters(complib, complevel))
+
+	return repack_table(db, tabname, cgroup, progress_callback=progress_callback)
+
+###################################################################
+
 ###################################################################
 ## Cross-match two tables
 
+@pool2.non_speculative
 def _xmatch_mapper(qresult, tabname_to, radius, tabname_xm, n_neighbors):
 	"""
 	    Mapper:
@@ -262,7 +378,7 @@ xm_table_def = \
 	}
 }
 
-def xmatch(db, tabname_from, tabname_to, radius, neighbors):
+def xmatch(db, tabname_from, tabname_to, radius, neighbors, checkpoint=None):
 	""" Cross-match objects from tabname_to with tabname_from table and
 	    store the result into a cross-match table in tabname_from.
 
@@ -274,6 +390,9 @@ def xmatch(db, tabname_from, tabname_to, radius, neighbors):
 	        - No attempt is being made to force the xmatch result to be a
 	          one-to-one map. In particular, more than one object from tabname_from
 	          may be mapped to a same object in tabname_to
+	        - If checkpoint is given, the progress is recorded into that
+	          directory, and an interrupted run can be resumed by
+	          rerunning with the same arguments (see Query.execute)
 	"""
 	tabname_xm = '_%s_to_%s' % (tabname_from, tabname_to)
 
@@ -306,7 +425,7 @@ def xmatch(db, tabname_from, tabname_to, radius, neighbors):
 	ntot = 0
 	for (nfrom, nto, nmatch) in db.query("_ID, _LON, _LAT from '%s'" % tabname_from).execute(
 					[ (_xmatch_mapper, tabname_to, radius, tabname_xm, neighbors) ],
-					progress_callback=pool2.progress_pass):
+					progress_callback=pool2.progress_pass, checkpoint=checkpoint):
 		ntot += nmatch
 		if nfrom != 0 and nto != 0:
 			pctfrom = 100. * nmatch / nfrom
@@ -1,6 +1,8 @@
 import subprocess, os, errno
 import numpy as np
 import contextlib
+import tempfile
+import random
 
 class NamedList(list):
 	def __init__(self, *items):
@@ -286,6 +288,20 @@ def shell(cmd):
 		raise err
 	return out;
 
+def tempdirs():
+	""" Return the list of directories for large temporary files.
+
+	    These are given by LSD_TEMPDIR, which may list several
+	    directories separated by ':', and default to the system's
+	    temporary directory.
+	"""
+	dirs = [ d for d in os.getenv('LSD_TEMPDIR', '').split(':') if d ]
+	return dirs if dirs else [ tempfile.gettempdir() ]
+
+def tempdir():
+	""" Return one of tempdirs(), chosen at random """
+	return random.choice(tempdirs())
+
 def mkdir_p(path):
 	''' Recursively create a directory, but don't fail if it already exists. '''
 	try:
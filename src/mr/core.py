@@ -177,6 +177,7 @@ from collections import defaultdict, deque
 from heapq import heappop, heappush, heapify
 import traceback
 import weakref
+import serialization
 
 class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
 	def __init__(self, *args, **kwargs):
@@ -660,7 +661,7 @@ def serialize_message(fp, stage, key, value):
 	fp.write(struct.pack('<I', stage))		# 2. [uint32] Destination stage
 
 	cPickle.dump(key, fp, -1)				# 3. [pickle] Key
-	cPickle.dump(value, fp, -1)				# 4. [pickle] Value
+	serialization.dump(value, fp)				# 4. [serialization] Value
 
 	end = fp.tell()
 	fp.seek(pkt_beg)
@@ -1164,7 +1165,7 @@ class Worker(object):
 					end = buf.tell() + pkt_len
 					stage, = struct.unpack('<I', buf.read(4))	# 2. stage (uint32)
 					key = cPickle.load(buf)				# 3. key (pickled)
-					pkl_value = buf.read(end - buf.tell())		# 4. value (pickled)
+					pkl_value = buf.read(end - buf.tell())		# 4. value (serialized)
 
 					# Handle control messages right here
 					if key == AckDoneSentinel:
@@ -1295,7 +1296,7 @@ class Worker(object):
 				while True:
 					len, = struct.unpack('<Q', self.mm[at:at+8])
 					at += 8
-					v = cPickle.loads(self.mm[at:at+len])
+					v = serialization.loads(self.mm[at:at+len])
 					at += len
 
 					yield v
@@ -1633,7 +1634,7 @@ class Worker(object):
 
 				if (self.stage+1, keyhash) in self.scatterer.local_destinations:
 					# bypass TCP/IP if we're the destination
-					pkl_value = cPickle.dumps(value, -1)
+					pkl_value = serialization.dumps(value)
 					try:
 						buffer = self._gatherer_buffer_cache
 					except AttributeError:
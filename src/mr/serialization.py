@@ -0,0 +1,270 @@
+"""
+Serialization of (intermediate) values passed between MapReduce stages.
+
+Plain ndarrays, and other column-oriented types registered with
+register(), are stored as a short header (dtypes and shapes) followed by
+the raw array buffers. They're faster to write than pickles, and can be
+read back out of a memory map without copying. Everything else is
+pickled.
+
+The header also names the module that registered the type, so that (as
+with pickles) the reader doesn't need to have imported it beforehand.
+"""
+
+import cPickle
+import cStringIO
+import struct
+import mmap
+import numpy as np
+
+MAGIC = '\x00RAW'	# Marks a raw value (pickles begin with '\x80')
+
+_handlers = {}		# type -> (tag, to_columns, from_columns)
+_from_columns = {}	# tag -> from_columns
+
+def register(type_, tag, to_columns, from_columns):
+	"""
+	Register a type to be serialized as raw columns.
+
+	to_columns(obj) must return a tuple of (cols, extra), where cols
+	is a list of (name, ndarray) pairs and extra is any (small,
+	pickleable) object, or None if obj can't be serialized this
+	way. from_columns(cols, extra) must reconstruct the object.
+
+	register() should be called when the module defining
+	from_columns is imported; load() imports that module if the
+	tag hasn't been registered yet.
+	"""
+	_handlers[type_] = (tag, to_columns, from_columns)
+	_from_columns[tag] = from_columns
+
+def _ndarray_to_columns(arr):
+	if arr.dtype.hasobject:
+		return None
+	return [(None, arr)], None
+
+def _ndarray_from_columns(cols, extra):
+	return cols[0][1]
+
+register(np.ndarray, 'ndarray', _ndarray_to_columns, _ndarray_from_columns)
+
+def _get_from_columns(tag, module):
+	# Return the from_columns function registered for tag, importing
+	# the module that registered it if needed
+	try:
+		return _from_columns[tag]
+	except KeyError:
+		pass
+
+	try:
+		__import__(module)
+		return _from_columns[tag]
+	except (ImportError, KeyError) as e:
+		raise ValueError("Cannot load a raw value of type '%s': it's registered by module '%s', which could not be imported or didn't register it (%s: %s)" % (tag, module, type(e).__name__, e))
+
+def dump(obj, fp):
+	"""
+	Serialize obj into file-like object fp (or a mmap)
+	"""
+	try:
+		tag, to_columns, _ = _handlers[type(obj)]
+		ret = to_columns(obj)
+	except KeyError:
+		ret = None
+
+	if ret is None:
+		cPickle.dump(obj, fp, -1)
+		return
+
+	cols, extra = ret
+	cols = [ (name, np.ascontiguousarray(col)) for (name, col) in cols ]
+	module = _handlers[type(obj)][2].__module__
+	header = cPickle.dumps((tag, module, [ (name, col.dtype, col.shape) for (name, col) in cols ], extra), -1)
+
+	fp.write(MAGIC)
+	fp.write(struct.pack('<I', len(header)))
+	fp.write(header)
+	for (_, col) in cols:
+		fp.write(col.data)
+
+def dumps(obj):
+	"""
+	Serialize obj into a string
+	"""
+	fp = cStringIO.StringIO()
+	dump(obj, fp)
+	return fp.getvalue()
+
+def _load_columns(buf, at, layout):
+	# Construct the arrays described by layout from buffer buf,
+	# starting at offset at. Arrays are copied only if buf is
+	# read-only.
+	cols = []
+	for (name, dtype, shape) in layout:
+		count = int(np.prod(shape))
+		if count:
+			col = np.frombuffer(buf, dtype=dtype, count=count, offset=at).reshape(shape)
+			if not col.flags.writeable:
+				col = col.copy()
+		else:
+			col = np.empty(shape, dtype=dtype)
+		cols.append((name, col))
+		at += count * dtype.itemsize
+	return cols, at
+
+def load(fp):
+	"""
+	Load an object stored with dump() from file-like object fp.
+
+	If fp is a writable (or copy-on-write) mmap, the arrays are
+	constructed directly on top of the mapped memory. Note that the
+	mmap must not then be close()d while they're in use; let it be
+	garbage collected instead.
+	"""
+	at = fp.tell()
+	if fp.read(len(MAGIC)) != MAGIC:
+		fp.seek(at)
+		return cPickle.load(fp)
+
+	hlen, = struct.unpack('<I', fp.read(4))
+	tag, module, layout, extra = cPickle.loads(fp.read(hlen))
+	from_columns = _get_from_columns(tag, module)
+
+	if isinstance(fp, mmap.mmap):
+		cols, end = _load_columns(fp, fp.tell(), layout)
+		fp.seek(end)
+	else:
+		cols = []
+		for (name, dtype, shape) in layout:
+			count = int(np.prod(shape))
+			col, _ = _load_columns(fp.read(count * dtype.itemsize), 0, [(name, dtype, shape)])
+			cols += col
+
+	return from_columns(cols, extra)
+
+def loads(s):
+	"""
+	Load an object stored with dumps() from a string
+	"""
+	if s[:len(MAGIC)] != MAGIC:
+		return cPickle.loads(s)
+
+	at = len(MAGIC)
+	hlen, = struct.unpack('<I', s[at:at+4])
+	at += 4
+	tag, module, layout, extra = cPickle.loads(s[at:at+hlen])
+	from_columns = _get_from_columns(tag, module)
+	cols, _ = _load_columns(s, at + hlen, layout)
+
+	return from_columns(cols, extra)
+
+############ Unit tests
+
+class Test_serialization:
+	"""serialization: round-trips through dumps/loads and dump/load"""
+	def setUp(self):
+		global ColGroup, os, tempfile, subprocess, sys
+		import os, tempfile, subprocess, sys
+		from lsd.colgroup import ColGroup
+
+	def _objects(self):
+		a = np.arange(40, dtype='f8').reshape(8, 5)
+		cg = ColGroup()
+		cg.f1 = np.arange(10)
+		cg.f2 = np.arange(20, dtype='f4').reshape(10, 2)
+
+		return [
+			a[::2],					# non-contiguous
+			a.T,					# non-contiguous (Fortran order)
+			np.arange(0, dtype='i4'),		# empty
+			np.empty((0, 3), dtype='f8'),		# empty, 2D
+			cg,
+			np.array([1, 'a', None], dtype=object),	# pickled
+			{ 'a': 1, 'b': [2, 3] }
+		]
+
+	def _check(self, obj, obj2):
+		assert type(obj) == type(obj2)
+		if isinstance(obj, np.ndarray):
+			assert obj.dtype == obj2.dtype
+			assert obj.shape == obj2.shape
+			assert np.all(obj == obj2)
+		elif isinstance(obj, ColGroup):
+			assert obj.keys() == obj2.keys()
+			for name in obj.keys():
+				assert obj[name].dtype == obj2[name].dtype
+				assert np.all(obj[name] == obj2[name])
+		else:
+			assert obj == obj2
+
+	def test_dumps_loads(self):
+		"""serialization: dumps/loads"""
+		for obj in self._objects():
+			s = dumps(obj)
+			self._check(obj, loads(s))
+
+	def test_raw_or_pickled(self):
+		"""serialization: raw format for arrays, pickles for the rest"""
+		objs = self._objects()
+		for obj in objs[:5]:
+			assert dumps(obj).startswith(MAGIC)
+		for obj in objs[5:]:
+			assert not dumps(obj).startswith(MAGIC)
+
+	def test_dump_load_mmap(self):
+		"""serialization: dump/load on a copy-on-write mmap"""
+		objs = self._objects()
+		with tempfile.TemporaryFile() as fp:
+			for obj in objs:
+				dump(obj, fp)
+			fp.flush()
+
+			mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+			for obj in objs:
+				self._check(obj, load(mm))
+			assert mm.tell() == len(mm)
+
+	def test_dump_load_file(self):
+		"""serialization: dump/load on a regular file"""
+		objs = self._objects()
+		with tempfile.TemporaryFile() as fp:
+			for obj in objs:
+				dump(obj, fp)
+			fp.seek(0)
+
+			for obj in objs:
+				self._check(obj, load(fp))
+
+	def test_load_imports_handler(self):
+		"""serialization: loading a ColGroup without importing lsd.colgroup"""
+		cg = self._objects()[4]
+		with tempfile.NamedTemporaryFile() as fp:
+			dump(cg, fp)
+			fp.flush()
+
+			code = "import sys; from mr import serialization; obj = serialization.load(open(sys.argv[1], 'rb')); print type(obj).__name__, len(obj)"
+			srcdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+			out = subprocess.check_output([sys.executable, '-c', code, fp.name], cwd=srcdir)
+			assert out.split() == ['ColGroup', str(len(cg))]
+
+	def test_unknown_handler(self):
+		"""serialization: informative error for an unregistered type"""
+		class Unknown(object):
+			pass
+		def from_columns(cols, extra):
+			return Unknown()
+		from_columns.__module__ = 'no_such_module'
+
+		register(Unknown, 'unknown', lambda obj: ([], None), from_columns)
+		try:
+			s = dumps(Unknown())
+			del _from_columns['unknown']
+			try:
+				loads(s)
+			except ValueError as e:
+				assert 'no_such_module' in str(e)
+			else:
+				assert 0, "loads() should have raised ValueError"
+		finally:
+			_handlers.pop(Unknown, None)
+			_from_columns.pop('unknown', None)
@@ -347,6 +347,7 @@ def import_from_catalogs(db, det_tabname, exp_tabname, catalog_files, create=Fal
 	del pool
 	explist_file.close()
 
+@pool2.non_speculative
 def import_from_catalogs_aux(file, det_table, exp_table, djm, all=False):
     # read SExtractor catalog file
 #	print >>sys.stderr, file